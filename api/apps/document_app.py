@@ -29,7 +29,7 @@ from api.db import FileType, TaskStatus, ParserType, FileSource
 from api.db.db_models import File, Task
 from api.db.services.file2document_service import File2DocumentService
 from api.db.services.file_service import FileService
-from api.db.services.task_service import queue_tasks
+from api.db.services.task_service import cancel_all_task_of, queue_tasks
 from api.db.services.user_service import UserTenantService
 from api.db.services import duplicate_name
 from api.db.services.knowledgebase_service import KnowledgebaseService
@@ -364,6 +364,8 @@ def run():
                 info["chunk_num"] = 0
                 info["token_num"] = 0
             DocumentService.update_by_id(id, info)
+            if str(req["run"]) == TaskStatus.CANCEL.value:
+                cancel_all_task_of(id)
             tenant_id = DocumentService.get_tenant_id(id)
             if not tenant_id:
                 return get_data_error_result(message="Tenant not found!")
@@ -31,6 +31,7 @@ from api.db.services.knowledgebase_service import KnowledgebaseService
 from api.db.db_models import File
 from api.utils.api_utils import get_json_result
 from api import settings
+from graphrag.utils import get_graph_preview
 from rag.nlp import search
 from api.constants import DATASET_NAME_LIMIT
 from rag.settings import PAGERANK_FLD
@@ -316,7 +317,9 @@ def knowledge_graph(kb_id):
 
         obj[ty] = content_json
 
-    if "nodes" in obj["graph"]:
+    if "entities" in obj["graph"]:
+        obj["graph"] = get_graph_preview(kb.tenant_id, kb_id, obj["graph"])
+    elif "nodes" in obj["graph"]:
         obj["graph"]["nodes"] = sorted(obj["graph"]["nodes"], key=lambda x: x.get("pagerank", 0), reverse=True)[:256]
         if "edges" in obj["graph"]:
             node_id_set = { o["id"] for o in obj["graph"]["nodes"] }
@@ -25,7 +25,7 @@ import xxhash
 import re
 from api.utils.api_utils import token_required
 from api.db.db_models import Task
-from api.db.services.task_service import TaskService, queue_tasks
+from api.db.services.task_service import TaskService, cancel_all_task_of, queue_tasks
 from api.utils.api_utils import server_error_response
 from api.utils.api_utils import get_result, get_error_data_result
 from io import BytesIO
@@ -790,6 +790,7 @@ def stop_parsing(tenant_id, dataset_id):
             )
         info = {"run": "2", "progress": 0, "chunk_num": 0}
         DocumentService.update_by_id(id, info)
+        cancel_all_task_of(id)
         settings.docStoreConn.delete({"doc_id": doc[0].id}, search.index_name(tenant_id), dataset_id)
         success_count += 1
     if duplicate_messages:
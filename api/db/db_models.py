@@ -422,7 +422,7 @@ def init_database_tables(alter_fields=[]):
     table_objs = []
     create_failed_list = []
     for name, obj in members:
-        if obj != DataBaseModel and issubclass(obj, DataBaseModel):
+        if obj is TaskChunk or (obj != DataBaseModel and issubclass(obj, DataBaseModel)):
             table_objs.append(obj)
             logging.debug(f"start create table {obj.__name__}")
             try:
@@ -676,6 +676,17 @@ class Task(DataBaseModel):
     chunk_ids = LongTextField(null=True, help_text="chunk ids", default="")
 
 
+class TaskChunk(Model):
+    # a row per chunk, so none of the indexed create and update times of BaseModel
+    task_id = CharField(max_length=32, null=False, help_text="task id")
+    chunk_id = CharField(max_length=64, null=False, help_text="id of a chunk inserted by the task")
+
+    class Meta:
+        database = DB
+        db_table = "task_chunk"
+        primary_key = CompositeKey("task_id", "chunk_id")
+
+
 class Dialog(DataBaseModel):
     id = CharField(max_length=32, primary_key=True)
     tenant_id = CharField(max_length=32, null=False, index=True)
@@ -883,3 +894,8 @@ def migrate_db():
             migrate(migrator.add_column("llm", "is_tools", BooleanField(null=False, help_text="support tools", default=False)))
         except Exception:
             pass
+        for column in ["create_time", "create_date", "update_time", "update_date"]:
+            try:
+                migrate(migrator.drop_column("task_chunk", column))
+            except Exception:
+                pass
@@ -15,8 +15,12 @@
 #
 import binascii
 import logging
+import os
 import re
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from copy import deepcopy
 from functools import partial
 from timeit import default_timer as timer
@@ -35,10 +39,17 @@ from rag.app.resume import forbidden_select_fields4resume
 from rag.app.tag import label_question
 from rag.nlp.search import index_name
 from rag.prompts import chunks_format, citation_prompt, full_question, kb_prompt, keyword_extraction, llm_id2llm_type, message_fit_in
-from rag.utils import num_tokens_from_string, rmSpace
+from rag.utils import TokenCounter, num_tokens_from_string, rmSpace
 from rag.utils.tavily_conn import Tavily
 
 
+# web search and knowledge graph retrieval run beside the knowledge base retrieval of chat()
+CHAT_RETRIEVAL_THREADS = int(os.environ.get("CHAT_RETRIEVAL_THREADS", "32"))
+RETRIEVAL_EXECUTOR = ThreadPoolExecutor(max_workers=CHAT_RETRIEVAL_THREADS, thread_name_prefix="chat_retrieval")
+WEB_SEARCH_TIMEOUT = float(os.environ.get("WEB_SEARCH_TIMEOUT", "30"))
+KG_RETRIEVAL_TIMEOUT = float(os.environ.get("KG_RETRIEVAL_TIMEOUT", "120"))
+
+
 class DialogService(CommonService):
     model = Dialog
 
@@ -61,6 +72,54 @@ class DialogService(CommonService):
         return list(chats.dicts())
 
 
+class RetrievalJob:
+    """
+    A retrieval run on RETRIEVAL_EXECUTOR. Its timeout counts from when a thread picks it up, and is handed to
+    the retrieval itself so that the thread is given back about then; waiting for a thread is bounded by it too.
+    """
+
+    lock = threading.Lock()
+    unfinished = 0
+
+    def __init__(self, source, timeout, func, *args, **kwargs):
+        self.source = source
+        self.timeout = timeout
+        self.started = threading.Event()
+        self.started_at = None
+        self.submitted_at = timer()
+        with RetrievalJob.lock:
+            RetrievalJob.unfinished += 1
+            unfinished = RetrievalJob.unfinished
+        if unfinished > CHAT_RETRIEVAL_THREADS:
+            logging.warning(f"Chat retrieval pool is saturated: {unfinished} retrievals for {CHAT_RETRIEVAL_THREADS} threads, {source} has to wait.")
+        self.future = RETRIEVAL_EXECUTOR.submit(self._run, func, args, kwargs)
+        self.future.add_done_callback(RetrievalJob._done)
+
+    def _run(self, func, args, kwargs):
+        self.started_at = timer()
+        self.started.set()
+        return func(*args, timeout=self.timeout, **kwargs)
+
+    @staticmethod
+    def _done(_):
+        with RetrievalJob.lock:
+            RetrievalJob.unfinished -= 1
+
+    def result(self):
+        """Wait for the retrieval, None if it failed, timed out or didn't get a thread in time."""
+        try:
+            if not self.started.wait(max(0, self.submitted_at + self.timeout - timer())):
+                self.future.cancel()
+                logging.warning(f"{self.source} retrieval waited {self.timeout}s for a thread, answer without it.")
+                return None
+            return self.future.result(timeout=max(0, self.started_at + self.timeout - timer()))
+        except FutureTimeoutError:
+            logging.warning(f"{self.source} retrieval timed out, answer without it.")
+        except Exception:
+            logging.exception(f"{self.source} retrieval failed, answer without it.")
+        return None
+
+
 def chat_solo(dialog, messages, stream=True):
     if llm_id2llm_type(dialog.llm_id) == "image2text":
         chat_mdl = LLMBundle(dialog.tenant_id, LLMType.IMAGE2TEXT, dialog.llm_id)
@@ -74,12 +133,15 @@ def chat_solo(dialog, messages, stream=True):
     msg = [{"role": m["role"], "content": re.sub(r"##\d+\$\$", "", m["content"])} for m in messages if m["role"] != "system"]
     if stream:
         last_ans = ""
+        last_tk_num = 0
+        counter = TokenCounter()
         for ans in chat_mdl.chat_streamly(prompt_config.get("system", ""), msg, dialog.llm_setting):
             answer = ans
             delta_ans = ans[len(last_ans) :]
-            if num_tokens_from_string(delta_ans) < 16:
+            if counter.update(answer) - last_tk_num < 16:
                 continue
             last_ans = answer
+            last_tk_num = counter.count
             yield {"answer": answer, "reference": {}, "audio_binary": tts(tts_mdl, delta_ans), "prompt": "", "created_at": time.time()}
         if delta_ans:
             yield {"answer": answer, "reference": {}, "audio_binary": tts(tts_mdl, delta_ans), "prompt": "", "created_at": time.time()}
@@ -188,12 +250,20 @@ def chat(dialog, messages, stream=True, **kwargs):
     if "knowledge" not in [p["key"] for p in prompt_config["parameters"]]:
         knowledges = []
     else:
+        tenant_ids = list(set([kb.tenant_id for kb in kbs]))
+
+        # web search and the knowledge graph don't need the extracted keywords, start them first
+        web_job, kg_job = None, None
+        if not prompt_config.get("reasoning", False):
+            if prompt_config.get("tavily_api_key"):
+                web_job = RetrievalJob("Web search", WEB_SEARCH_TIMEOUT, Tavily(prompt_config["tavily_api_key"]).retrieve_chunks, " ".join(questions))
+            if prompt_config.get("use_kg"):
+                kg_job = RetrievalJob("Knowledge graph", KG_RETRIEVAL_TIMEOUT, settings.kg_retrievaler.retrieval, " ".join(questions), tenant_ids, dialog.kb_ids, embd_mdl, LLMBundle(dialog.tenant_id, LLMType.CHAT))
+
         if prompt_config.get("keyword", False):
             questions[-1] += keyword_extraction(chat_mdl, questions[-1])
             generate_keyword_ts = timer()
 
-        tenant_ids = list(set([kb.tenant_id for kb in kbs]))
-
         knowledges = []
         if prompt_config.get("reasoning", False):
             reasoner = DeepResearcher(
@@ -224,15 +294,14 @@ def chat(dialog, messages, stream=True, **kwargs):
                 rerank_mdl=rerank_mdl,
                 rank_feature=label_question(" ".join(questions), kbs),
             )
-            if prompt_config.get("tavily_api_key"):
-                tav = Tavily(prompt_config["tavily_api_key"])
-                tav_res = tav.retrieve_chunks(" ".join(questions))
+            # merge in a fixed order whatever finishes first: knowledge base, web, knowledge graph on top
+            tav_res = web_job.result() if web_job else None
+            if tav_res:
                 kbinfos["chunks"].extend(tav_res["chunks"])
                 kbinfos["doc_aggs"].extend(tav_res["doc_aggs"])
-            if prompt_config.get("use_kg"):
-                ck = settings.kg_retrievaler.retrieval(" ".join(questions), tenant_ids, dialog.kb_ids, embd_mdl, LLMBundle(dialog.tenant_id, LLMType.CHAT))
-                if ck["content_with_weight"]:
-                    kbinfos["chunks"].insert(0, ck)
+            ck = kg_job.result() if kg_job else None
+            if ck and ck["content_with_weight"]:
+                kbinfos["chunks"].insert(0, ck)
 
             knowledges = kb_prompt(kbinfos, max_tokens)
 
@@ -348,15 +417,18 @@ def chat(dialog, messages, stream=True, **kwargs):
 
     if stream:
         last_ans = ""
+        last_tk_num = 0
         answer = ""
+        counter = TokenCounter()
         for ans in chat_mdl.chat_streamly(prompt + prompt4citation, msg[1:], gen_conf):
             if thought:
                 ans = re.sub(r"<think>.*</think>", "", ans, flags=re.DOTALL)
             answer = ans
             delta_ans = ans[len(last_ans) :]
-            if num_tokens_from_string(delta_ans) < 16:
+            if counter.update(answer) - last_tk_num < 16:
                 continue
             last_ans = answer
+            last_tk_num = counter.count
             yield {"answer": thought + answer, "reference": {}, "audio_binary": tts(tts_mdl, delta_ans)}
         delta_ans = answer[len(last_ans) :]
         if delta_ans:
@@ -15,8 +15,10 @@
 #
 import json
 import logging
+import os
 import random
 import re
+from collections import defaultdict
 from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 from datetime import datetime
@@ -34,9 +36,14 @@ from api.db.services.common_service import CommonService
 from api.db.services.knowledgebase_service import KnowledgebaseService
 from api.utils import current_timestamp, get_format_time, get_uuid
 from rag.nlp import rag_tokenizer, search
-from rag.settings import get_svr_queue_name
+from rag.settings import DOC_PROGRESS_QUEUE_NAME
+from rag.utils.page_cache import PAGE_ANALYSIS_CACHE
 from rag.utils.redis_conn import REDIS_CONN
 from rag.utils.storage_factory import STORAGE_IMPL
+from rag.utils.task_scheduler import TASK_SCHEDULER
+
+# documents synced with their tasks at a time, and progress events consumed at a time
+DOC_PROGRESS_BATCH = int(os.environ.get("DOC_PROGRESS_BATCH", "1024"))
 
 
 class DocumentService(CommonService):
@@ -101,6 +108,7 @@ class DocumentService(CommonService):
     @DB.connection_context()
     def remove_document(cls, doc, tenant_id):
         cls.clear_chunk_num(doc.id)
+        PAGE_ANALYSIS_CACHE.drop_doc(doc.id)
         try:
             settings.docStoreConn.delete({"doc_id": doc.id}, search.index_name(tenant_id), doc.kb_id)
             settings.docStoreConn.update({"kb_id": doc.kb_id, "knowledge_graph_kwd": ["entity", "relation", "graph", "subgraph", "community_report"], "source_id": doc.id},
@@ -146,7 +154,7 @@ class DocumentService(CommonService):
 
     @classmethod
     @DB.connection_context()
-    def get_unfinished_docs(cls):
+    def get_unfinished_docs(cls, doc_ids=None):
         fields = [cls.model.id, cls.model.process_begin_at, cls.model.parser_config, cls.model.progress_msg,
                   cls.model.run, cls.model.parser_id]
         docs = cls.model.select(*fields) \
@@ -155,6 +163,8 @@ class DocumentService(CommonService):
             ~(cls.model.type == FileType.VIRTUAL.value),
             cls.model.progress < 1,
             cls.model.progress > 0)
+        if doc_ids is not None:
+            docs = docs.where(cls.model.id.in_(doc_ids))
         return list(docs.dicts())
 
     @classmethod
@@ -385,20 +395,55 @@ class DocumentService(CommonService):
     @classmethod
     @DB.connection_context()
     def update_progress(cls):
+        """Sync every unfinished document with its tasks, catching up on progress events which got lost."""
         docs = cls.get_unfinished_docs()
+        for i in range(0, len(docs), DOC_PROGRESS_BATCH):
+            cls.sync_progress(docs[i:i + DOC_PROGRESS_BATCH])
+
+    @classmethod
+    def consume_progress_events(cls, timeout):
+        """
+        Sync the documents of the tasks whose progress was published to DOC_PROGRESS_QUEUE_NAME,
+        waiting up to `timeout` seconds for some. Returns the number of events consumed.
+        """
+        events = REDIS_CONN.queue_wait(DOC_PROGRESS_QUEUE_NAME, DOC_PROGRESS_BATCH, timeout)
+        if not events:
+            return 0
+        cls.update_progress_by_tasks(set(e["task_id"] for _, e in events))
+        REDIS_CONN.queue_delete(DOC_PROGRESS_QUEUE_NAME, [msg_id for msg_id, _ in events])
+        return len(events)
+
+    @classmethod
+    @DB.connection_context()
+    def update_progress_by_tasks(cls, task_ids):
+        doc_ids = [t.doc_id for t in Task.select(Task.doc_id).where(Task.id.in_(list(task_ids))).distinct()]
+        if doc_ids:
+            cls.sync_progress(cls.get_unfinished_docs(doc_ids))
+
+    @classmethod
+    @DB.connection_context()
+    def sync_progress(cls, docs):
+        """Recompute the progress of `docs`, rows of get_unfinished_docs, from the tasks of all of them at once."""
+        if not docs:
+            return
+        tasks = defaultdict(list)
+        fields = [Task.doc_id, Task.task_type, Task.progress, Task.progress_msg, Task.priority]
+        for t in Task.select(*fields).where(Task.doc_id.in_([d["id"] for d in docs])).order_by(Task.create_time):
+            tasks[t.doc_id].append(t)
+
+        updates = []
         for d in docs:
+            tsks = tasks.get(d["id"])
+            if not tsks:
+                continue
             try:
-                tsks = Task.query(doc_id=d["id"], order_by=Task.create_time)
-                if not tsks:
-                    continue
                 msg = []
                 prg = 0
                 finished = True
                 bad = 0
                 has_raptor = False
                 has_graphrag = False
-                e, doc = DocumentService.get_by_id(d["id"])
-                status = doc.run  # TaskStatus.RUNNING.value
+                status = d["run"]  # TaskStatus.RUNNING.value
                 priority = 0
                 for t in tsks:
                     if 0 <= t.progress < 1:
@@ -428,6 +473,7 @@ class DocumentService(CommonService):
 
                 msg = "\n".join(sorted(msg))
                 info = {
+                    "id": d["id"],
                     "process_duation": datetime.timestamp(
                         datetime.now()) -
                     d["process_begin_at"].timestamp(),
@@ -436,10 +482,11 @@ class DocumentService(CommonService):
                     info["progress"] = prg
                 if msg:
                     info["progress_msg"] = msg
-                cls.update_by_id(d["id"], info)
+                updates.append(info)
             except Exception as e:
                 if str(e).find("'0'") < 0:
                     logging.exception("fetch task exception")
+        cls.update_many_by_id(updates)
 
     @classmethod
     @DB.connection_context()
@@ -481,7 +528,7 @@ def queue_raptor_o_graphrag_tasks(doc, ty, priority):
     hasher.update(ty.encode("utf-8"))
     task["digest"] = hasher.hexdigest()
     bulk_insert_into_db(Task, [task], True)
-    assert REDIS_CONN.queue_product(get_svr_queue_name(priority), message=task), "Can't access Redis. Please check the Redis' status."
+    assert TASK_SCHEDULER.enqueue(priority, chunking_config["tenant_id"], ty, task), "Can't access Redis. Please check the Redis' status."
 
 
 def doc_upload_and_parse(conversation_id, file_objs, user_id):
@@ -15,6 +15,7 @@
 #
 import logging
 
+import numpy as np
 from langfuse import Langfuse
 
 from api import settings
@@ -24,6 +25,7 @@ from api.db.services.common_service import CommonService
 from api.db.services.langfuse_service import TenantLangfuseService
 from api.db.services.user_service import TenantService
 from rag.llm import ChatModel, CvModel, EmbeddingModel, RerankModel, Seq2txtModel, TTSModel
+from rag.utils.embedding_cache import EMBEDDING_CACHE
 
 
 class LLMFactoriesService(CommonService):
@@ -215,12 +217,27 @@ class LLMBundle:
         else:
             self.langfuse = None
 
+    def embedding_cache_key(self):
+        """What tells the vectors of this model apart from others' in EMBEDDING_CACHE."""
+        base_url = getattr(getattr(self.mdl, "client", None), "base_url", "") or getattr(self.mdl, "base_url", "")
+        return f"{self.mdl.__class__.__name__}/{getattr(self.mdl, 'model_name', self.llm_name)}/{base_url}"
+
     def encode(self, texts: list):
         if self.langfuse:
             generation = self.trace.generation(name="encode", model=self.llm_name, input={"texts": texts})
 
-        embeddings, used_tokens = self.mdl.encode(texts)
-        if not TenantLLMService.increase_usage(self.tenant_id, self.llm_type, used_tokens):
+        # only texts never embedded by this model go to the provider
+        cache_key = self.embedding_cache_key()
+        vects = EMBEDDING_CACHE.get(cache_key, texts)
+        missing = list(dict.fromkeys(t for t, v in zip(texts, vects) if v is None))
+        used_tokens = 0
+        if missing:
+            embeddings, used_tokens = self.mdl.encode(missing)
+            EMBEDDING_CACHE.set(cache_key, missing, embeddings)
+            embeddings = dict(zip(missing, embeddings))
+            vects = [embeddings[t] if v is None else v for t, v in zip(texts, vects)]
+        embeddings = np.array(vects)
+        if used_tokens and not TenantLLMService.increase_usage(self.tenant_id, self.llm_type, used_tokens):
             logging.error("LLMBundle.encode can't update token usage for {}/EMBEDDING used_tokens: {}".format(self.tenant_id, used_tokens))
 
         if self.langfuse:
@@ -232,8 +249,13 @@ class LLMBundle:
         if self.langfuse:
             generation = self.trace.generation(name="encode_queries", model=self.llm_name, input={"query": query})
 
-        emd, used_tokens = self.mdl.encode_queries(query)
-        if not TenantLLMService.increase_usage(self.tenant_id, self.llm_type, used_tokens):
+        cache_key = self.embedding_cache_key()
+        emd = EMBEDDING_CACHE.get(cache_key, [query], "query")[0]
+        used_tokens = 0
+        if emd is None:
+            emd, used_tokens = self.mdl.encode_queries(query)
+            EMBEDDING_CACHE.set(cache_key, [query], [emd], "query")
+        if used_tokens and not TenantLLMService.increase_usage(self.tenant_id, self.llm_type, used_tokens):
             logging.error("LLMBundle.encode_queries can't update token usage for {}/EMBEDDING used_tokens: {}".format(self.tenant_id, used_tokens))
 
         if self.langfuse:
@@ -20,17 +20,18 @@ from datetime import datetime
 
 from api.db.db_utils import bulk_insert_into_db
 from deepdoc.parser import PdfParser
-from peewee import JOIN
+from peewee import JOIN, fn
 from api.db.db_models import DB, File2Document, File
 from api.db import StatusEnum, FileType, TaskStatus
-from api.db.db_models import Task, Document, Knowledgebase, Tenant
+from api.db.db_models import Task, TaskChunk, Document, Knowledgebase, Tenant
 from api.db.services.common_service import CommonService
 from api.db.services.document_service import DocumentService
 from api.utils import current_timestamp, get_uuid
 from deepdoc.parser.excel_parser import RAGFlowExcelParser
-from rag.settings import get_svr_queue_name
+from rag.settings import DOC_PROGRESS_QUEUE_MAXLEN, DOC_PROGRESS_QUEUE_NAME, TASK_CANCEL_CHANNEL
 from rag.utils.storage_factory import STORAGE_IMPL
 from rag.utils.redis_conn import REDIS_CONN
+from rag.utils.task_scheduler import TASK_SCHEDULER
 from api import settings
 from rag.nlp import search
 
@@ -146,8 +147,8 @@ class TaskService(CommonService):
             doc_id (str): The unique identifier of the document.
     
         Returns:
-            list[dict]: List of task dictionaries containing task details.
-                       Returns None if no tasks are found.
+            list[dict]: List of task dictionaries containing task details, with the number of
+                       chunks in their ledgers as `chunk_num`. Returns None if no tasks are found.
         """
         fields = [
             cls.model.id,
@@ -163,21 +164,59 @@ class TaskService(CommonService):
         tasks = list(tasks.dicts())
         if not tasks:
             return None
+        chunk_nums = dict(
+            TaskChunk.select(TaskChunk.task_id, fn.COUNT(TaskChunk.chunk_id))
+            .where(TaskChunk.task_id.in_([t["id"] for t in tasks]))
+            .group_by(TaskChunk.task_id).tuples()
+        )
+        for t in tasks:
+            t["chunk_num"] = chunk_nums.get(t["id"], 0)
         return tasks
 
     @classmethod
     @DB.connection_context()
-    def update_chunk_ids(cls, id: str, chunk_ids: str):
-        """Update the chunk IDs associated with a task.
-    
-        This method updates the chunk_ids field of a task, which stores the IDs of
-        processed document chunks in a space-separated string format.
-    
+    def add_chunk_ids(cls, id: str, chunk_ids: list[str]) -> bool:
+        """Append the IDs of chunks a task inserted to its ledger.
+
         Args:
             id (str): The unique identifier of the task.
-            chunk_ids (str): Space-separated string of chunk identifiers.
+            chunk_ids (list[str]): IDs of the chunks inserted since the last call.
+
+        Returns:
+            bool: False, with nothing added, if the task doesn't exist anymore.
         """
-        cls.model.update(chunk_ids=chunk_ids).where(cls.model.id == id).execute()
+        if not cls.model.select(cls.model.id).where(cls.model.id == id).exists():
+            return False
+        rows = [(id, chunk_id) for chunk_id in dict.fromkeys(chunk_ids)]
+        with DB.atomic():
+            for i in range(0, len(rows), 1000):
+                TaskChunk.insert_many(rows[i:i + 1000], fields=[TaskChunk.task_id, TaskChunk.chunk_id]) \
+                    .on_conflict_ignore().execute()
+        return True
+
+    @classmethod
+    @DB.connection_context()
+    def get_chunk_ids(cls, task_ids: list[str]) -> list[str]:
+        """IDs of the chunks in the ledgers of the tasks."""
+        if not task_ids:
+            return []
+        return [r.chunk_id for r in TaskChunk.select(TaskChunk.chunk_id).where(TaskChunk.task_id.in_(task_ids))]
+
+    @classmethod
+    @DB.connection_context()
+    def move_chunk_ids(cls, task_ids: dict[str, str]):
+        """Hand the ledgers of tasks over to the tasks reusing their chunks, given as {previous task id: task id}."""
+        with DB.atomic():
+            for prev_id, id in task_ids.items():
+                TaskChunk.update(task_id=id).where(TaskChunk.task_id == prev_id).execute()
+
+    @classmethod
+    @DB.connection_context()
+    def filter_delete(cls, filters):
+        """Delete the tasks matching the filters together with their chunk ledgers."""
+        with DB.atomic():
+            TaskChunk.delete().where(TaskChunk.task_id.in_(cls.model.select(cls.model.id).where(*filters))).execute()
+            return cls.model.delete().where(*filters).execute()
 
     @classmethod
     @DB.connection_context()
@@ -268,25 +307,28 @@ class TaskService(CommonService):
                         - progress (float, optional): Progress percentage (0.0 to 1.0)
         """
         if os.environ.get("MACOS"):
-            if info["progress_msg"]:
-                task = cls.model.get_by_id(id)
-                progress_msg = trim_header_by_lines(task.progress_msg + "\n" + info["progress_msg"], 3000)
-                cls.model.update(progress_msg=progress_msg).where(cls.model.id == id).execute()
-            if "progress" in info:
-                cls.model.update(progress=info["progress"]).where(
-                    cls.model.id == id
-                ).execute()
-            return
-
-        with DB.lock("update_progress", -1):
-            if info["progress_msg"]:
-                task = cls.model.get_by_id(id)
-                progress_msg = trim_header_by_lines(task.progress_msg + "\n" + info["progress_msg"], 3000)
-                cls.model.update(progress_msg=progress_msg).where(cls.model.id == id).execute()
-            if "progress" in info:
-                cls.model.update(progress=info["progress"]).where(
-                    cls.model.id == id
-                ).execute()
+            cls._update_progress(id, info)
+        else:
+            with DB.lock("update_progress", -1):
+                cls._update_progress(id, info)
+        # the document is brought up to date by the server consuming these
+        REDIS_CONN.queue_product(DOC_PROGRESS_QUEUE_NAME, {"task_id": id}, maxlen=DOC_PROGRESS_QUEUE_MAXLEN)
+
+    @classmethod
+    def _update_progress(cls, id, info):
+        if info["progress_msg"]:
+            task = cls.model.get_by_id(id)
+            progress_msg = trim_header_by_lines(task.progress_msg + "\n" + info["progress_msg"], 3000)
+            cls.model.update(progress_msg=progress_msg).where(cls.model.id == id).execute()
+        if "progress" in info:
+            cls.model.update(progress=info["progress"]).where(
+                cls.model.id == id
+            ).execute()
+
+
+def cancel_all_task_of(doc_id):
+    """Tell the task executors the parsing of the document was canceled, they check the database every few seconds otherwise."""
+    REDIS_CONN.publish(TASK_CANCEL_CHANNEL, doc_id)
 
 
 def queue_tasks(doc: dict, bucket: str, name: str, priority: int):
@@ -366,11 +408,14 @@ def queue_tasks(doc: dict, bucket: str, name: str, priority: int):
     if prev_tasks:
         for task in parse_task_array:
             ck_num += reuse_prev_task_chunks(task, prev_tasks, chunking_config)
-        TaskService.filter_delete([Task.doc_id == doc["id"]])
-        chunk_ids = []
-        for task in prev_tasks:
+        TaskService.move_chunk_ids({t["id"]: t["reused_by"] for t in prev_tasks if t.get("reused_by")})
+        stale_tasks = [t for t in prev_tasks if not t.get("reused_by")]
+        chunk_ids = TaskService.get_chunk_ids([t["id"] for t in stale_tasks if t["chunk_num"]])
+        for task in stale_tasks:
+            # written by earlier versions in place of the ledger
             if task["chunk_ids"]:
                 chunk_ids.extend(task["chunk_ids"].split())
+        TaskService.filter_delete([Task.doc_id == doc["id"]])
         if chunk_ids:
             settings.docStoreConn.delete({"id": chunk_ids}, search.index_name(chunking_config["tenant_id"]),
                                          chunking_config["kb_id"])
@@ -381,8 +426,10 @@ def queue_tasks(doc: dict, bucket: str, name: str, priority: int):
 
     unfinished_task_array = [task for task in parse_task_array if task["progress"] < 1.0]
     for unfinished_task in unfinished_task_array:
-        assert REDIS_CONN.queue_product(
-            get_svr_queue_name(priority), message=unfinished_task
+        # pages for the fair share of the tenant
+        cost = unfinished_task["to_page"] - unfinished_task["from_page"] if doc["type"] == FileType.PDF.value else 1
+        assert TASK_SCHEDULER.enqueue(
+            priority, chunking_config["tenant_id"], doc["parser_id"], unfinished_task, cost
         ), "Can't access Redis. Please check the Redis' status."
 
 
@@ -405,7 +452,7 @@ def reuse_prev_task_chunks(task: dict, prev_tasks: list[dict], chunking_config:
         Chunks can only be reused if:
         - A previous task exists with matching page range and configuration digest
         - The previous task was completed successfully (progress = 1.0)
-        - The previous task has valid chunk IDs
+        - The previous task has chunks in its ledger, or chunk IDs written by earlier versions
     """
     idx = 0
     while idx < len(prev_tasks):
@@ -418,7 +465,7 @@ def reuse_prev_task_chunks(task: dict, prev_tasks: list[dict], chunking_config:
     if idx >= len(prev_tasks):
         return 0
     prev_task = prev_tasks[idx]
-    if prev_task["progress"] < 1.0 or not prev_task["chunk_ids"]:
+    if prev_task["progress"] < 1.0 or prev_task.get("reused_by") or not (prev_task["chunk_num"] or prev_task["chunk_ids"]):
         return 0
     task["chunk_ids"] = prev_task["chunk_ids"]
     task["progress"] = 1.0
@@ -428,6 +475,6 @@ def reuse_prev_task_chunks(task: dict, prev_tasks: list[dict], chunking_config:
         task["progress_msg"] = ""
     task["progress_msg"] = " ".join(
         [datetime.now().strftime("%H:%M:%S"), task["progress_msg"], "Reused previous task's chunks."])
-    prev_task["chunk_ids"] = ""
+    prev_task["reused_by"] = task["id"]
 
-    return len(task["chunk_ids"].split())
+    return prev_task["chunk_num"] + len(task["chunk_ids"].split())
@@ -49,18 +49,27 @@ stop_event = threading.Event()
 
 RAGFLOW_DEBUGPY_LISTEN = int(os.environ.get('RAGFLOW_DEBUGPY_LISTEN', "0"))
 
+# seconds between syncs of every unfinished document, progress events are handled as they come in between
+DOC_PROGRESS_SWEEP_INTERVAL = int(os.environ.get('DOC_PROGRESS_SWEEP_INTERVAL', "60"))
+
 def update_progress():
     lock_value = str(uuid.uuid4())
     redis_lock = RedisDistributedLock("update_progress", lock_value=lock_value, timeout=60)
     logging.info(f"update_progress lock_value: {lock_value}")
+    last_sweep = 0
     while not stop_event.is_set():
         try:
-            if redis_lock.acquire():
+            if not redis_lock.acquire():
+                stop_event.wait(6)
+                continue
+            if time.time() - last_sweep >= DOC_PROGRESS_SWEEP_INTERVAL:
                 DocumentService.update_progress()
-                redis_lock.release()
-            stop_event.wait(6)
+                last_sweep = time.time()
+            DocumentService.consume_progress_events(timeout=1)
+            redis_lock.release()
         except Exception:
             logging.exception("update_progress exception")
+            stop_event.wait(6)
 
 def signal_handler(sig, frame):
     logging.info("Received interrupt signal, shutting down...")
@@ -11,9 +11,10 @@
 #  limitations under the License.
 #
 
+import csv
 import logging
 import sys
-from io import BytesIO
+from io import BytesIO, TextIOWrapper
 
 import pandas as pd
 from openpyxl import Workbook, load_workbook
@@ -70,58 +71,120 @@ class RAGFlowExcelParser:
 
         return wb
 
+    @staticmethod
+    def _open(fnm):
+        if isinstance(fnm, str):
+            return open(fnm, "rb")
+        if isinstance(fnm, bytes):
+            return BytesIO(fnm)
+        return fnm
+
+    @staticmethod
+    def _text_lines(file_like_object):
+        """Lines of a text file, decoded as they are read."""
+        file_like_object.seek(0)
+        encoding = find_codec(file_like_object.read(4096))
+        file_like_object.seek(0)
+        return TextIOWrapper(file_like_object, encoding=encoding, errors="ignore")
+
+    @staticmethod
+    def _iter_sheets(fnm):
+        """
+        (sheet name, rows) of a workbook or a CSV file, rows being tuples of cell values. Workbooks are
+        opened read-only and rows are parsed as they are iterated, so no sheet is held in memory at once.
+        """
+        file_like_object = RAGFlowExcelParser._open(fnm)
+        try:
+            file_like_object.seek(0)
+            file_head = file_like_object.read(4)
+            file_like_object.seek(0)
+
+            if not (file_head.startswith(b'PK\x03\x04') or file_head.startswith(b'\xD0\xCF\x11\xE0')):
+                # blank lines are skipped like pandas does
+                yield "Data", (r for r in csv.reader(RAGFlowExcelParser._text_lines(file_like_object)) if r)
+                return
+
+            try:
+                wb = load_workbook(file_like_object, read_only=True, data_only=True)
+            except Exception as e:
+                # xls and files openpyxl can't read, loaded whole by pandas
+                logging.info(f"openpyxl load error: {e}, try pandas instead")
+                try:
+                    file_like_object.seek(0)
+                    df = pd.read_excel(file_like_object)
+                except Exception as e_pandas:
+                    raise Exception(f"pandas.read_excel error: {e_pandas}, original openpyxl error: {e}")
+                yield "Data", iter([tuple(df.columns)] + [tuple(r) for r in df.values])
+                return
+            try:
+                for ws in wb.worksheets:
+                    if ws.max_column is None:
+                        # without a recorded dimension rows end at their last cell, it's measured by a pass
+                        # over the sheet so that rows are padded to the same width as those of other sheets
+                        ws.reset_dimensions()
+                        try:
+                            ws.calculate_dimension(force=True)
+                        except Exception as e:
+                            logging.info(f"Sheet {ws.title} is empty: {e}")
+                            continue
+                    yield ws.title, ws.iter_rows(values_only=True)
+            finally:
+                wb.close()
+        finally:
+            if isinstance(fnm, str):
+                file_like_object.close()
+
     def html(self, fnm, chunk_rows=256):
-        file_like_object = BytesIO(fnm) if not isinstance(fnm, str) else fnm
-        wb = RAGFlowExcelParser._load_excel_to_workbook(file_like_object)
         tb_chunks = []
-        for sheetname in wb.sheetnames:
-            ws = wb[sheetname]
-            rows = list(ws.rows)
-            if not rows:
+        for sheetname, rows in RAGFlowExcelParser._iter_sheets(fnm):
+            head = next(rows, None)
+            if head is None:
                 continue
 
             tb_rows_0 = "<tr>"
-            for t in list(rows[0]):
-                tb_rows_0 += f"<th>{t.value}</th>"
+            for t in head:
+                tb_rows_0 += f"<th>{t}</th>"
             tb_rows_0 += "</tr>"
 
-            for chunk_i in range((len(rows) - 1) // chunk_rows + 1):
-                tb = ""
-                tb += f"<table><caption>{sheetname}</caption>"
-                tb += tb_rows_0
-                for r in list(
-                    rows[1 + chunk_i * chunk_rows: 1 + (chunk_i + 1) * chunk_rows]
-                ):
-                    tb += "<tr>"
-                    for i, c in enumerate(r):
-                        if c.value is None:
-                            tb += "<td></td>"
-                        else:
-                            tb += f"<td>{c.value}</td>"
-                    tb += "</tr>"
-                tb += "</table>\n"
-                tb_chunks.append(tb)
+            batch = []
+            for r in rows:
+                batch.append(r)
+                if len(batch) == chunk_rows:
+                    tb_chunks.append(self._html_table(sheetname, tb_rows_0, batch))
+                    batch = []
+            tb_chunks.append(self._html_table(sheetname, tb_rows_0, batch))
 
         return tb_chunks
 
-    def __call__(self, fnm):
-        file_like_object = BytesIO(fnm) if not isinstance(fnm, str) else fnm
-        wb = RAGFlowExcelParser._load_excel_to_workbook(file_like_object)
+    @staticmethod
+    def _html_table(sheetname, tb_rows_0, rows):
+        tb = ""
+        tb += f"<table><caption>{sheetname}</caption>"
+        tb += tb_rows_0
+        for r in rows:
+            tb += "<tr>"
+            for c in r:
+                if c is None:
+                    tb += "<td></td>"
+                else:
+                    tb += f"<td>{c}</td>"
+            tb += "</tr>"
+        tb += "</table>\n"
+        return tb
 
+    def __call__(self, fnm):
         res = []
-        for sheetname in wb.sheetnames:
-            ws = wb[sheetname]
-            rows = list(ws.rows)
-            if not rows:
+        for sheetname, rows in RAGFlowExcelParser._iter_sheets(fnm):
+            ti = next(rows, None)
+            if ti is None:
                 continue
-            ti = list(rows[0])
-            for r in list(rows[1:]):
+            for r in rows:
                 fields = []
                 for i, c in enumerate(r):
-                    if not c.value:
+                    if not c:
                         continue
-                    t = str(ti[i].value) if i < len(ti) else ""
-                    t += ("：" if t else "") + str(c.value)
+                    t = str(ti[i]) if i < len(ti) else ""
+                    t += ("：" if t else "") + str(c)
                     fields.append(t)
                 line = "; ".join(fields)
                 if sheetname.lower().find("sheet") < 0:
@@ -132,11 +195,9 @@ class RAGFlowExcelParser:
     @staticmethod
     def row_number(fnm, binary):
         if fnm.split(".")[-1].lower().find("xls") >= 0:
-            wb = RAGFlowExcelParser._load_excel_to_workbook(BytesIO(binary))
             total = 0
-            for sheetname in wb.sheetnames:
-                ws = wb[sheetname]
-                total += len(list(ws.rows))
+            for _, rows in RAGFlowExcelParser._iter_sheets(binary):
+                total += sum(1 for _ in rows)
             return total
 
         if fnm.split(".")[-1].lower() in ["csv", "txt"]:
@@ -20,6 +20,8 @@ import random
 import re
 import sys
 import threading
+import zlib
+from collections import OrderedDict
 from copy import deepcopy
 from io import BytesIO
 from timeit import default_timer as timer
@@ -39,11 +41,60 @@ from rag.app.picture import vision_llm_chunk as picture_vision_llm_chunk
 from rag.nlp import rag_tokenizer
 from rag.prompts import vision_llm_describe_prompt
 from rag.settings import PARALLEL_DEVICES
+from rag.utils.page_cache import PAGE_ANALYSIS_CACHE
 
 LOCK_KEY_pdfplumber = "global_shared_lock_pdfplumber"
 if LOCK_KEY_pdfplumber not in sys.modules:
     sys.modules[LOCK_KEY_pdfplumber] = threading.Lock()
 
+# pages rendered ahead of the OCR
+PDF_RASTER_WINDOW = int(os.environ.get("PDF_RASTER_WINDOW", "4"))
+# rendered pages kept decoded, the others are kept compressed until they are used again
+PDF_PAGE_CACHE = int(os.environ.get("PDF_PAGE_CACHE", "32"))
+
+
+class PageImages:
+    """
+    The rendered pages, indexed like a list. Only the PDF_PAGE_CACHE most recently used ones are
+    kept as images, so memory doesn't grow with the page count once the OCR is done with a page.
+    """
+
+    def __init__(self, cache_size=PDF_PAGE_CACHE):
+        self.cache_size = max(1, cache_size)
+        self.pages = []
+        self.decoded = OrderedDict()
+
+    def __len__(self):
+        return len(self.pages)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if i in self.decoded:
+            self.decoded.move_to_end(i)
+            return self.decoded[i]
+        mode, size, data = self.pages[i]
+        img = Image.frombytes(mode, size, zlib.decompress(data))
+        self._cache(i, img)
+        return img
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def append(self, img):
+        self.pages.append(None)
+        self._cache(len(self.pages) - 1, img)
+
+    def _cache(self, i, img):
+        self.decoded[i] = img
+        while len(self.decoded) > self.cache_size:
+            j, evicted = self.decoded.popitem(last=False)
+            if self.pages[j] is None:
+                self.pages[j] = (evicted.mode, evicted.size, zlib.compress(evicted.tobytes(), 1))
+
 
 class RAGFlowPdfParser:
     def __init__(self, **kwargs):
@@ -300,7 +351,6 @@ class RAGFlowPdfParser:
 
         start = timer()
         if not bxs:
-            self.boxes.append([])
             return
         bxs = [(line[0], line[1][0]) for line in bxs]
         bxs = Recognizer.sort_Y_firstly(
@@ -308,7 +358,7 @@ class RAGFlowPdfParser:
               "top": b[0][1] / ZM, "text": "", "txt": t,
               "bottom": b[-1][1] / ZM,
               "page_number": pagenum} for b, t in bxs if b[0][0] <= b[1][0] and b[0][1] <= b[-1][1]],
-            self.mean_height[-1] / 3
+            self.mean_height[pagenum - 1] / 3
         )
 
         # merge chars in the same rect
@@ -346,10 +396,26 @@ class RAGFlowPdfParser:
             del boxes_to_reg[i]["box_image"]
         logging.info(f"__ocr recognize {len(bxs)} boxes cost {timer() - start}s")
         bxs = [b for b in bxs if b["text"]]
-        if self.mean_height[-1] == 0:
-            self.mean_height[-1] = np.median([b["bottom"] - b["top"]
-                                              for b in bxs])
-        self.boxes.append(bxs)
+        if self.mean_height[pagenum - 1] == 0:
+            self.mean_height[pagenum - 1] = np.median([b["bottom"] - b["top"]
+                                                       for b in bxs])
+        self.boxes[pagenum - 1] = bxs
+
+    def __cached_ocr(self, pagenum, img, chars, ZM=3, device_id: int | None = None):
+        """__ocr, unless the page was recognized before with the same image, text layer and models."""
+        if not PAGE_ANALYSIS_CACHE.enabled:
+            return self.__ocr(pagenum, img, chars, ZM, device_id)
+        key = PAGE_ANALYSIS_CACHE.key("ocr", self.ocr.version, img, ZM,
+                                      [(c["text"], c["x0"], c["x1"], c["top"], c["bottom"]) for c in chars])
+        cached = PAGE_ANALYSIS_CACHE.get(key)
+        if cached is not None:
+            for b in cached["boxes"]:
+                b["page_number"] = pagenum
+            self.boxes[pagenum - 1] = cached["boxes"]
+            self.mean_height[pagenum - 1] = cached["mean_height"]
+            return
+        self.__ocr(pagenum, img, chars, ZM, device_id)
+        PAGE_ANALYSIS_CACHE.set(key, {"boxes": self.boxes[pagenum - 1], "mean_height": self.mean_height[pagenum - 1]})
 
     def _layouts_rec(self, ZM, drop=True):
         assert len(self.page_images) == len(self.boxes)
@@ -996,27 +1062,27 @@ class RAGFlowPdfParser:
         self.lefted_chars = []
         self.mean_height = []
         self.mean_width = []
-        self.boxes = []
         self.garbages = {}
         self.page_cum_height = [0]
         self.page_layout = []
         self.page_from = page_from
+        self.page_images = PageImages()
         start = timer()
+        pdf = None
         try:
             with sys.modules[LOCK_KEY_pdfplumber]:
-                self.pdf = pdfplumber.open(fnm) if isinstance(
+                pdf = pdfplumber.open(fnm) if isinstance(
                     fnm, str) else pdfplumber.open(BytesIO(fnm))
-                self.page_images = [p.to_image(resolution=72 * zoomin).annotated for i, p in
-                                    enumerate(self.pdf.pages[page_from:page_to])]
                 try:
-                    self.page_chars = [[c for c in page.dedupe_chars().chars if self._has_color(c)] for page in self.pdf.pages[page_from:page_to]]
+                    self.page_chars = [[c for c in page.dedupe_chars().chars if self._has_color(c)] for page in pdf.pages[page_from:page_to]]
                 except Exception as e:
                     logging.warning(f"Failed to extract characters for pages {page_from}-{page_to}: {str(e)}")
-                    self.page_chars = [[] for _ in range(page_to - page_from)]  # If failed to extract, using empty list instead.
+                    self.page_chars = [[] for _ in range(len(pdf.pages[page_from:page_to]))]  # If failed to extract, using empty list instead.
 
-                self.total_page = len(self.pdf.pages)
+                self.total_page = len(pdf.pages)
         except Exception:
             logging.exception("RAGFlowPdfParser __images__")
+            self.page_chars = []
         logging.info(f"__images__ dedupe_chars cost {timer() - start}s")
 
         self.outlines = []
@@ -1039,17 +1105,32 @@ class RAGFlowPdfParser:
         if not self.outlines:
             logging.warning("Miss outlines")
 
-        logging.debug("Images converted.")
         self.is_english = [re.search(r"[a-zA-Z0-9,/¸;:'\[\]\(\)!@#$%^&*\"?<>._-]{30,}", "".join(
             random.choices([c["text"] for c in self.page_chars[i]], k=min(100, len(self.page_chars[i]))))) for i in
             range(len(self.page_chars))]
         if sum([1 if e else 0 for e in self.is_english]) > len(
-                self.page_images) / 2:
+                self.page_chars) / 2:
             self.is_english = True
         else:
             self.is_english = False
 
-        async def __img_ocr(i, id, img, chars, limiter):
+        page_count = len(self.page_chars)
+        self.boxes = [[] for _ in range(page_count)]
+
+        def __render(i):
+            # the lock is only held for a page, so other documents get rendered in between
+            with sys.modules[LOCK_KEY_pdfplumber]:
+                img = pdf.pages[page_from + i].to_image(resolution=72 * zoomin).annotated
+            self.page_images.append(img)
+            return img
+
+        async def __img_renderer(send_channel):
+            async with send_channel:
+                for i in range(page_count):
+                    img = await trio.to_thread.run_sync(__render, i)
+                    await send_channel.send((i, img))
+
+        async def __img_ocr(i, id, img, chars, limiter, window):
             j = 0
             while j + 1 < len(chars):
                 if chars[j]["text"] and chars[j + 1]["text"] \
@@ -1059,17 +1140,20 @@ class RAGFlowPdfParser:
                     chars[j]["text"] += " "
                 j += 1
 
-            if limiter:
-                async with limiter:
-                    await trio.to_thread.run_sync(lambda: self.__ocr(i + 1, img, chars, zoomin, id))
-            else:
-                self.__ocr(i + 1, img, chars, zoomin, id)
+            try:
+                if limiter:
+                    async with limiter:
+                        await trio.to_thread.run_sync(lambda: self.__cached_ocr(i + 1, img, chars, zoomin, id))
+                else:
+                    await trio.to_thread.run_sync(lambda: self.__cached_ocr(i + 1, img, chars, zoomin, id))
+            finally:
+                window.release()
 
             if callback and i % 6 == 5:
-                callback(prog=(i + 1) * 0.6 / len(self.page_images), msg="")
+                callback(prog=(i + 1) * 0.6 / page_count, msg="")
 
         async def __img_ocr_launcher():
-            def __ocr_preprocess():
+            def __ocr_preprocess(i, img):
                 chars = self.page_chars[i] if not self.is_english else []
                 self.mean_height.append(
                     np.median(sorted([c["height"] for c in chars])) if chars else 0
@@ -1080,22 +1164,29 @@ class RAGFlowPdfParser:
                 self.page_cum_height.append(img.size[1] / zoomin)
                 return chars
 
-            if self.parallel_limiter:
-                async with trio.open_nursery() as nursery:
-                    for i, img in enumerate(self.page_images):
-                        chars = __ocr_preprocess()
-
-                        nursery.start_soon(__img_ocr, i, i % PARALLEL_DEVICES, img, chars,
-                                           self.parallel_limiter[i % PARALLEL_DEVICES])
-                        await trio.sleep(0.1)
-            else:
-                for i, img in enumerate(self.page_images):
-                    chars = __ocr_preprocess()
-                    await __img_ocr(i, 0, img, chars, None)
+            # pages in the OCR at once, the channel holds the ones rendered ahead of it.
+            # Their text lines are recognized in shared batches.
+            window = trio.Semaphore(max(1, PDF_RASTER_WINDOW, PARALLEL_DEVICES or 1))
+            send_channel, receive_channel = trio.open_memory_channel(max(0, PDF_RASTER_WINDOW - 1))
+            async with trio.open_nursery() as nursery:
+                nursery.start_soon(__img_renderer, send_channel)
+                async with receive_channel:
+                    async for i, img in receive_channel:
+                        chars = __ocr_preprocess(i, img)
+                        await window.acquire()
+                        if self.parallel_limiter:
+                            nursery.start_soon(__img_ocr, i, i % PARALLEL_DEVICES, img, chars,
+                                               self.parallel_limiter[i % PARALLEL_DEVICES], window)
+                        else:
+                            nursery.start_soon(__img_ocr, i, 0, img, chars, None, window)
 
         start = timer()
 
-        trio.run(__img_ocr_launcher)
+        try:
+            trio.run(__img_ocr_launcher)
+        finally:
+            if pdf is not None:
+                pdf.close()
 
         logging.info(f"__images__ {len(self.page_images)} pages cost {timer() - start}s")
 
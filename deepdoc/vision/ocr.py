@@ -16,6 +16,8 @@
 
 import logging
 import copy
+from collections import deque
+import threading
 import time
 import os
 
@@ -29,10 +31,18 @@ import math
 import numpy as np
 import cv2
 import onnxruntime as ort
+import xxhash
 
 from .postprocess import build_post_process
 
 loaded_models = {}
+load_model_lock = threading.Lock()
+rec_batchers = {}
+
+# text lines recognized in one run, gathered across pages and documents
+OCR_REC_BATCH_SIZE = int(os.environ.get("OCR_REC_BATCH_SIZE", "32"))
+# milliseconds text lines wait for the ones of other pages before their batch runs anyway
+OCR_REC_BATCH_WAIT = int(os.environ.get("OCR_REC_BATCH_WAIT", "20"))
 
 def transform(data, ops=None):
     """ transform """
@@ -67,62 +77,148 @@ def create_operators(op_param_list, global_config=None):
     return ops
 
 
+# threads of each onnxruntime session, 0 lets onnxruntime use all the cores.
+# Keep sessions * intra-op threads * task executors within the cores of the host.
+ONNX_INTRA_OP_THREADS = int(os.environ.get("ONNX_INTRA_OP_THREADS", "2"))
+ONNX_INTER_OP_THREADS = int(os.environ.get("ONNX_INTER_OP_THREADS", "2"))
+# inter-op threads only run independent nodes in parallel in this mode
+ONNX_PARALLEL_EXECUTION = int(os.environ.get("ONNX_PARALLEL_EXECUTION", "0"))
+# disable, basic, extended or all
+ONNX_GRAPH_OPTIMIZATION = os.environ.get("ONNX_GRAPH_OPTIMIZATION", "all")
+ONNX_CPU_MEM_ARENA = int(os.environ.get("ONNX_CPU_MEM_ARENA", "0"))
+# sessions per model and device, each run goes to the least busy one
+ONNX_SESSION_POOL_SIZE = int(os.environ.get("ONNX_SESSION_POOL_SIZE", "1"))
+# latencies kept per model for the percentiles of model_stats()
+ONNX_STATS_WINDOW = 1024
+
+
+class SessionPool:
+    """
+    The onnxruntime sessions of a model on a device, shared by every parser of the process.
+    Behaves like an InferenceSession, and records the latency of the runs.
+    """
+
+    def __init__(self, name, sessions, version=""):
+        self.name = name
+        self.sessions = sessions
+        # hash of the model file, results computed by another model aren't reused
+        self.version = version
+        self.busy = [0] * len(sessions)
+        self.lock = threading.Lock()
+        self.runs = 0
+        self.total = 0.0
+        self.slowest = 0.0
+        self.latencies = deque(maxlen=ONNX_STATS_WINDOW)
+
+    def get_inputs(self):
+        return self.sessions[0].get_inputs()
+
+    def get_outputs(self):
+        return self.sessions[0].get_outputs()
+
+    def run(self, output_names, input_feed, run_options=None):
+        with self.lock:
+            i = self.busy.index(min(self.busy))
+            self.busy[i] += 1
+        start = time.perf_counter()
+        try:
+            return self.sessions[i].run(output_names, input_feed, run_options)
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.busy[i] -= 1
+                self.runs += 1
+                self.total += elapsed
+                self.slowest = max(self.slowest, elapsed)
+                self.latencies.append(elapsed)
+
+    def stats(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            runs, total, slowest = self.runs, self.total, self.slowest
+        if not runs:
+            return {"runs": 0}
+        return {
+            "runs": runs,
+            "sessions": len(self.sessions),
+            "avg_ms": round(total / runs * 1000, 2),
+            "p50_ms": round(latencies[len(latencies) // 2] * 1000, 2),
+            "p95_ms": round(latencies[int(len(latencies) * 0.95)] * 1000, 2),
+            "max_ms": round(slowest * 1000, 2),
+        }
+
+
+def model_stats():
+    """Latency of the models loaded by this process, keyed by model file and device."""
+    return {tag: sess.stats() for tag, (sess, _) in list(loaded_models.items())}
+
+
 def load_model(model_dir, nm, device_id: int | None = None):
     model_file_path = os.path.join(model_dir, nm + ".onnx")
     model_cached_tag = model_file_path + str(device_id) if device_id is not None else model_file_path
 
     global loaded_models
-    loaded_model = loaded_models.get(model_cached_tag)
-    if loaded_model:
-        logging.info(f"load_model {model_file_path} reuses cached model")
-        return loaded_model
-
-    if not os.path.exists(model_file_path):
-        raise ValueError("not find model file path {}".format(
-            model_file_path))
-
-    def cuda_is_available():
-        try:
-            import torch
-            if torch.cuda.is_available() and torch.cuda.device_count() > device_id:
-                return True
-        except Exception:
+    # parsers created concurrently load a model once
+    with load_model_lock:
+        loaded_model = loaded_models.get(model_cached_tag)
+        if loaded_model:
+            logging.info(f"load_model {model_file_path} reuses cached model")
+            return loaded_model
+
+        if not os.path.exists(model_file_path):
+            raise ValueError("not find model file path {}".format(
+                model_file_path))
+
+        def cuda_is_available():
+            try:
+                import torch
+                if torch.cuda.is_available() and torch.cuda.device_count() > device_id:
+                    return True
+            except Exception:
+                return False
             return False
-        return False
-
-    options = ort.SessionOptions()
-    options.enable_cpu_mem_arena = False
-    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
-    options.intra_op_num_threads = 2
-    options.inter_op_num_threads = 2
-
-    # https://github.com/microsoft/onnxruntime/issues/9509#issuecomment-951546580
-    # Shrink GPU memory after execution
-    run_options = ort.RunOptions()
-    if cuda_is_available():
-        cuda_provider_options = {
-            "device_id": device_id, # Use specific GPU
-            "gpu_mem_limit": 512 * 1024 * 1024, # Limit gpu memory
-            "arena_extend_strategy": "kNextPowerOfTwo",  # gpu memory allocation strategy
-        }
-        sess = ort.InferenceSession(
-            model_file_path,
-            options=options,
-            providers=['CUDAExecutionProvider'],
-            provider_options=[cuda_provider_options]
-            )
-        run_options.add_run_config_entry("memory.enable_memory_arena_shrinkage", "gpu:" + str(device_id))
-        logging.info(f"load_model {model_file_path} uses GPU")
-    else:
-        sess = ort.InferenceSession(
-            model_file_path,
-            options=options,
-            providers=['CPUExecutionProvider'])
-        run_options.add_run_config_entry("memory.enable_memory_arena_shrinkage", "cpu")
-        logging.info(f"load_model {model_file_path} uses CPU")
-    loaded_model = (sess, run_options)
-    loaded_models[model_cached_tag] = loaded_model
-    return loaded_model
+
+        options = ort.SessionOptions()
+        options.enable_cpu_mem_arena = bool(ONNX_CPU_MEM_ARENA)
+        options.execution_mode = ort.ExecutionMode.ORT_PARALLEL if ONNX_PARALLEL_EXECUTION else ort.ExecutionMode.ORT_SEQUENTIAL
+        options.intra_op_num_threads = ONNX_INTRA_OP_THREADS
+        options.inter_op_num_threads = ONNX_INTER_OP_THREADS
+        options.graph_optimization_level = {
+            "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+            "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+            "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+        }.get(ONNX_GRAPH_OPTIMIZATION.lower(), ort.GraphOptimizationLevel.ORT_ENABLE_ALL)
+
+        # https://github.com/microsoft/onnxruntime/issues/9509#issuecomment-951546580
+        # Shrink GPU memory after execution
+        run_options = ort.RunOptions()
+        if cuda_is_available():
+            cuda_provider_options = {
+                "device_id": device_id, # Use specific GPU
+                "gpu_mem_limit": 512 * 1024 * 1024, # Limit gpu memory
+                "arena_extend_strategy": "kNextPowerOfTwo",  # gpu memory allocation strategy
+            }
+            sessions = [ort.InferenceSession(
+                model_file_path,
+                options,
+                providers=['CUDAExecutionProvider'],
+                provider_options=[cuda_provider_options]
+                ) for _ in range(max(1, ONNX_SESSION_POOL_SIZE))]
+            run_options.add_run_config_entry("memory.enable_memory_arena_shrinkage", "gpu:" + str(device_id))
+            logging.info(f"load_model {model_file_path} uses GPU")
+        else:
+            sessions = [ort.InferenceSession(
+                model_file_path,
+                options,
+                providers=['CPUExecutionProvider']) for _ in range(max(1, ONNX_SESSION_POOL_SIZE))]
+            if ONNX_CPU_MEM_ARENA:
+                run_options.add_run_config_entry("memory.enable_memory_arena_shrinkage", "cpu:0")
+            logging.info(f"load_model {model_file_path} uses CPU")
+        with open(model_file_path, "rb") as f:
+            version = xxhash.xxh64(f.read()).hexdigest()
+        loaded_model = (SessionPool(model_cached_tag, sessions, version), run_options)
+        loaded_models[model_cached_tag] = loaded_model
+        return loaded_model
 
 
 class TextRecognizer:
@@ -137,6 +233,8 @@ class TextRecognizer:
         self.postprocess_op = build_post_process(postprocess_params)
         self.predictor, self.run_options = load_model(model_dir, 'rec', device_id)
         self.input_tensor = self.predictor.get_inputs()[0]
+        # one batcher per loaded model, shared by all the OCR instances using it
+        self.batcher = rec_batchers.setdefault(id(self.predictor), RecognitionBatcher(self))
 
     def resize_norm_img(self, img, max_wh_ratio):
         imgC, imgH, imgW = self.rec_image_shape
@@ -362,39 +460,142 @@ class TextRecognizer:
 
         for beg_img_no in range(0, img_num, batch_num):
             end_img_no = min(img_num, beg_img_no + batch_num)
-            norm_img_batch = []
-            imgC, imgH, imgW = self.rec_image_shape[:3]
-            max_wh_ratio = imgW / imgH
-            # max_wh_ratio = 0
-            for ino in range(beg_img_no, end_img_no):
-                h, w = img_list[indices[ino]].shape[0:2]
-                wh_ratio = w * 1.0 / h
-                max_wh_ratio = max(max_wh_ratio, wh_ratio)
-            for ino in range(beg_img_no, end_img_no):
-                norm_img = self.resize_norm_img(img_list[indices[ino]],
-                                                max_wh_ratio)
-                norm_img = norm_img[np.newaxis, :]
-                norm_img_batch.append(norm_img)
-            norm_img_batch = np.concatenate(norm_img_batch)
-            norm_img_batch = norm_img_batch.copy()
-
-            input_dict = {}
-            input_dict[self.input_tensor.name] = norm_img_batch
-            for i in range(100000):
-                try:
-                    outputs = self.predictor.run(None, input_dict, self.run_options)
-                    break
-                except Exception as e:
-                    if i >= 3:
-                        raise e
-                    time.sleep(5)
-            preds = outputs[0]
-            rec_result = self.postprocess_op(preds)
+            rec_result = self.recognize_sorted([img_list[indices[ino]] for ino in range(beg_img_no, end_img_no)])
             for rno in range(len(rec_result)):
                 rec_res[indices[beg_img_no + rno]] = rec_result[rno]
 
         return rec_res, time.time() - st
 
+    def width_bucket(self, img):
+        """Batches are padded to their widest line, so lines are batched with the ones of about the same width."""
+        _, imgH, imgW = self.rec_image_shape[:3]
+        w = math.ceil(imgH * img.shape[1] / float(img.shape[0]))
+        return max(0, math.ceil(math.log2(w / imgW))) if w > imgW else 0
+
+    def recognize_sorted(self, img_list):
+        """Recognize a batch of text lines in one run, padded to the widest of them."""
+        norm_img_batch = []
+        imgC, imgH, imgW = self.rec_image_shape[:3]
+        max_wh_ratio = imgW / imgH
+        # max_wh_ratio = 0
+        for img in img_list:
+            h, w = img.shape[0:2]
+            wh_ratio = w * 1.0 / h
+            max_wh_ratio = max(max_wh_ratio, wh_ratio)
+        for img in img_list:
+            norm_img = self.resize_norm_img(img, max_wh_ratio)
+            norm_img = norm_img[np.newaxis, :]
+            norm_img_batch.append(norm_img)
+        norm_img_batch = np.concatenate(norm_img_batch)
+        norm_img_batch = norm_img_batch.copy()
+
+        input_dict = {}
+        input_dict[self.input_tensor.name] = norm_img_batch
+        for i in range(100000):
+            try:
+                outputs = self.predictor.run(None, input_dict, self.run_options)
+                break
+            except Exception as e:
+                if i >= 3:
+                    raise e
+                time.sleep(5)
+        preds = outputs[0]
+        return self.postprocess_op(preds)
+
+
+class RecognitionBatcher:
+    """
+    Recognizes the text lines submitted by concurrent callers, e.g. the pages of documents being parsed,
+    in shared batches. Pending lines are grouped by TextRecognizer.width_bucket and run OCR_REC_BATCH_SIZE
+    at a time, so the batches are full and little of them is padding.
+    """
+
+    def __init__(self, recognizer: TextRecognizer):
+        self.recognizer = recognizer
+        self.cond = threading.Condition()
+        self.pending = []
+        self.worker = None
+
+    def __call__(self, img_list):
+        req = {"res": [['', 0.0]] * len(img_list), "error": None, "left": len(img_list), "finished": set(), "done": threading.Event()}
+        if not img_list:
+            return req["res"]
+        with self.cond:
+            self.pending.extend((img, req, i) for i, img in enumerate(img_list))
+            self.cond.notify()
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self._run, daemon=True)
+                self.worker.start()
+        req["done"].wait()
+        if req["error"]:
+            raise req["error"]
+        return req["res"]
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                # give the other pages a moment to add theirs unless a batch is full already
+                deadline = time.monotonic() + OCR_REC_BATCH_WAIT / 1000
+                while len(self.pending) < OCR_REC_BATCH_SIZE and (left := deadline - time.monotonic()) > 0:
+                    self.cond.wait(left)
+                items, self.pending = self.pending, []
+
+            try:
+                buckets = {}
+                for it in items:
+                    try:
+                        bucket = self.recognizer.width_bucket(it[0])
+                    except Exception as e:
+                        self._finish(it, error=e)
+                        continue
+                    buckets.setdefault(bucket, []).append(it)
+                for bucket in buckets.values():
+                    bucket.sort(key=lambda it: it[0].shape[1] / float(it[0].shape[0]))
+                    for b in range(0, len(bucket), OCR_REC_BATCH_SIZE):
+                        self._recognize(bucket[b:b + OCR_REC_BATCH_SIZE])
+            except Exception as e:
+                # nobody may be left waiting on a line
+                logging.exception("RecognitionBatcher")
+                for it in items:
+                    self._finish(it, error=e)
+
+    def _recognize(self, batch):
+        try:
+            rec_result = self.recognizer.recognize_sorted([img for img, _, _ in batch])
+        except Exception as e:
+            reqs = list(dict.fromkeys(id(req) for _, req, _ in batch))
+            if len(reqs) == 1:
+                logging.exception("RecognitionBatcher")
+                for it in batch:
+                    self._finish(it, error=e)
+                return
+            # the lines of each caller are recognized apart, so that only the callers of bad lines fail
+            logging.warning(f"RecognitionBatcher batch of {len(reqs)} callers failed, retrying them one by one: {e}")
+            for r in reqs:
+                self._recognize([it for it in batch if id(it[1]) == r])
+            return
+        for rno, it in enumerate(batch):
+            if rno < len(rec_result):
+                self._finish(it, rec_result[rno])
+            else:
+                self._finish(it, error=RuntimeError(f"{len(rec_result)} lines were recognized out of {len(batch)}."))
+
+    @staticmethod
+    def _finish(item, res=None, error=None):
+        _, req, i = item
+        if i in req["finished"]:
+            return
+        req["finished"].add(i)
+        if error is not None:
+            req["error"] = error
+        elif res is not None:
+            req["res"][i] = res
+        req["left"] -= 1
+        if req["left"] == 0:
+            req["done"].set()
+
 
 class TextDetector:
     def __init__(self, model_dir, device_id: int | None = None):
@@ -558,6 +759,11 @@ class OCR:
         self.drop_score = 0.5
         self.crop_image_res_index = 0
 
+    @property
+    def version(self):
+        """Models and settings the results depend on."""
+        return "{}-{}-{}".format(self.text_detector[0].predictor.version, self.text_recognizer[0].predictor.version, self.drop_score)
+
     def get_rotate_crop_image(self, img, points):
         '''
         img_height, img_width = img.shape[0:2]
@@ -651,7 +857,7 @@ class OCR:
     def recognize_batch(self, img_list, device_id: int | None = None):
         if device_id is None:
             device_id = 0
-        rec_res, elapse = self.text_recognizer[device_id](img_list)
+        rec_res = self.text_recognizer[device_id].batcher(img_list)
         texts = []
         for i in range(len(rec_res)):
             text, score = rec_res[i]
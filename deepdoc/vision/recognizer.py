@@ -23,6 +23,7 @@ from functools import cmp_to_key
 
 
 from api.utils.file_utils import get_project_base_directory
+from rag.utils.page_cache import PAGE_ANALYSIS_CACHE
 from .operators import *  # noqa: F403
 from .operators import preprocess
 from . import operators
@@ -407,24 +408,27 @@ class Recognizer:
         } for i in indices]
 
     def __call__(self, image_list, thr=0.7, batch_size=16):
-        res = []
-        imgs = []
-        for i in range(len(image_list)):
-            if not isinstance(image_list[i], np.ndarray):
-                imgs.append(np.array(image_list[i]))
-            else:
-                imgs.append(image_list[i])
-
-        batch_loop_cnt = math.ceil(float(len(imgs)) / batch_size)
+        res = [None] * len(image_list)
+        keys = [None] * len(image_list)
+        if PAGE_ANALYSIS_CACHE.enabled:
+            for i, img in enumerate(image_list):
+                keys[i] = PAGE_ANALYSIS_CACHE.key(self.__class__.__name__, self.ort_sess.version, img, thr)
+                res[i] = PAGE_ANALYSIS_CACHE.get(keys[i])
+        todo = [i for i, bb in enumerate(res) if bb is None]
+
+        batch_loop_cnt = math.ceil(float(len(todo)) / batch_size)
         for i in range(batch_loop_cnt):
             start_index = i * batch_size
-            end_index = min((i + 1) * batch_size, len(imgs))
-            batch_image_list = imgs[start_index:end_index]
+            end_index = min((i + 1) * batch_size, len(todo))
+            # converted a batch at a time, so only a batch of pages is held as arrays
+            batch_image_list = [image_list[j] if isinstance(image_list[j], np.ndarray) else np.array(image_list[j]) for j in todo[start_index:end_index]]
             inputs = self.preprocess(batch_image_list)
             logging.debug("preprocess")
-            for ins in inputs:
+            for j, ins in zip(todo[start_index:end_index], inputs):
                 bb = self.postprocess(self.ort_sess.run(None, {k:v for k,v in ins.items() if k in self.input_names}, self.run_options)[0], ins, thr)
-                res.append(bb)
+                res[j] = bb
+                if keys[j]:
+                    PAGE_ANALYSIS_CACHE.set(keys[j], bb)
 
         #seeit.save_results(image_list, res, self.label_list, threshold=thr)
 
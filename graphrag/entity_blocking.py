@@ -0,0 +1,125 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+Candidate blocking for entity resolution, so that only names likely to be the same entity get compared.
+
+English names are shingled into character trigrams and summarized by MinHash signatures. Names
+agreeing on every row of some LSH band share a bucket, and pairs sharing a bucket are candidates:
+with the default 20 bands of 3 rows that's over 99% of pairs with a Jaccard similarity of 0.6, and
+about 15% of those at 0.2. Other names, CJK ones mostly, are short and taken for similar as soon as
+they share two characters, which no Jaccard threshold captures, so those pairs are found exactly
+through the names each character appears in. Optionally the nearest names by embedding join them,
+which catches translations and abbreviations that have few n-grams in common.
+"""
+import os
+import re
+from collections import Counter, defaultdict
+
+import numpy as np
+import trio
+import xxhash
+
+from rag.nlp import is_english
+
+ENTITY_LSH_BANDS = int(os.environ.get("ENTITY_LSH_BANDS", "20"))
+ENTITY_LSH_ROWS = int(os.environ.get("ENTITY_LSH_ROWS", "3"))
+# nearest names by embedding taken as candidates too, 0 disables it
+ENTITY_EMBEDDING_TOPK = int(os.environ.get("ENTITY_EMBEDDING_TOPK", "0"))
+ENTITY_EMBEDDING_SIMILARITY = float(os.environ.get("ENTITY_EMBEDDING_SIMILARITY", "0.9"))
+
+MINHASH_PRIME = 4294967291
+_rng = np.random.RandomState(20250101)
+MINHASH_A = _rng.randint(1, MINHASH_PRIME, size=ENTITY_LSH_BANDS * ENTITY_LSH_ROWS, dtype=np.uint64)
+MINHASH_B = _rng.randint(0, MINHASH_PRIME, size=ENTITY_LSH_BANDS * ENTITY_LSH_ROWS, dtype=np.uint64)
+
+
+def shingles(name: str) -> set[str]:
+    name = re.sub(r"[\W_]+", " ", name.lower()).strip()
+    if len(name) <= 3:
+        return {name}
+    return {name[i:i + 3] for i in range(len(name) - 2)}
+
+
+def minhash(name: str) -> np.ndarray:
+    hv = np.array([xxhash.xxh32_intdigest(s.encode("utf-8")) for s in shingles(name)], dtype=np.uint64)
+    return ((np.outer(hv, MINHASH_A) + MINHASH_B) % MINHASH_PRIME).min(axis=0)
+
+
+def blocking_candidates(names: list[str], queries: set[str]) -> set[tuple[str, str]]:
+    """Pairs of `names`, ordered, with at least one of them in `queries`, that are worth comparing."""
+    english = {n for n in names if is_english(n)}
+    return lsh_candidates([n for n in names if n in english], queries & english) | \
+        shared_chars_candidates(names, queries, english)
+
+
+def shared_chars_candidates(names: list[str], queries: set[str], english: set[str]) -> set[tuple[str, str]]:
+    """Pairs of `names`, ordered, with at least one of them in `queries` and not both `english`, sharing two characters."""
+    postings = defaultdict(list)
+    for n in names:
+        for c in set(n):
+            postings[c].append(n)
+
+    pairs = set()
+    for q in queries:
+        shared = Counter()
+        for c in set(q):
+            shared.update(postings[c])
+        for n, cnt in shared.items():
+            if cnt > 1 and n != q and not (n in english and q in english):
+                pairs.add((min(n, q), max(n, q)))
+    return pairs
+
+
+def lsh_candidates(names: list[str], queries: set[str]) -> set[tuple[str, str]]:
+    """Pairs of `names`, ordered, with at least one of them in `queries` that share an LSH bucket."""
+    signatures = {n: minhash(n) for n in names}
+    buckets = defaultdict(list)
+    for n, sig in signatures.items():
+        for b in range(ENTITY_LSH_BANDS):
+            buckets[(b, sig[b * ENTITY_LSH_ROWS:(b + 1) * ENTITY_LSH_ROWS].tobytes())].append(n)
+
+    pairs = set()
+    for q in queries:
+        if q not in signatures:
+            continue
+        sig = signatures[q]
+        for b in range(ENTITY_LSH_BANDS):
+            for n in buckets[(b, sig[b * ENTITY_LSH_ROWS:(b + 1) * ENTITY_LSH_ROWS].tobytes())]:
+                if n != q:
+                    pairs.add((min(n, q), max(n, q)))
+    return pairs
+
+
+async def embedding_candidates(embd_mdl, names: list[str], queries: set[str]) -> set[tuple[str, str]]:
+    """Pairs of `names`, ordered, of a name in `queries` and its ENTITY_EMBEDDING_TOPK nearest names above ENTITY_EMBEDDING_SIMILARITY."""
+    rows = [i for i, n in enumerate(names) if n in queries]
+    if ENTITY_EMBEDDING_TOPK <= 0 or not rows or len(names) < 2:
+        return set()
+    vecs, _ = await trio.to_thread.run_sync(lambda: embd_mdl.encode(names))
+    vecs = np.asarray(vecs, dtype=np.float32)
+    vecs /= np.linalg.norm(vecs, axis=1, keepdims=True) + 1e-9
+    k = min(ENTITY_EMBEDDING_TOPK + 1, len(names))
+
+    pairs = set()
+    for b in range(0, len(rows), 1024):
+        batch = rows[b:b + 1024]
+        sims = vecs[batch] @ vecs.T
+        nearest = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+        for i, q in enumerate(batch):
+            for j in nearest[i]:
+                if j != q and sims[i, j] >= ENTITY_EMBEDDING_SIMILARITY:
+                    pairs.add((min(names[q], names[j]), max(names[q], names[j])))
+    return pairs
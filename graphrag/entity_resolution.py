@@ -14,7 +14,6 @@
 #  limitations under the License.
 #
 import logging
-import itertools
 import re
 from dataclasses import dataclass
 from typing import Any, Callable
@@ -27,6 +26,8 @@ from rag.nlp import is_english
 import editdistance
 from graphrag.entity_resolution_prompt import ENTITY_RESOLUTION_PROMPT
 from rag.llm.chat_model import Base as CompletionLLM
+from graphrag.entity_blocking import blocking_candidates, embedding_candidates
+from graphrag.pagerank import update_pagerank
 from graphrag.utils import perform_variable_replacements, chat_limiter, GraphChange
 
 DEFAULT_RECORD_DELIMITER = "##"
@@ -53,10 +54,12 @@ class EntityResolution(Extractor):
     def __init__(
             self,
             llm_invoker: CompletionLLM,
+            embd_mdl=None,
     ):
         super().__init__(llm_invoker)
         """Init method definition."""
         self._llm = llm_invoker
+        self._embd_mdl = embd_mdl
         self._resolution_prompt = ENTITY_RESOLUTION_PROMPT
         self._record_delimiter_key = "record_delimiter"
         self._entity_index_dilimiter_key = "entity_index_delimiter"
@@ -91,7 +94,12 @@ class EntityResolution(Extractor):
 
         candidate_resolution = {entity_type: [] for entity_type in entity_types}
         for k, v in node_clusters.items():
-            candidate_resolution[k] = [(a, b) for a, b in itertools.combinations(v, 2) if (a in subgraph_nodes or b in subgraph_nodes) and self.is_similarity(a, b)]
+            # only pairs blocked together are compared, instead of all combinations
+            queries = subgraph_nodes & set(v)
+            candidates = set(pair for pair in blocking_candidates(v, queries) if self.is_similarity(*pair))
+            if self._embd_mdl is not None:
+                candidates |= await embedding_candidates(self._embd_mdl, v, queries)
+            candidate_resolution[k] = sorted(candidates)
         num_candidates = sum([len(candidates) for _, candidates in candidate_resolution.items()])
         callback(msg=f"Identified {num_candidates} candidate pairs")
 
@@ -114,10 +122,7 @@ class EntityResolution(Extractor):
                 merging_nodes = list(sub_connect_graph.nodes)
                 nursery.start_soon(lambda: self._merge_graph_nodes(graph, merging_nodes, change))
 
-        # Update pagerank
-        pr = nx.pagerank(graph)
-        for node_name, pagerank in pr.items():
-            graph.nodes[node_name]["pagerank"] = pagerank
+        update_pagerank(graph)
 
         return EntityResolutionResult(
             graph=graph,
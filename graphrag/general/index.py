@@ -15,8 +15,10 @@
 #
 import json
 import logging
+import os
 import networkx as nx
 import trio
+from networkx.readwrite import json_graph
 
 from api import settings
 from api.utils import get_uuid
@@ -25,17 +27,27 @@ from graphrag.general.graph_extractor import GraphExtractor as GeneralKGExt
 from graphrag.general.community_reports_extractor import CommunityReportsExtractor
 from graphrag.entity_resolution import EntityResolution
 from graphrag.general.extractor import Extractor
+from graphrag.pagerank import update_pagerank
 from graphrag.utils import (
     graph_merge,
     get_graph,
+    get_graph_topology,
+    get_subgraph,
     set_graph,
+    update_graph_topology,
     chunk_id,
     does_graph_contains,
     tidy_graph,
     GraphChange,
 )
 from rag.nlp import rag_tokenizer, search
-from rag.utils.redis_conn import RedisDistributedLock
+from rag.settings import DOC_BULK_SIZE
+from rag.utils.redis_conn import REDIS_CONN, RedisDistributedLock
+
+# subgraphs merged into the graph in one write
+GRAPHRAG_MERGE_BATCH = int(os.environ.get("GRAPHRAG_MERGE_BATCH", "16"))
+# seconds to wait for a notification before trying graphrag_task_lock again
+GRAPHRAG_LOCK_WAIT = int(os.environ.get("GRAPHRAG_LOCK_WAIT", "60"))
 
 
 async def run_graphrag(
@@ -73,7 +85,7 @@ async def run_graphrag(
         return
 
     subgraph_nodes = set(subgraph.nodes())
-    new_graph = await merge_subgraph(
+    await merge_subgraph(
         tenant_id,
         kb_id,
         doc_id,
@@ -81,11 +93,14 @@ async def run_graphrag(
         embedding_model,
         callback,
     )
-    assert new_graph is not None
 
     if not with_resolution or not with_community:
         return
 
+    # merge_subgraph holds only the part of the graph this document touched
+    new_graph = await get_graph(tenant_id, kb_id)
+    assert new_graph is not None
+
     if with_resolution:
         await resolve_entities(
             new_graph,
@@ -191,35 +206,115 @@ async def merge_subgraph(
     embedding_model,
     callback,
 ):
+    """
+    Queue `subgraph` on the merge stream of the KB. Whoever holds graphrag_task_lock merges everything
+    queued in batches and notifies the producers, which wait for that or for the lock to be released.
+    """
+    start = trio.current_time()
     graphrag_task_lock = RedisDistributedLock(f"graphrag_task_{kb_id}", lock_value=doc_id, timeout=600)
+    reply_channel = f"graphrag_merged_{kb_id}_{doc_id}"
+    # subscribe first so that neither the reply nor a release is missed
+    pubsub = REDIS_CONN.subscribe([reply_channel, graphrag_task_lock.released_channel])
+    try:
+        message = {"doc_id": doc_id, "subgraph": nx.node_link_data(subgraph, edges="edges")}
+        assert REDIS_CONN.queue_product(f"graphrag_merge_{kb_id}", message), "Can't access Redis. Please check the Redis' status."
+        while True:
+            if await trio.to_thread.run_sync(graphrag_task_lock.acquire):
+                try:
+                    merged = await merge_queued_subgraphs(tenant_id, kb_id, {doc_id: subgraph}, embedding_model, callback,
+                                                          graphrag_task_lock)
+                finally:
+                    graphrag_task_lock.release()
+                if doc_id in merged:
+                    break
+            msg = await trio.to_thread.run_sync(lambda: REDIS_CONN.wait_message(pubsub, GRAPHRAG_LOCK_WAIT))
+            if msg is None:
+                callback(msg=f"merge_subgraph {doc_id} is waiting graphrag_task_lock")
+            elif msg["channel"] == reply_channel:
+                error = json.loads(msg["data"]).get("error")
+                if error:
+                    raise Exception(f"Merging subgraph of {doc_id} failed: {error}")
+                break
+    finally:
+        if pubsub is not None:
+            pubsub.close()
+    now = trio.current_time()
+    callback(
+        msg=f"merging subgraph for doc {doc_id} into the global graph done in {now - start:.2f} seconds."
+    )
+
+
+async def merge_queued_subgraphs(tenant_id: str, kb_id: str, subgraphs: dict[str, nx.Graph], embedding_model, callback,
+                                 graphrag_task_lock: RedisDistributedLock) -> set[str]:
+    """
+    Merge the queued subgraphs GRAPHRAG_MERGE_BATCH at a time until the stream is empty. The lock is extended
+    before every batch, and the merging stops if it was lost, since its new holder merges the same entries.
+    """
+    queue = f"graphrag_merge_{kb_id}"
+    merged = set()
     while True:
-        if graphrag_task_lock.acquire():
-            break
-        callback(msg=f"merge_subgraph {doc_id} is waiting graphrag_task_lock")
-        await trio.sleep(10)
+        if not await trio.to_thread.run_sync(graphrag_task_lock.extend):
+            callback(msg="graphrag_task_lock was lost, the remaining subgraphs are left to its holder.")
+            return merged
+        entries = await trio.to_thread.run_sync(lambda: REDIS_CONN.queue_range(queue, GRAPHRAG_MERGE_BATCH))
+        if not entries:
+            return merged
+        doc_ids = [msg["doc_id"] for _, msg in entries]
+        error = "merge was interrupted"
+        try:
+            batch = [subgraphs[msg["doc_id"]] if msg["doc_id"] in subgraphs else json_graph.node_link_graph(msg["subgraph"], edges="edges")
+                     for _, msg in entries]
+            await merge_subgraphs(tenant_id, kb_id, batch, embedding_model, callback)
+            error = ""
+        except Exception as e:
+            error = str(e) or repr(e)
+            raise
+        finally:
+            REDIS_CONN.queue_delete(queue, [msg_id for msg_id, _ in entries])
+            for doc_id in doc_ids:
+                REDIS_CONN.publish(f"graphrag_merged_{kb_id}_{doc_id}", json.dumps({"error": error}))
+        merged.update(doc_ids)
+        callback(msg=f"merged subgraphs of {len(doc_ids)} documents into the global graph.")
 
-    start = trio.current_time()
+
+async def merge_subgraphs(
+    tenant_id: str,
+    kb_id: str,
+    subgraphs: list[nx.Graph],
+    embedding_model,
+    callback,
+):
     change = GraphChange()
-    old_graph = await get_graph(tenant_id, kb_id)
-    if old_graph is not None:
+    topology = await get_graph_topology(tenant_id, kb_id)
+    if topology is None:
+        new_graph = topology = nx.Graph()
+        for subgraph in subgraphs:
+            graph_merge(new_graph, subgraph, change)
+    elif topology.graph.get("legacy"):
         logging.info("Merge with an exiting graph...................")
-        tidy_graph(old_graph, callback)
-        new_graph = graph_merge(old_graph, subgraph, change)
+        tidy_graph(topology, callback)
+        for subgraph in subgraphs:
+            graph_merge(topology, subgraph, change)
+        new_graph = topology
+    else:
+        # only the entities and relations the subgraphs touch are read and written back
+        new_graph = await get_subgraph(tenant_id, kb_id, topology, set().union(*(s.nodes() for s in subgraphs)))
+        tidy_graph(new_graph, callback)
+        for subgraph in subgraphs:
+            graph_merge(new_graph, subgraph, change)
+        update_graph_topology(topology, new_graph, change)
+    if new_graph is topology:
+        update_pagerank(topology, callback=callback)
     else:
-        new_graph = subgraph
-        change.added_updated_nodes = set(new_graph.nodes())
-        change.added_updated_edges = set(new_graph.edges())
-    pr = nx.pagerank(new_graph)
-    for node_name, pagerank in pr.items():
-        new_graph.nodes[node_name]["pagerank"] = pagerank
+        touched = set(change.added_updated_nodes)
+        for edge in change.added_updated_edges | change.removed_edges:
+            touched.update(edge)
+        update_pagerank(topology, touched, topology.graph.get("version", 0), callback)
+    for node_name in new_graph.nodes:
+        new_graph.nodes[node_name]["rank"] = topology.degree(node_name)
+        new_graph.nodes[node_name]["pagerank"] = topology.nodes[node_name]["pagerank"]
 
-    await set_graph(tenant_id, kb_id, embedding_model, new_graph, change, callback)
-    graphrag_task_lock.release()
-    now = trio.current_time()
-    callback(
-        msg=f"merging subgraph for doc {doc_id} into the global graph done in {now - start:.2f} seconds."
-    )
-    return new_graph
+    await set_graph(tenant_id, kb_id, embedding_model, new_graph, change, callback, topology)
 
 
 async def resolve_entities(
@@ -233,15 +328,13 @@ async def resolve_entities(
     callback,
 ):
     graphrag_task_lock = RedisDistributedLock(f"graphrag_task_{kb_id}", lock_value=doc_id, timeout=600)
-    while True:
-        if graphrag_task_lock.acquire():
-            break
+    while not await trio.to_thread.run_sync(lambda: graphrag_task_lock.wait_acquire(GRAPHRAG_LOCK_WAIT)):
         callback(msg=f"resolve_entities {doc_id} is waiting graphrag_task_lock")
-        await trio.sleep(10)
 
     start = trio.current_time()
     er = EntityResolution(
         llm_bdl,
+        embed_bdl,
     )
     reso = await er(graph, subgraph_nodes, callback=callback)
     graph = reso.graph
@@ -265,11 +358,8 @@ async def extract_community(
     callback,
 ):
     graphrag_task_lock = RedisDistributedLock(f"graphrag_task_{kb_id}", lock_value=doc_id, timeout=600)
-    while True:
-        if graphrag_task_lock.acquire():
-            break
+    while not await trio.to_thread.run_sync(lambda: graphrag_task_lock.wait_acquire(GRAPHRAG_LOCK_WAIT)):
         callback(msg=f"extract_community {doc_id} is waiting graphrag_task_lock")
-        await trio.sleep(10)
 
     start = trio.current_time()
     ext = CommunityReportsExtractor(
@@ -319,7 +409,7 @@ async def extract_community(
             kb_id,
         )
     )
-    es_bulk_size = 4
+    es_bulk_size = DOC_BULK_SIZE
     for b in range(0, len(chunks), es_bulk_size):
         doc_store_result = await trio.to_thread.run_sync(lambda: settings.docStoreConn.insert(chunks[b:b + es_bulk_size], search.index_name(tenant_id), kb_id))
         if doc_store_result:
@@ -0,0 +1,126 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+PageRank of the knowledge graph, kept up to date around the nodes a merge touches.
+
+Nodes carry a `score`, PageRank scaled so that every node teleports 1 - alpha instead of
+(1 - alpha) / N. Unlike `pagerank`, which is `score` over the sum of all scores, it doesn't
+move when nodes are added elsewhere in the graph, so a change only perturbs the scores of
+nearby nodes. Those are settled by pushing residuals to the neighbors until none exceeds
+the tolerance.
+"""
+import logging
+import os
+
+import networkx as nx
+
+PAGERANK_ALPHA = 0.85
+# largest residual left unpushed per neighbor of a node, scores average to about 1
+GRAPH_PAGERANK_TOLERANCE = float(os.environ.get("GRAPH_PAGERANK_TOLERANCE", "1e-4"))
+# graph versions between full recomputes, which also clear the residuals dropped so far
+GRAPH_PAGERANK_FULL_EVERY = int(os.environ.get("GRAPH_PAGERANK_FULL_EVERY", "64"))
+# recompute fully when the nodes to settle exceed this share of the graph
+GRAPH_PAGERANK_FULL_RATIO = float(os.environ.get("GRAPH_PAGERANK_FULL_RATIO", "0.3"))
+
+
+def out_weight(graph: nx.Graph, node) -> float:
+    return sum(attrs.get("weight", 1) for attrs in graph.adj[node].values())
+
+
+def full_pagerank(graph: nx.Graph):
+    # nx stops once the scores move less than tol * N in total, scaled to match the tolerance of the updates
+    pr = nx.pagerank(graph, alpha=PAGERANK_ALPHA, tol=GRAPH_PAGERANK_TOLERANCE / max(1, graph.number_of_nodes()))
+    # nx spreads the rank of dangling nodes over all nodes, which only scales the scores:
+    # they sum to N - alpha * number of dangling nodes
+    dangling = sum(1 for n in graph.nodes if out_weight(graph, n) == 0)
+    scale = graph.number_of_nodes() - PAGERANK_ALPHA * dangling
+    for n, p in pr.items():
+        graph.nodes[n]["score"] = p * scale
+        graph.nodes[n]["pagerank"] = p
+
+
+def incremental_pagerank(graph: nx.Graph, touched) -> set:
+    """
+    Settle the scores after the edges of `touched` nodes changed, new nodes start from 0.
+    Returns the nodes whose score moved.
+    """
+    weights = {}
+
+    def w(n):
+        if n not in weights:
+            weights[n] = out_weight(graph, n)
+        return weights[n]
+
+    def score(n):
+        return graph.nodes[n].get("score", 0)
+
+    # a node's equation involves its neighbors' out-weights, so the neighbors of touched nodes are off too
+    frontier = set(n for n in touched if graph.has_node(n))
+    for n in list(frontier):
+        frontier.update(graph.adj[n])
+    residual = {}
+    for n in frontier:
+        inflow = sum(score(m) * attrs.get("weight", 1) / w(m) for m, attrs in graph.adj[n].items() if w(m) > 0)
+        residual[n] = 1 - PAGERANK_ALPHA + PAGERANK_ALPHA * inflow - score(n)
+
+    # scores grow with the degree, so does the residual a node may keep
+    def settled(n):
+        return abs(residual.get(n, 0)) <= GRAPH_PAGERANK_TOLERANCE * max(1, len(graph.adj[n]))
+
+    moved = set()
+    queue = [n for n in residual if not settled(n)]
+    queued = set(queue)
+    while queue:
+        n = queue.pop()
+        queued.discard(n)
+        r = residual.pop(n, 0)
+        graph.nodes[n]["score"] = score(n) + r
+        moved.add(n)
+        if w(n) == 0:
+            continue
+        for m, attrs in graph.adj[n].items():
+            residual[m] = residual.get(m, 0) + PAGERANK_ALPHA * r * attrs.get("weight", 1) / w(n)
+            if m not in queued and not settled(m):
+                queue.append(m)
+                queued.add(m)
+    return moved
+
+
+def update_pagerank(graph: nx.Graph, touched=None, version: int = 0, callback=None) -> set:
+    """
+    Bring `score` and `pagerank` of the graph up to date, incrementally around `touched` unless it's None,
+    the graph is due a full recompute, or too much of it is touched. Returns the nodes whose `pagerank` was set.
+    """
+    if touched is not None:
+        touched = set(touched)
+    full = touched is None or version % GRAPH_PAGERANK_FULL_EVERY == 0 or \
+        len(touched) > GRAPH_PAGERANK_FULL_RATIO * graph.number_of_nodes() or \
+        any("score" not in attrs for n, attrs in graph.nodes(data=True) if n not in touched)
+    if full:
+        full_pagerank(graph)
+        msg = f"PageRank recomputed for {graph.number_of_nodes()} nodes."
+        updated = set(graph.nodes)
+    else:
+        moved = incremental_pagerank(graph, touched)
+        total = sum(attrs["score"] for _, attrs in graph.nodes(data=True)) or 1
+        updated = moved | set(n for n in touched if graph.has_node(n))
+        for n in updated:
+            graph.nodes[n]["pagerank"] = graph.nodes[n]["score"] / total
+        msg = f"PageRank updated {len(moved)} of {graph.number_of_nodes()} nodes around {len(touched)} changed ones."
+    logging.debug(msg)
+    if callback:
+        callback(msg=msg)
+    return updated
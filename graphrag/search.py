@@ -15,7 +15,10 @@
 #
 import json
 import logging
+import os
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from copy import deepcopy
 import json_repair
 import pandas as pd
@@ -29,6 +32,9 @@ from rag.utils.doc_store_conn import OrderByExpr
 
 from rag.nlp.search import Dealer, index_name
 
+# bounds the LLM query rewrite of retrievals which have a timeout, so that a slow LLM can't hold their threads
+QUERY_REWRITE_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.environ.get("KG_QUERY_REWRITE_THREADS", "8")), thread_name_prefix="kg_query_rewrite")
+
 
 class KGSearch(Dealer):
     def _chat(self, llm_bdl, system, history, gen_conf):
@@ -41,11 +47,15 @@ class KGSearch(Dealer):
         set_llm_cache(llm_bdl.llm_name, system, response, history, gen_conf)
         return response
 
-    def query_rewrite(self, llm, question, idxnms, kb_ids):
+    def query_rewrite(self, llm, question, idxnms, kb_ids, timeout=None):
         ty2ents = trio.run(lambda: get_entity_type2sampels(idxnms, kb_ids))
         hint_prompt = PROMPTS["minirag_query2kwd"].format(query=question,
                                                           TYPE_POOL=json.dumps(ty2ents, ensure_ascii=False, indent=2))
-        result = self._chat(llm, hint_prompt, [{"role": "user", "content": "Output:"}], {"temperature": .5})
+        history = [{"role": "user", "content": "Output:"}]
+        if timeout is None:
+            result = self._chat(llm, hint_prompt, history, {"temperature": .5})
+        else:
+            result = QUERY_REWRITE_EXECUTOR.submit(self._chat, llm, hint_prompt, history, {"temperature": .5}).result(timeout=max(0, timeout))
         try:
             keywords_data = json_repair.loads(result)
             type_keywords = keywords_data.get("answer_type_keywords", [])
@@ -148,7 +158,9 @@ class KGSearch(Dealer):
                comm_topn: int = 1,
                ent_sim_threshold: float = 0.3,
                rel_sim_threshold: float = 0.3,
+               timeout: float | None = None,
                ):
+        """`timeout` bounds the LLM query rewrite, the question itself is searched for if it runs out."""
         qst = question
         filters = self.get_filters({"kb_ids": kb_ids})
         if isinstance(tenant_ids, str):
@@ -156,8 +168,11 @@ class KGSearch(Dealer):
         idxnms = [index_name(tid) for tid in tenant_ids]
         ty_kwds = []
         try:
-            ty_kwds, ents = self.query_rewrite(llm, qst, [index_name(tid) for tid in tenant_ids], kb_ids)
+            ty_kwds, ents = self.query_rewrite(llm, qst, [index_name(tid) for tid in tenant_ids], kb_ids, timeout)
             logging.info(f"Q: {qst}, Types: {ty_kwds}, Entities: {ents}")
+        except FutureTimeoutError:
+            logging.warning(f"Query rewrite of '{qst}' timed out after {timeout}s, search for the question itself.")
+            ents = [qst]
         except Exception as e:
             logging.exception(e)
             ents = [qst]
@@ -19,15 +19,15 @@ import trio
 from typing import Set, Tuple
 
 import networkx as nx
-import numpy as np
 import xxhash
 from networkx.readwrite import json_graph
 import dataclasses
 
 from api import settings
-from api.utils import get_uuid
 from rag.nlp import search, rag_tokenizer
+from rag.settings import DOC_BULK_SIZE
 from rag.utils.doc_store_conn import OrderByExpr
+from rag.utils.embedding_cache import EMBEDDING_CACHE
 from rag.utils.redis_conn import REDIS_CONN
 
 GRAPH_FIELD_SEP = "<SEP>"
@@ -36,6 +36,10 @@ ErrorHandlerFn = Callable[[BaseException | None, str | None, dict | None], None]
 
 chat_limiter = trio.CapacityLimiter(int(os.environ.get('MAX_CONCURRENT_CHATS', 10)))
 
+# entities and relations read from the doc store per request
+GRAPH_SHARD_BATCH = int(os.environ.get("GRAPH_SHARD_BATCH", 1024))
+GRAPH_SHARD_FIELDS = ["knowledge_graph_kwd", "entity_kwd", "from_entity_kwd", "to_entity_kwd", "content_with_weight"]
+
 @dataclasses.dataclass
 class GraphChange:
     removed_nodes: Set[str] = dataclasses.field(default_factory=set)
@@ -118,25 +122,11 @@ def set_llm_cache(llmnm, txt, v, history, genconf):
 
 
 def get_embed_cache(llmnm, txt):
-    hasher = xxhash.xxh64()
-    hasher.update(str(llmnm).encode("utf-8"))
-    hasher.update(str(txt).encode("utf-8"))
-
-    k = hasher.hexdigest()
-    bin = REDIS_CONN.get(k)
-    if not bin:
-        return
-    return np.array(json.loads(bin))
+    return EMBEDDING_CACHE.get(str(llmnm), [txt])[0]
 
 
 def set_embed_cache(llmnm, txt, arr):
-    hasher = xxhash.xxh64()
-    hasher.update(str(llmnm).encode("utf-8"))
-    hasher.update(str(txt).encode("utf-8"))
-
-    k = hasher.hexdigest()
-    arr = json.dumps(arr.tolist() if isinstance(arr, np.ndarray) else arr)
-    REDIS_CONN.set(k, arr.encode("utf-8"), 24*3600)
+    EMBEDDING_CACHE.set(str(llmnm), [txt], [arr])
 
 
 def get_tags_from_cache(kb_ids):
@@ -299,9 +289,14 @@ def chunk_id(chunk):
     return xxhash.xxh64((chunk["content_with_weight"] + chunk["kb_id"]).encode("utf-8")).hexdigest()
 
 
+def graph_shard_id(kb_id, *key):
+    """Entities, relations and the graph manifest are stored under ids derived from their names, so writes overwrite them in place."""
+    return xxhash.xxh64("\0".join([kb_id, *key]).encode("utf-8")).hexdigest()
+
+
 async def graph_node_to_chunk(kb_id, embd_mdl, ent_name, meta, chunks):
     chunk = {
-        "id": get_uuid(),
+        "id": graph_shard_id(kb_id, "entity", ent_name),
         "important_kwd": [ent_name],
         "title_tks": rag_tokenizer.tokenize(ent_name),
         "entity_kwd": ent_name,
@@ -353,7 +348,7 @@ def get_relation(tenant_id, kb_id, from_ent_name, to_ent_name, size=1):
 
 async def graph_edge_to_chunk(kb_id, embd_mdl, from_ent_name, to_ent_name, meta, chunks):
     chunk = {
-        "id": get_uuid(),
+        "id": graph_shard_id(kb_id, "relation", from_ent_name, to_ent_name),
         "from_entity_kwd": from_ent_name,
         "to_entity_kwd": to_ent_name,
         "knowledge_graph_kwd": "relation",
@@ -406,7 +401,13 @@ async def get_graph_doc_ids(tenant_id, kb_id) -> list[str]:
     return doc_ids
 
 
-async def get_graph(tenant_id, kb_id):
+async def get_graph_topology(tenant_id, kb_id):
+    """
+    The bare graph kept in the manifest chunk: entity names with their PageRank score and the weighted relations,
+    `graph.graph` carries the version and source_id. A graph stored as one node_link_data chunk,
+    which is how it used to be kept, comes back whole and flagged `legacy`. Without a manifest to read,
+    removed along with a document or unreadable, it's rebuilt from the entities and relations.
+    """
     conds = {
         "fields": ["content_with_weight", "source_id"],
         "removed_kwd": "N",
@@ -414,69 +415,206 @@ async def get_graph(tenant_id, kb_id):
         "knowledge_graph_kwd": ["graph"]
     }
     res = await trio.to_thread.run_sync(lambda: settings.retrievaler.search(conds, search.index_name(tenant_id), [kb_id]))
-    if res.total == 0:
-        return None
     for id in res.ids:
         try:
-            g = json_graph.node_link_graph(json.loads(res.field[id]["content_with_weight"]), edges="edges")
+            content = json.loads(res.field[id]["content_with_weight"])
+            if "entities" in content:
+                g = nx.Graph()
+                total = sum(score for _, score in content["entities"]) or 1
+                for ent_name, score in content["entities"]:
+                    g.add_node(ent_name, score=score, pagerank=score / total)
+                g.add_weighted_edges_from(content["relations"])
+                g.graph["version"] = content["version"]
+            else:
+                g = json_graph.node_link_graph(content, edges="edges")
+                g.graph["legacy"] = True
             if "source_id" not in g.graph:
                 g.graph["source_id"] = res.field[id]["source_id"]
             return g
         except Exception:
             continue
-    result = await rebuild_graph(tenant_id, kb_id)
-    return result
+    if res.total:
+        logging.warning(f"get_graph_topology can't read the graph manifest of kb {kb_id}, rebuild it")
+    return await trio.to_thread.run_sync(lambda: rebuild_graph_topology(tenant_id, kb_id))
 
 
-async def set_graph(tenant_id: str, kb_id: str, embd_mdl, graph: nx.Graph, change: GraphChange, callback):
-    start = trio.current_time()
+def rebuild_graph_topology(tenant_id, kb_id):
+    """The topology of the entities and relations stored, None if there's none. Their scores are left to be recomputed."""
+    flds = ["knowledge_graph_kwd", "entity_kwd", "from_entity_kwd", "to_entity_kwd", "weight_int", "source_id"]
+    graph = nx.Graph()
+    src_ids = set()
+    relations = []
+    for kwd in ["entity", "relation"]:
+        offset = 0
+        while True:
+            es_res = settings.docStoreConn.search(flds, [], {"kb_id": kb_id, "knowledge_graph_kwd": [kwd]}, [], OrderByExpr(),
+                                                  offset, GRAPH_SHARD_BATCH, search.index_name(tenant_id), [kb_id])
+            records = settings.docStoreConn.getFields(es_res, flds)
+            for d in records.values():
+                src_ids.update(d.get("source_id") or [])
+                if kwd == "entity":
+                    graph.add_node(d["entity_kwd"])
+                else:
+                    relations.append((d["from_entity_kwd"], d["to_entity_kwd"], int(d.get("weight_int") or 0)))
+            if len(settings.docStoreConn.getChunkIds(es_res)) < GRAPH_SHARD_BATCH:
+                break
+            offset += GRAPH_SHARD_BATCH
+    if not graph.number_of_nodes():
+        return None
+    # relations left by entities removed with their documents are dropped
+    graph.add_weighted_edges_from((f, t, w) for f, t, w in relations if graph.has_node(f) and graph.has_node(t))
+    graph.graph["version"] = 0
+    graph.graph["source_id"] = sorted(src_ids)
+    logging.info(f"Rebuilt the graph topology of kb {kb_id}: {graph.number_of_nodes()} entities, {graph.number_of_edges()} relations")
+    return graph
 
-    await trio.to_thread.run_sync(lambda: settings.docStoreConn.delete({"knowledge_graph_kwd": ["graph"]}, search.index_name(tenant_id), kb_id))
 
-    if change.removed_nodes:
-        await trio.to_thread.run_sync(lambda: settings.docStoreConn.delete({"knowledge_graph_kwd": ["entity"], "entity_kwd": sorted(change.removed_nodes)}, search.index_name(tenant_id), kb_id))
+def get_graph_shards(tenant_id, kb_id, ids: list[str]) -> list[dict]:
+    res = []
+    for b in range(0, len(ids), GRAPH_SHARD_BATCH):
+        batch = ids[b:b + GRAPH_SHARD_BATCH]
+        es_res = settings.docStoreConn.search(GRAPH_SHARD_FIELDS, [], {"id": batch}, [], OrderByExpr(), 0, len(batch), search.index_name(tenant_id), [kb_id])
+        res.extend(settings.docStoreConn.getFields(es_res, GRAPH_SHARD_FIELDS).values())
+    return res
 
-    if change.removed_edges:
-        async with trio.open_nursery() as nursery:
-            for from_node, to_node in change.removed_edges:
-                nursery.start_soon(lambda: settings.docStoreConn.delete({"knowledge_graph_kwd": ["relation"], "from_entity_kwd": from_node, "to_entity_kwd": to_node}, search.index_name(tenant_id), kb_id))
-    now = trio.current_time()
-    if callback:
-        callback(msg=f"set_graph removed {len(change.removed_nodes)} nodes and {len(change.removed_edges)} edges from index in {now - start:.2f}s.")
-    start = now
 
-    chunks = [{
-        "id": get_uuid(),
-        "content_with_weight": json.dumps(nx.node_link_data(graph, edges="edges"), ensure_ascii=False),
+async def get_subgraph(tenant_id, kb_id, topology: nx.Graph, nodes) -> nx.Graph:
+    """The stored entities among `nodes` and the relations between them, read by id."""
+    nodes = [n for n in nodes if topology.has_node(n)]
+    ids = [graph_shard_id(kb_id, "entity", n) for n in nodes]
+    ids.extend(graph_shard_id(kb_id, "relation", *get_from_to(f, t)) for f, t in topology.subgraph(nodes).edges())
+    records = await trio.to_thread.run_sync(lambda: get_graph_shards(tenant_id, kb_id, ids))
+
+    graph = nx.Graph()
+    graph.graph["version"] = topology.graph.get("version", 0)
+    graph.graph["source_id"] = list(topology.graph.get("source_id", []))
+    for d in records:
+        if d.get("knowledge_graph_kwd") == "entity":
+            graph.add_node(d["entity_kwd"], **json.loads(d["content_with_weight"]))
+    for d in records:
+        if d.get("knowledge_graph_kwd") == "relation" and graph.has_node(d["from_entity_kwd"]) and graph.has_node(d["to_entity_kwd"]):
+            graph.add_edge(d["from_entity_kwd"], d["to_entity_kwd"], **json.loads(d["content_with_weight"]))
+    for n in graph.nodes:
+        graph.nodes[n]["score"] = topology.nodes[n].get("score", 0)
+        graph.nodes[n]["pagerank"] = topology.nodes[n].get("pagerank", 0)
+    return graph
+
+
+async def get_graph(tenant_id, kb_id):
+    topology = await get_graph_topology(tenant_id, kb_id)
+    if topology is None or topology.graph.get("legacy"):
+        return topology
+    return await get_subgraph(tenant_id, kb_id, topology, list(topology.nodes()))
+
+
+def update_graph_topology(topology: nx.Graph, graph: nx.Graph, change: GraphChange):
+    """Apply `change`, made to `graph` which may hold only part of the graph, to the topology of the whole graph."""
+    topology.remove_nodes_from(change.removed_nodes)
+    topology.remove_edges_from(change.removed_edges)
+    topology.add_nodes_from(change.added_updated_nodes)
+    for from_node, to_node in change.added_updated_edges:
+        topology.add_edge(from_node, to_node, weight=graph.edges[from_node, to_node].get("weight", 0))
+    topology.graph["source_id"] = graph.graph.get("source_id", [])
+
+
+def graph_manifest_chunk(kb_id, graph: nx.Graph, topology: nx.Graph, version: int) -> dict:
+    return {
+        "id": graph_shard_id(kb_id, "graph"),
+        "content_with_weight": json.dumps({
+            "version": version,
+            "entities": [[n, attrs.get("score", 0)] for n, attrs in topology.nodes(data=True)],
+            "relations": [[f, t, attrs.get("weight", 0)] for f, t, attrs in topology.edges(data=True)],
+        }, ensure_ascii=False),
         "knowledge_graph_kwd": "graph",
         "kb_id": kb_id,
         "source_id": graph.graph.get("source_id", []),
+        "graph_version_int": version,
         "available_int": 0,
         "removed_kwd": "N"
-    }]
+    }
+
+
+async def set_graph(tenant_id: str, kb_id: str, embd_mdl, graph: nx.Graph, change: GraphChange, callback, topology: nx.Graph = None):
+    """
+    Write `change` made to `graph` as a delta: removed entities and relations are deleted by id, added and
+    updated ones overwrite their records. The manifest with `topology`, the whole graph if `graph` holds only
+    part of it, goes last and bumps the version. A legacy graph is rewritten sharded.
+    """
+    start = trio.current_time()
+    if topology is None:
+        topology = graph
+    version = graph.graph.get("version", 0) + 1
+
+    if graph.graph.get("legacy"):
+        # entities and relations of a legacy graph have random ids, they can't be overwritten
+        await trio.to_thread.run_sync(lambda: settings.docStoreConn.delete({"knowledge_graph_kwd": ["graph", "entity", "relation"]}, search.index_name(tenant_id), kb_id))
+        change = GraphChange(added_updated_nodes=set(graph.nodes()), added_updated_edges=set(graph.edges()))
+    elif version == 1:
+        await trio.to_thread.run_sync(lambda: settings.docStoreConn.delete({"knowledge_graph_kwd": ["graph"]}, search.index_name(tenant_id), kb_id))
+
+    removed = [graph_shard_id(kb_id, "entity", n) for n in change.removed_nodes]
+    removed.extend(graph_shard_id(kb_id, "relation", *get_from_to(f, t)) for f, t in change.removed_edges)
+    if removed:
+        await trio.to_thread.run_sync(lambda: settings.docStoreConn.delete({"id": removed}, search.index_name(tenant_id), kb_id))
+    now = trio.current_time()
+    if callback:
+        callback(msg=f"set_graph removed {len(change.removed_nodes)} nodes and {len(change.removed_edges)} edges from index in {now - start:.2f}s.")
+    start = now
+
+    chunks = []
     async with trio.open_nursery() as nursery:
         for node in change.added_updated_nodes:
             node_attrs = graph.nodes[node]
             nursery.start_soon(lambda: graph_node_to_chunk(kb_id, embd_mdl, node, node_attrs, chunks))
         for from_node, to_node in change.added_updated_edges:
+            from_node, to_node = get_from_to(from_node, to_node)
             edge_attrs = graph.edges[from_node, to_node]
             nursery.start_soon(lambda: graph_edge_to_chunk(kb_id, embd_mdl, from_node, to_node, edge_attrs, chunks))
+    for chunk in chunks:
+        chunk["graph_version_int"] = version
     now = trio.current_time()
     if callback:
         callback(msg=f"set_graph converted graph change to {len(chunks)} chunks in {now - start:.2f}s.")
     start = now
 
-    es_bulk_size = 4
-    for b in range(0, len(chunks), es_bulk_size):
-        doc_store_result = await trio.to_thread.run_sync(lambda: settings.docStoreConn.insert(chunks[b:b + es_bulk_size], search.index_name(tenant_id), kb_id))
+    # the manifest is written once the records it points to are in place
+    es_bulk_size = DOC_BULK_SIZE
+    batches = [chunks[b:b + es_bulk_size] for b in range(0, len(chunks), es_bulk_size)]
+    batches.append([graph_manifest_chunk(kb_id, graph, topology, version)])
+    for batch in batches:
+        doc_store_result = await trio.to_thread.run_sync(lambda: settings.docStoreConn.insert(batch, search.index_name(tenant_id), kb_id))
         if doc_store_result:
             error_message = f"Insert chunk error: {doc_store_result}, please check log file and Elasticsearch/Infinity status!"
             raise Exception(error_message)
+    graph.graph["version"] = topology.graph["version"] = version
+    graph.graph.pop("legacy", None)
     now = trio.current_time()
     if callback:
         callback(msg=f"set_graph added/updated {len(change.added_updated_nodes)} nodes and {len(change.added_updated_edges)} edges from index in {now - start:.2f}s.")
 
 
+def get_graph_preview(tenant_id, kb_id, content: dict, max_nodes=256, max_edges=128) -> dict:
+    """The entities of a sharded graph with the highest pagerank and the heaviest relations among them, as node_link_data."""
+    total = sum(score for _, score in content["entities"]) or 1
+    entities = sorted(content["entities"], key=lambda x: x[1], reverse=True)[:max_nodes]
+    pagerank = dict((n, score / total) for n, score in entities)
+    relations = [r for r in content["relations"] if r[0] != r[1] and r[0] in pagerank and r[1] in pagerank]
+    relations = sorted(relations, key=lambda x: x[2], reverse=True)[:max_edges]
+    ids = [graph_shard_id(kb_id, "entity", n) for n in pagerank]
+    ids.extend(graph_shard_id(kb_id, "relation", *get_from_to(f, t)) for f, t, _ in relations)
+
+    nodes, edges = [], []
+    for d in get_graph_shards(tenant_id, kb_id, ids):
+        attrs = json.loads(d["content_with_weight"])
+        if d.get("knowledge_graph_kwd") == "entity":
+            nodes.append({**attrs, "pagerank": pagerank[d["entity_kwd"]], "id": d["entity_kwd"]})
+        elif d.get("knowledge_graph_kwd") == "relation":
+            edges.append({**attrs, "source": d["from_entity_kwd"], "target": d["to_entity_kwd"]})
+    nodes = sorted(nodes, key=lambda x: x["pagerank"], reverse=True)
+    edges = sorted(edges, key=lambda x: x.get("weight", 0), reverse=True)
+    return {"directed": False, "multigraph": False, "graph": {}, "nodes": nodes, "edges": edges}
+
+
 def is_continuous_subsequence(subseq, seq):
     def find_all_indexes(tup, value):
         indexes = []
@@ -549,50 +687,3 @@ def flat_uniq_list(arr, key):
         else:
             res.append(a)
     return list(set(res))
-
-
-async def rebuild_graph(tenant_id, kb_id):
-    graph = nx.Graph()
-    src_ids = set()
-    flds = ["entity_kwd", "from_entity_kwd", "to_entity_kwd", "knowledge_graph_kwd", "content_with_weight", "source_id"]
-    bs = 256
-    for i in range(0, 1024*bs, bs):
-        es_res = await trio.to_thread.run_sync(lambda: settings.docStoreConn.search(flds, [],
-                                 {"kb_id": kb_id, "knowledge_graph_kwd": ["entity"]},
-                                 [],
-                                 OrderByExpr(),
-                                 i, bs, search.index_name(tenant_id), [kb_id]
-                                 ))
-        tot = settings.docStoreConn.getTotal(es_res)
-        if tot == 0:
-            break
-
-        es_res = settings.docStoreConn.getFields(es_res, flds)
-        for id, d in es_res.items():
-            assert d["knowledge_graph_kwd"] == "relation"
-            src_ids.update(d.get("source_id", []))
-            attrs = json.load(d["content_with_weight"])
-            graph.add_node(d["entity_kwd"], **attrs)
-
-    for i in range(0, 1024*bs, bs):
-        es_res = await trio.to_thread.run_sync(lambda: settings.docStoreConn.search(flds, [],
-                                 {"kb_id": kb_id, "knowledge_graph_kwd": ["relation"]},
-                                 [],
-                                 OrderByExpr(),
-                                 i, bs, search.index_name(tenant_id), [kb_id]
-                                 ))
-        tot = settings.docStoreConn.getTotal(es_res)
-        if tot == 0:
-            return None
-
-        es_res = settings.docStoreConn.getFields(es_res, flds)
-        for id, d in es_res.items():
-            assert d["knowledge_graph_kwd"] == "relation"
-            src_ids.update(d.get("source_id", []))
-            if graph.has_node(d["from_entity_kwd"]) and graph.has_node(d["to_entity_kwd"]):
-                attrs = json.load(d["content_with_weight"])
-                graph.add_edge(d["from_entity_kwd"], d["to_entity_kwd"], **attrs)
-
-    src_ids = sorted(src_ids)
-    graph.graph["source_id"] = src_ids
-    return graph
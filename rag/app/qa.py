@@ -20,7 +20,6 @@ import csv
 from copy import deepcopy
 from io import BytesIO
 from timeit import default_timer as timer
-from openpyxl import load_workbook
 
 from deepdoc.parser.utils import get_text
 from rag.nlp import is_english, random_choices, qbullets_category, add_positions, has_qbullet, docx_question_level
@@ -35,39 +34,27 @@ from rag.utils import get_float
 
 class Excel(ExcelParser):
     def __call__(self, fnm, binary=None, callback=None):
-        if not binary:
-            wb = load_workbook(fnm)
-        else:
-            wb = load_workbook(BytesIO(binary))
-        total = 0
-        for sheetname in wb.sheetnames:
-            total += len(list(wb[sheetname].rows))
-
         res, fails = [], []
-        for sheetname in wb.sheetnames:
-            ws = wb[sheetname]
-            rows = list(ws.rows)
+        # rows are read as they are iterated instead of loading the workbook
+        for sheetname, rows in Excel._iter_sheets(binary if binary else fnm):
             for i, r in enumerate(rows):
                 q, a = "", ""
-                for cell in r:
-                    if not cell.value:
+                for v in r:
+                    if not v:
                         continue
                     if not q:
-                        q = str(cell.value)
+                        q = str(v)
                     elif not a:
-                        a = str(cell.value)
+                        a = str(v)
                     else:
                         break
                 if q and a:
                     res.append((q, a))
+                    if len(res) % 999 == 0:
+                        callback(msg="Extract pairs: {}".format(len(res)) +
+                                 (f"{len(fails)} failure, line: %s..." % (",".join(fails[:3])) if fails else ""))
                 else:
                     fails.append(str(i + 1))
-                if len(res) % 999 == 0:
-                    callback(len(res) *
-                             0.6 /
-                             total, ("Extract pairs: {}".format(len(res)) +
-                                     (f"{len(fails)} failure, line: %s..." %
-                                      (",".join(fails[:3])) if fails else "")))
 
         callback(0.6, ("Extract pairs: {}. ".format(len(res)) + (
             f"{len(fails)} failure, line: %s..." % (",".join(fails[:3])) if fails else "")))
@@ -16,7 +16,6 @@
 
 import copy
 import re
-from io import BytesIO
 from xpinyin import Pinyin
 import numpy as np
 import pandas as pd
@@ -24,7 +23,6 @@ import pandas as pd
 from dateutil.parser import parse as datetime_parse
 
 from api.db.services.knowledgebase_service import KnowledgebaseService
-from deepdoc.parser.utils import get_text
 from rag.nlp import rag_tokenizer, tokenize
 from deepdoc.parser import ExcelParser
 
@@ -32,39 +30,29 @@ from deepdoc.parser import ExcelParser
 class Excel(ExcelParser):
     def __call__(self, fnm, binary=None, from_page=0,
                  to_page=10000000000, callback=None):
-        if not binary:
-            wb = Excel._load_excel_to_workbook(fnm)
-        else:
-            wb = Excel._load_excel_to_workbook(BytesIO(binary))
-        total = 0
-        for sheetname in wb.sheetnames:
-            total += len(list(wb[sheetname].rows))
-
         res, fails, done = [], [], 0
         rn = 0
-        for sheetname in wb.sheetnames:
-            ws = wb[sheetname]
-            rows = list(ws.rows)
-            if not rows:
+        # rows are read as they are needed, those past to_page never are
+        for sheetname, rows in Excel._iter_sheets(binary if binary else fnm):
+            if rn >= to_page:
+                break
+            head = next(rows, None)
+            if head is None:
                 continue
-            headers = [cell.value for cell in rows[0]]
-            missed = set([i for i, h in enumerate(headers) if h is None])
-            headers = [
-                cell.value for i,
-                cell in enumerate(
-                    rows[0]) if i not in missed]
+            missed = set([i for i, h in enumerate(head) if h is None])
+            headers = [h for i, h in enumerate(head) if i not in missed]
             if not headers:
                 continue
             data = []
-            for i, r in enumerate(rows[1:]):
+            for i, r in enumerate(rows):
                 rn += 1
                 if rn - 1 < from_page:
                     continue
                 if rn - 1 >= to_page:
                     break
                 row = [
-                    cell.value for ii,
-                    cell in enumerate(r) if ii not in missed]
+                    v for ii,
+                    v in enumerate(r) if ii not in missed]
                 if len(row) != len(headers):
                     fails.append(str(i))
                     continue
@@ -154,23 +142,25 @@ def chunk(filename, binary=None, from_page=0, to_page=10000000000,
             callback=callback)
     elif re.search(r"\.(txt|csv)$", filename, re.IGNORECASE):
         callback(0.1, "Start to parse.")
-        txt = get_text(filename, binary)
-        lines = txt.split("\n")
-        fails = []
-        headers = lines[0].split(kwargs.get("delimiter", "\t"))
-        rows = []
-        for i, line in enumerate(lines[1:]):
-            if i < from_page:
-                continue
-            if i >= to_page:
-                break
-            row = [field for field in line.split(kwargs.get("delimiter", "\t"))]
-            if len(row) != len(headers):
-                fails.append(str(i))
-                continue
-            rows.append(row)
+        # decoded line by line, the lines past to_page never are
+        with Excel._text_lines(Excel._open(binary if binary else filename)) as lines:
+            fails = []
+            headers = next(lines, "").rstrip("\r\n").split(kwargs.get("delimiter", "\t"))
+            rows = []
+            n = 1
+            for i, line in enumerate(lines):
+                n += 1
+                if i < from_page:
+                    continue
+                if i >= to_page:
+                    break
+                row = [field for field in line.rstrip("\r\n").split(kwargs.get("delimiter", "\t"))]
+                if len(row) != len(headers):
+                    fails.append(str(i))
+                    continue
+                rows.append(row)
 
-        callback(0.3, ("Extract records: {}~{}".format(from_page, min(len(lines), to_page)) + (
+        callback(0.3, ("Extract records: {}~{}".format(from_page, min(n, to_page)) + (
             f"{len(fails)} failure, line: %s..." % (",".join(fails[:3])) if fails else "")))
 
         dfs = [pd.DataFrame(np.array(rows), columns=headers)]
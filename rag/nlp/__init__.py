@@ -255,8 +255,21 @@ def tokenize(d, t, eng):
     d["content_sm_ltks"] = rag_tokenizer.fine_grained_tokenize(d["content_ltks"])
 
 
+def tokenize_batch(docs, texts, eng):
+    """Same as `tokenize` for many documents, repeated texts are tokenized once."""
+    for d, t in zip(docs, texts):
+        d["content_with_weight"] = t
+    texts = [re.sub(r"</?(table|td|caption|tr|th)( [^<>]{0,12})?>", " ", t) for t in texts]
+    ltks = rag_tokenizer.tokenize_batch(texts)
+    sm_ltks = rag_tokenizer.fine_grained_tokenize_batch(ltks)
+    for d, tks, sm_tks in zip(docs, ltks, sm_ltks):
+        d["content_ltks"] = tks
+        d["content_sm_ltks"] = sm_tks
+    logging.debug("tokenize_batch({}) tokenizer cache: {}".format(len(docs), rag_tokenizer.cache_info()))
+
+
 def tokenize_chunks(chunks, doc, eng, pdf_parser=None):
-    res = []
+    res, texts = [], []
     # wrap up as es documents
     for ii, ck in enumerate(chunks):
         if len(ck.strip()) == 0:
@@ -272,13 +285,14 @@ def tokenize_chunks(chunks, doc, eng, pdf_parser=None):
                 pass
         else:
             add_positions(d, [[ii]*5])
-        tokenize(d, ck, eng)
         res.append(d)
+        texts.append(ck)
+    tokenize_batch(res, texts, eng)
     return res
 
 
 def tokenize_chunks_docx(chunks, doc, eng, images):
-    res = []
+    res, texts = [], []
     # wrap up as es documents
     for ck, image in zip(chunks, images):
         if len(ck.strip()) == 0:
@@ -286,35 +300,36 @@ def tokenize_chunks_docx(chunks, doc, eng, images):
         logging.debug("-- {}".format(ck))
         d = copy.deepcopy(doc)
         d["image"] = image
-        tokenize(d, ck, eng)
         res.append(d)
+        texts.append(ck)
+    tokenize_batch(res, texts, eng)
     return res
 
 
 def tokenize_table(tbls, doc, eng, batch_size=10):
-    res = []
+    res, texts = [], []
     # add tables
     for (img, rows), poss in tbls:
         if not rows:
             continue
         if isinstance(rows, str):
             d = copy.deepcopy(doc)
-            tokenize(d, rows, eng)
-            d["content_with_weight"] = rows
             if img:
                 d["image"] = img
             if poss:
                 add_positions(d, poss)
             res.append(d)
+            texts.append(rows)
             continue
         de = "; " if eng else "； "
         for i in range(0, len(rows), batch_size):
             d = copy.deepcopy(doc)
             r = de.join(rows[i:i + batch_size])
-            tokenize(d, r, eng)
             d["image"] = img
             add_positions(d, poss)
             res.append(d)
+            texts.append(r)
+    tokenize_batch(res, texts, eng)
     return res
 
 
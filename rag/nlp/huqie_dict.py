@@ -0,0 +1,181 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import json
+import logging
+import mmap
+import os
+import string
+import struct
+from array import array
+
+import datrie
+
+# Bump it whenever the layout of the compiled dictionary changes.
+DICT_VERSION = 1
+MAGIC = b"HUQIEDCT"
+HEADER = struct.Struct("<8sIII")
+REVERSE = -1
+
+
+class HuqieDict:
+    """
+    Precompiled, read-only tokenizer dictionary.
+
+    The trie maps keys to integers only (no Python objects), forward keys to a row of the frequency/tag
+    arrays and reverse keys to `REVERSE`. The arrays are memory mapped, so processes on a host share
+    them through the page cache and forked workers share the trie pages as long as nobody writes.
+    Words added at runtime by user dictionaries go to a small in-memory overlay.
+    """
+
+    def __init__(self, trie: datrie.BaseTrie, freqs, tag_ids, tags: list[str]):
+        self.trie = trie
+        self.freqs = freqs
+        self.tag_ids = tag_ids
+        self.tags = tags
+        self.tag_index = {t: i for i, t in enumerate(tags)}
+        self.overlay = []
+        # hot path of the segmentation, skip a wrapper call
+        self.has_keys_with_prefix = trie.has_keys_with_prefix
+
+    @staticmethod
+    def paths(base: str) -> tuple[str, str]:
+        return f"{base}.v{DICT_VERSION}.trie", f"{base}.v{DICT_VERSION}.dict"
+
+    @staticmethod
+    def fingerprint(fnm: str) -> str:
+        st = os.stat(fnm)
+        return f"{os.path.basename(fnm)}:{st.st_size}:{int(st.st_mtime)}"
+
+    @classmethod
+    def load(cls, base: str, source: str | None = None):
+        """
+        Load the compiled dictionary of `base`, None if it's missing, of another version or
+        compiled from a different `source` file.
+        """
+        trie_fnm, dict_fnm = cls.paths(base)
+        if not os.path.exists(trie_fnm) or not os.path.exists(dict_fnm):
+            return None
+        try:
+            with open(dict_fnm, "rb") as f:
+                magic, version, n, header_len = HEADER.unpack(f.read(HEADER.size))
+                if magic != MAGIC or version != DICT_VERSION:
+                    return None
+                header = json.loads(f.read(header_len).decode("utf-8"))
+            if source and os.path.exists(source) and header.get("source") != cls.fingerprint(source):
+                return None
+            offset = HEADER.size + header_len
+            offset += -offset % 8
+            # memoryviews over the mapping index to plain ints, much cheaper than numpy scalars
+            with open(dict_fnm, "rb") as f:
+                buf = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)) if n else memoryview(b"")
+            freqs = buf[offset: offset + n * 2].cast("h")
+            offset += n * 2
+            offset += -offset % 8
+            tag_ids = buf[offset: offset + n * 2].cast("H")
+            trie = datrie.BaseTrie.load(trie_fnm)
+        except Exception:
+            logging.exception(f"[HUQIE]:Fail to load compiled dictionary {dict_fnm}")
+            return None
+        logging.info(f"[HUQIE]:Loaded compiled dictionary {dict_fnm}, {n} words")
+        return cls(trie, freqs, tag_ids, header["tags"])
+
+    @classmethod
+    def compile(cls, base: str, items, source: str | None = None, save: bool = True):
+        """
+        Compile (key, value) pairs of the legacy trie, (F, tag) for forward keys and 1 for reverse keys,
+        and save the snapshot unless `save` is False.
+        """
+        trie = datrie.BaseTrie(string.printable)
+        freqs, tag_ids, tags, tag_index = [], [], [], {}
+        for k, v in items:
+            if not isinstance(v, tuple):
+                if k not in trie:
+                    trie[k] = REVERSE
+                continue
+            F, tag = v
+            if tag not in tag_index:
+                tag_index[tag] = len(tags)
+                tags.append(tag)
+            i = trie.get(k, REVERSE)
+            if i == REVERSE:
+                trie[k] = len(freqs)
+                freqs.append(F)
+                tag_ids.append(tag_index[tag])
+            else:
+                freqs[i], tag_ids[i] = F, tag_index[tag]
+
+        dic = cls(trie, array("h", freqs), array("H", tag_ids), tags)
+        if not save:
+            return dic
+        try:
+            dic.save(base, source)
+        except Exception:
+            logging.exception(f"[HUQIE]:Fail to save compiled dictionary of {base}, keep it in memory")
+            return dic
+        return cls.load(base) or dic
+
+    def save(self, base: str, source: str | None = None):
+        trie_fnm, dict_fnm = self.paths(base)
+        header = json.dumps({"tags": self.tags, "source": self.fingerprint(source) if source and os.path.exists(source) else ""}).encode("utf-8")
+        # write to temporary files and rename, concurrent readers never see a partial snapshot
+        suffix = f".{os.getpid()}.tmp"
+        with open(dict_fnm + suffix, "wb") as f:
+            f.write(HEADER.pack(MAGIC, DICT_VERSION, len(self.freqs), len(header)))
+            f.write(header)
+            f.write(b"\0" * (-f.tell() % 8))
+            f.write(array("h", self.freqs).tobytes())
+            f.write(b"\0" * (-f.tell() % 8))
+            f.write(array("H", self.tag_ids).tobytes())
+        self.trie.save(trie_fnm + suffix)
+        os.replace(trie_fnm + suffix, trie_fnm)
+        os.replace(dict_fnm + suffix, dict_fnm)
+        logging.info(f"[HUQIE]:Saved compiled dictionary {dict_fnm}, {len(self.freqs)} words")
+
+    """
+    The part of the datrie.Trie interface RagTokenizer relies on.
+    """
+
+    def __contains__(self, k):
+        return k in self.trie
+
+    def __getitem__(self, k):
+        v = self.get(k)
+        if v is None:
+            raise KeyError(k)
+        return v
+
+    def get(self, k, default=None):
+        i = self.trie.get(k)
+        if i is None:
+            return default
+        if i == REVERSE:
+            return 1
+        if i >= len(self.freqs):
+            return self.overlay[i - len(self.freqs)]
+        return self.freqs[i], self.tags[self.tag_ids[i]]
+
+    def __setitem__(self, k, v):
+        if not isinstance(v, tuple):
+            if k not in self.trie:
+                self.trie[k] = REVERSE
+            return
+        i = self.trie.get(k, REVERSE)
+        if i >= len(self.freqs):
+            self.overlay[i - len(self.freqs)] = v
+            return
+        self.trie[k] = len(self.freqs) + len(self.overlay)
+        self.overlay.append(v)
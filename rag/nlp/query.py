@@ -18,7 +18,6 @@ import logging
 import json
 import math
 import re
-from collections import defaultdict
 
 from rag.utils.doc_store_conn import MatchTextExpr
 from rag.nlp import rag_tokenizer, term_weight, synonym
@@ -212,19 +211,57 @@ class FulltextQueryer:
             return np.array(tksim), tksim, sims[0]
         return np.array(sims[0]) * vtweight + np.array(tksim) * tkweight, tksim, sims[0]
 
+    def hybrid_similarity_matrix(self, avecs, bvecs, atkss, btkss, tkweight=0.3, vtweight=0.7):
+        """
+        hybrid_similarity of every `a` against every `b` at once, as len(atkss) x len(btkss) matrices.
+        Term weights are computed once per text instead of once per pair.
+        """
+        import numpy as np
+
+        avecs = np.array(avecs, dtype=np.float32)
+        bvecs = np.array(bvecs, dtype=np.float32)
+        anorm = np.linalg.norm(avecs, axis=1, keepdims=True)
+        bnorm = np.linalg.norm(bvecs, axis=1, keepdims=True)
+        vtsim = (avecs / np.where(anorm == 0, 1, anorm)) @ (bvecs / np.where(bnorm == 0, 1, bnorm)).T
+        tksim = self.token_similarity_matrix(atkss, btkss)
+        # like hybrid_similarity, rows without any vector similarity fall back to the token similarity
+        sim = np.where(np.sum(vtsim, axis=1, keepdims=True) == 0, tksim, vtsim * vtweight + tksim * tkweight)
+        return sim, tksim, vtsim
+
     def token_similarity(self, atks, btkss):
-        def toDict(tks):
-            if isinstance(tks, str):
-                tks = tks.split()
-            d = defaultdict(int)
-            wts = self.tw.weights(tks, preprocess=False)
-            for i, (t, c) in enumerate(wts):
-                d[t] += c
-            return d
-
-        atks = toDict(atks)
-        btkss = [toDict(tks) for tks in btkss]
-        return [self.similarity(atks, btks) for btks in btkss]
+        return self.token_similarity_matrix([atks], btkss)[0].tolist()
+
+    def term_weight_matrix(self, tkss, vocab):
+        """
+        Sparse len(tkss) x len(vocab) matrix of normalized term weights, duplicated terms summed up,
+        which is what `weights` followed by summing per term gives. Terms out of `vocab` are added to it.
+        """
+        from scipy.sparse import csr_matrix
+        import numpy as np
+
+        tkss = [tks.split() if isinstance(tks, str) else tks for tks in tkss]
+        wts = self.tw.token_weights(set(t for tks in tkss for t in tks))
+        rows, cols, vals = [], [], []
+        for i, tks in enumerate(tkss):
+            S = sum(wts[t] for t in tks) or 1
+            for t in tks:
+                rows.append(i)
+                cols.append(vocab.setdefault(t, len(vocab)))
+                vals.append(wts[t] / S)
+        return csr_matrix((np.array(vals, dtype=float), (rows, cols)), shape=(len(tkss), len(vocab))), \
+            np.array([len(set(tks)) for tks in tkss], dtype=float)
+
+    def token_similarity_matrix(self, atkss, btkss):
+        """token_similarity of every `a` against every `b` in one sparse product, as a len(atkss) x len(btkss) matrix."""
+        import numpy as np
+
+        vocab = {}
+        A, _ = self.term_weight_matrix(atkss, vocab)
+        B, blen = self.term_weight_matrix(btkss, vocab)
+        A.resize((A.shape[0], len(vocab)))
+        s = (A @ B.T).toarray() + 1e-9
+        q = np.asarray(A.multiply(A).sum(axis=1)) + 1e-9
+        return np.sqrt(3. * (s / q / np.log10(blen + 512)))
 
     def similarity(self, qtwt, dtwt):
         if isinstance(dtwt, type("")):
@@ -15,17 +15,19 @@
 #
 
 import logging
-import copy
 import datrie
 import math
 import os
 import re
-import string
 import sys
+import threading
+from collections import defaultdict
+from cachetools import LRUCache
 from hanziconv import HanziConv
 from nltk import word_tokenize
 from nltk.stem import PorterStemmer, WordNetLemmatizer
 from api.utils.file_utils import get_project_base_directory
+from rag.nlp.huqie_dict import HuqieDict
 
 
 class RagTokenizer:
@@ -35,67 +37,113 @@ class RagTokenizer:
     def rkey_(self, line):
         return str(("DD" + (line[::-1].lower())).encode("utf-8"))[2:-1]
 
-    def loadDict_(self, fnm):
-        logging.info(f"[HUQIE]:Build trie from {fnm}")
-        try:
-            of = open(fnm, "r", encoding='utf-8')
-            while True:
-                line = of.readline()
-                if not line:
-                    break
+    def readDict_(self, fnm):
+        """Read a `word frequency tag` dictionary file into trie items."""
+        words = {}
+        with open(fnm, "r", encoding='utf-8') as of:
+            for line in of:
                 line = re.sub(r"[\r\n]+", "", line)
                 line = re.split(r"[ \t]", line)
+                if len(line) < 3:
+                    continue
                 k = self.key_(line[0])
                 F = int(math.log(float(line[1]) / self.DENOMINATOR) + .5)
-                if k not in self.trie_ or self.trie_[k][0] < F:
-                    self.trie_[self.key_(line[0])] = (F, line[2])
-                self.trie_[self.rkey_(line[0])] = 1
-
-            dict_file_cache = fnm + ".trie"
-            logging.info(f"[HUQIE]:Build trie cache to {dict_file_cache}")
-            self.trie_.save(dict_file_cache)
-            of.close()
+                if k not in words or words[k][0] < F:
+                    words[k] = (F, line[2])
+                words[self.rkey_(line[0])] = 1
+        return words.items()
+
+    def loadDict_(self, fnm):
+        logging.info(f"[HUQIE]:Add words from {fnm}")
+        try:
+            for k, v in self.readDict_(fnm):
+                if isinstance(v, tuple) and k in self.trie_ and self.trie_[k][0] >= v[0]:
+                    continue
+                self.trie_[k] = v
         except Exception:
-            logging.exception(f"[HUQIE]:Build trie {fnm} failed")
+            logging.exception(f"[HUQIE]:Add words from {fnm} failed")
+
+    def buildDict_(self, fnm):
+        """
+        Load the compiled snapshot of dictionary `fnm`, (re)compiling it from the legacy `.trie` cache
+        or from the text file when it's missing, of another version or older than its source.
+        """
+        legacy = fnm + ".trie"
+        source = legacy if os.path.exists(legacy) else fnm
+        # or compiled from the text file, the legacy one being unreadable
+        dic = HuqieDict.load(fnm, source) or (source == legacy and HuqieDict.load(fnm, fnm))
+        if dic:
+            return dic
+        items = None
+        if source == legacy:
+            try:
+                logging.info(f"[HUQIE]:Compile dictionary from {legacy}")
+                items = datrie.Trie.load(legacy).items()
+            except Exception:
+                logging.exception(f"[HUQIE]:Fail to load trie file {legacy}, compile the dictionary from {fnm}")
+        if not items:
+            source = fnm
+            try:
+                logging.info(f"[HUQIE]:Compile dictionary from {fnm}")
+                items = self.readDict_(fnm)
+            except Exception:
+                logging.exception(f"[HUQIE]:Build dictionary {fnm} failed")
+        if not items:
+            # never saved, the next process tries again
+            logging.error(f"[HUQIE]:No words read for dictionary {fnm}, tokenize without it")
+            return HuqieDict.compile(fnm, [], save=False)
+        return HuqieDict.compile(fnm, items, source)
+
+    @property
+    def trie_(self):
+        if self.dict_ is None:
+            with self.dict_lock_:
+                if self.dict_ is None:
+                    self.dict_ = self.buildDict_(self.DIR_ + ".txt")
+        return self.dict_
+
+    @trie_.setter
+    def trie_(self, dic):
+        self.dict_ = dic
+
+    @property
+    def stemmer(self):
+        if self.stemmer_ is None:
+            self.stemmer_ = PorterStemmer()
+        return self.stemmer_
+
+    @property
+    def lemmatizer(self):
+        if self.lemmatizer_ is None:
+            self.lemmatizer_ = WordNetLemmatizer()
+        return self.lemmatizer_
 
     def __init__(self, debug=False):
         self.DEBUG = debug
         self.DENOMINATOR = 1000000
         self.DIR_ = os.path.join(get_project_base_directory(), "rag/res", "huqie")
 
-        self.stemmer = PorterStemmer()
-        self.lemmatizer = WordNetLemmatizer()
+        # the dictionary and the NLTK models are loaded on first use
+        self.dict_ = None
+        self.dict_lock_ = threading.Lock()
+        self.stemmer_ = None
+        self.lemmatizer_ = None
 
         self.SPLIT_CHAR = r"([ ,\.<>/?;:'\[\]\\`!@#$%^&*\(\)\{\}\|_+=《》，。？、；‘’：“”【】~！￥%……（）——-]+|[a-zA-Z0-9,\.-]+)"
 
-        trie_file_name = self.DIR_ + ".txt.trie"
-        # check if trie file existence
-        if os.path.exists(trie_file_name):
-            try:
-                # load trie from file
-                self.trie_ = datrie.Trie.load(trie_file_name)
-                return
-            except Exception:
-                # fail to load trie from file, build default trie
-                logging.exception(f"[HUQIE]:Fail to load trie file {trie_file_name}, build the default trie file")
-                self.trie_ = datrie.Trie(string.printable)
-        else:
-            # file not exist, build default trie
-            logging.info(f"[HUQIE]:Trie file {trie_file_name} not found, build the default trie file")
-            self.trie_ = datrie.Trie(string.printable)
-
-        # load data from dict file and save to trie file
-        self.loadDict_(self.DIR_ + ".txt")
+        # segmentations keyed on normalized sentences and on coarse tokens
+        cache_size = int(os.environ.get("TOKENIZER_CACHE_SIZE", "65536"))
+        self.cache_lock_ = threading.Lock()
+        self.sentence_cache_ = LRUCache(maxsize=cache_size)
+        self.fine_grained_cache_ = LRUCache(maxsize=cache_size)
+        self.cache_hits_, self.cache_misses_ = 0, 0
 
     def loadUserDict(self, fnm):
-        try:
-            self.trie_ = datrie.Trie.load(fnm + ".trie")
-            return
-        except Exception:
-            self.trie_ = datrie.Trie(string.printable)
-        self.loadDict_(fnm)
+        self.clear_cache()
+        self.trie_ = self.buildDict_(fnm)
 
     def addUserDict(self, fnm):
+        self.clear_cache()
         self.loadDict_(fnm)
 
     def _strQ2B(self, ustring):
@@ -116,55 +164,63 @@ class RagTokenizer:
     def _tradi2simp(self, line):
         return HanziConv.toSimplified(line)
 
-    def dfs_(self, chars, s, preTks, tkslist):
-        res = s
-        if len(tkslist) >= 2048:
-            return res
-        # if s > MAX_L or s>= len(chars):
-        if s >= len(chars):
-            tkslist.append(preTks)
-            return res
-
-        # pruning
-        S = s + 1
-        if s + 2 <= len(chars):
-            t1, t2 = "".join(chars[s:s + 1]), "".join(chars[s:s + 2])
-            if self.trie_.has_keys_with_prefix(self.key_(t1)) and not self.trie_.has_keys_with_prefix(
-                    self.key_(t2)):
-                S = s + 2
-        if len(preTks) > 2 and len(
-                preTks[-1][0]) == 1 and len(preTks[-2][0]) == 1 and len(preTks[-3][0]) == 1:
-            t1 = preTks[-1][0] + "".join(chars[s:s + 1])
-            if self.trie_.has_keys_with_prefix(self.key_(t1)):
-                S = s + 2
-
-        ################
-        for e in range(S, len(chars) + 1):
-            t = "".join(chars[s:e])
-            k = self.key_(t)
-
-            if e > s + 1 and not self.trie_.has_keys_with_prefix(k):
-                break
-
-            if k in self.trie_:
-                pretks = copy.deepcopy(preTks)
-                if k in self.trie_:
-                    pretks.append((t, self.trie_[k]))
-                else:
-                    pretks.append((t, (-12, '')))
-                res = max(res, self.dfs_(chars, e, pretks, tkslist))
-
-        if res > s:
-            return res
-
-        t = "".join(chars[s:s + 1])
-        k = self.key_(t)
-        if k in self.trie_:
-            preTks.append((t, self.trie_[k]))
-        else:
-            preTks.append((t, (-12, '')))
+    def lattice_(self, chars):
+        """
+        Collect the dictionary words starting at every position of `chars` once.
+        A character no word starts with becomes a single-character arc with the unknown-word score.
+        """
+        trie = self.trie_
+        arcs = []
+        for s in range(len(chars)):
+            arc = []
+            for e in range(s + 1, len(chars) + 1):
+                t = chars[s:e]
+                k = self.key_(t)
+                if e > s + 1 and not trie.has_keys_with_prefix(k):
+                    break
+                v = trie.get(k)
+                if v is not None:
+                    arc.append((e, t, v))
+            if not arc:
+                arc.append((s + 1, chars[s], (-12, '')))
+            arcs.append(arc)
+        return arcs
+
+    def nbest_(self, chars, topn=1):
+        """
+        Viterbi search on the segmentation lattice, return the `topn` best segmentations ranked by `score_`.
+        `score_` is normalized by the number of tokens, so a state is (tokens so far, multi-character tokens so far)
+        at each position and only the `topn` best frequency sums survive per state.
+        """
+        arcs = self.lattice_(chars)
+        states = [defaultdict(list) for _ in range(len(chars) + 1)]
+        states[0][(0, 0)].append((0, None))
+        for s in range(len(chars)):
+            for (n, L), entries in states[s].items():
+                for e, t, (F, tag) in arcs[s]:
+                    bucket = states[e][(n + 1, L + (0 if len(t) < 2 else 1))]
+                    for rank, (f, _) in enumerate(entries):
+                        bucket.append((f + F, (s, (n, L), rank, t, (F, tag))))
+                    if len(bucket) > topn:
+                        bucket.sort(key=lambda x: x[0], reverse=True)
+                        del bucket[topn:]
 
-        return self.dfs_(chars, s + 1, preTks, tkslist)
+        B = 30
+        ends = []
+        for (n, L), entries in states[len(chars)].items():
+            for rank, (f, _) in enumerate(entries):
+                ends.append(((B + L) / n + f, (n, L), rank))
+        res = []
+        for _, key, rank in sorted(ends, key=lambda x: x[0], reverse=True)[:topn]:
+            tfts, e = [], len(chars)
+            while True:
+                _, bp = states[e][key][rank]
+                if bp is None:
+                    break
+                e, key, rank, t, fts = bp
+                tfts.append((t, fts))
+            res.append(self.score_(tfts[::-1]))
+        return res
 
     def freq(self, tk):
         k = self.key_(tk)
@@ -190,13 +246,6 @@ class RagTokenizer:
         logging.debug("[SC] {} {} {} {} {}".format(tks, len(tks), L, F, B / len(tks) + L + F))
         return tks, B / len(tks) + L + F
 
-    def sortTks_(self, tkslist):
-        res = []
-        for tfts in tkslist:
-            tks, s = self.score_(tfts)
-            res.append((tks, s))
-        return sorted(res, key=lambda x: x[1], reverse=True)
-
     def merge_(self, tks):
         # if split chars is part of token
         res = []
@@ -216,47 +265,43 @@ class RagTokenizer:
         return " ".join(res)
 
     def maxForward_(self, line):
+        trie = self.trie_
         res = []
         s = 0
         while s < len(line):
             e = s + 1
             t = line[s:e]
-            while e < len(line) and self.trie_.has_keys_with_prefix(
+            while e < len(line) and trie.has_keys_with_prefix(
                     self.key_(t)):
                 e += 1
                 t = line[s:e]
 
-            while e - 1 > s and self.key_(t) not in self.trie_:
+            while e - 1 > s and self.key_(t) not in trie:
                 e -= 1
                 t = line[s:e]
 
-            if self.key_(t) in self.trie_:
-                res.append((t, self.trie_[self.key_(t)]))
-            else:
-                res.append((t, (0, '')))
+            res.append((t, trie.get(self.key_(t), (0, ''))))
 
             s = e
 
         return self.score_(res)
 
     def maxBackward_(self, line):
+        trie = self.trie_
         res = []
         s = len(line) - 1
         while s >= 0:
             e = s + 1
             t = line[s:e]
-            while s > 0 and self.trie_.has_keys_with_prefix(self.rkey_(t)):
+            while s > 0 and trie.has_keys_with_prefix(self.rkey_(t)):
                 s -= 1
                 t = line[s:e]
 
-            while s + 1 < e and self.key_(t) not in self.trie_:
+            while s + 1 < e and self.key_(t) not in trie:
                 s += 1
                 t = line[s:e]
 
-            if self.key_(t) in self.trie_:
-                res.append((t, self.trie_[self.key_(t)]))
-            else:
-                res.append((t, (0, '')))
+            res.append((t, trie.get(self.key_(t), (0, ''))))
 
             s -= 1
 
@@ -288,6 +333,57 @@ class RagTokenizer:
             txt_lang_pairs.append((a[s: e], zh))
         return txt_lang_pairs
 
+    def segment_(self, L):
+        res = []
+        # use maxforward for the first time
+        tks, s = self.maxForward_(L)
+        tks1, s1 = self.maxBackward_(L)
+        if self.DEBUG:
+            logging.debug("[FW] {} {}".format(tks, s))
+            logging.debug("[BW] {} {}".format(tks1, s1))
+
+        i, j, _i, _j = 0, 0, 0, 0
+        same = 0
+        while i + same < len(tks1) and j + same < len(tks) and tks1[i + same] == tks[j + same]:
+            same += 1
+        if same > 0:
+            res.append(" ".join(tks[j: j + same]))
+        _i = i + same
+        _j = j + same
+        j = _j + 1
+        i = _i + 1
+
+        while i < len(tks1) and j < len(tks):
+            tk1, tk = "".join(tks1[_i:i]), "".join(tks[_j:j])
+            if tk1 != tk:
+                if len(tk1) > len(tk):
+                    j += 1
+                else:
+                    i += 1
+                continue
+
+            if tks1[i] != tks[j]:
+                i += 1
+                j += 1
+                continue
+            # backward tokens from_i to i are different from forward tokens from _j to j.
+            res.append(" ".join(self.nbest_("".join(tks[_j:j]))[0][0]))
+
+            same = 1
+            while i + same < len(tks1) and j + same < len(tks) and tks1[i + same] == tks[j + same]:
+                same += 1
+            res.append(" ".join(tks[j: j + same]))
+            _i = i + same
+            _j = j + same
+            j = _j + 1
+            i = _i + 1
+
+        if _i < len(tks1):
+            assert _j < len(tks)
+            assert "".join(tks1[_i:]) == "".join(tks[_j:])
+            res.append(" ".join(self.nbest_("".join(tks[_j:]))[0][0]))
+        return " ".join(res)
+
     def tokenize(self, line):
         line = re.sub(r"\W+", " ", line)
         line = self._strQ2B(line).lower()
@@ -297,64 +393,14 @@ class RagTokenizer:
         res = []
         for L,lang in arr:
             if not lang:
-                res.extend([self.stemmer.stem(self.lemmatizer.lemmatize(t)) for t in word_tokenize(L)])
+                res.append(self._cached_(self.sentence_cache_, (L, lang), lambda: " ".join(
+                    [self.stemmer.stem(self.lemmatizer.lemmatize(t)) for t in word_tokenize(L)])))
                 continue
             if len(L) < 2 or re.match(
                     r"[a-z\.-]+$", L) or re.match(r"[0-9\.-]+$", L):
                 res.append(L)
                 continue
-
-            # use maxforward for the first time
-            tks, s = self.maxForward_(L)
-            tks1, s1 = self.maxBackward_(L)
-            if self.DEBUG:
-                logging.debug("[FW] {} {}".format(tks, s))
-                logging.debug("[BW] {} {}".format(tks1, s1))
-
-            i, j, _i, _j = 0, 0, 0, 0
-            same = 0
-            while i + same < len(tks1) and j + same < len(tks) and tks1[i + same] == tks[j + same]:
-                same += 1
-            if same > 0:
-                res.append(" ".join(tks[j: j + same]))
-            _i = i + same
-            _j = j + same
-            j = _j + 1
-            i = _i + 1
-
-            while i < len(tks1) and j < len(tks):
-                tk1, tk = "".join(tks1[_i:i]), "".join(tks[_j:j])
-                if tk1 != tk:
-                    if len(tk1) > len(tk):
-                        j += 1
-                    else:
-                        i += 1
-                    continue
-
-                if tks1[i] != tks[j]:
-                    i += 1
-                    j += 1
-                    continue
-                # backward tokens from_i to i are different from forward tokens from _j to j.
-                tkslist = []
-                self.dfs_("".join(tks[_j:j]), 0, [], tkslist)
-                res.append(" ".join(self.sortTks_(tkslist)[0][0]))
-
-                same = 1
-                while i + same < len(tks1) and j + same < len(tks) and tks1[i + same] == tks[j + same]:
-                    same += 1
-                res.append(" ".join(tks[j: j + same]))
-                _i = i + same
-                _j = j + same
-                j = _j + 1
-                i = _i + 1
-
-            if _i < len(tks1):
-                assert _j < len(tks)
-                assert "".join(tks1[_i:]) == "".join(tks[_j:])
-                tkslist = []
-                self.dfs_("".join(tks[_j:]), 0, [], tkslist)
-                res.append(" ".join(self.sortTks_(tkslist)[0][0]))
+            res.append(self._cached_(self.sentence_cache_, (L, lang), lambda: self.segment_(L)))
 
         res = " ".join(res)
         logging.debug("[TKS] {}".format(self.merge_(res)))
@@ -374,32 +420,74 @@ class RagTokenizer:
             if len(tk) < 3 or re.match(r"[0-9,\.-]+$", tk):
                 res.append(tk)
                 continue
-            tkslist = []
             if len(tk) > 10:
-                tkslist.append(tk)
-            else:
-                self.dfs_(tk, 0, [], tkslist)
-            if len(tkslist) < 2:
                 res.append(tk)
                 continue
-            stk = self.sortTks_(tkslist)[1][0]
-            if len(stk) == len(tk):
-                stk = tk
-            else:
-                if re.match(r"[a-z\.-]+$", tk):
-                    for t in stk:
-                        if len(t) < 3:
-                            stk = tk
-                            break
-                    else:
-                        stk = " ".join(stk)
-                else:
-                    stk = " ".join(stk)
-
-            res.append(stk)
+            res.append(self._cached_(self.fine_grained_cache_, tk, lambda: self.fine_grained_segment_(tk)))
 
         return " ".join(self.english_normalize_(res))
 
+    def fine_grained_segment_(self, tk):
+        tkslist = self.nbest_(tk, 2)
+        if len(tkslist) < 2:
+            return tk
+        stk = tkslist[1][0]
+        if len(stk) == len(tk):
+            return tk
+        if re.match(r"[a-z\.-]+$", tk):
+            for t in stk:
+                if len(t) < 3:
+                    return tk
+        return " ".join(stk)
+
+    def tokenize_batch(self, lines):
+        """
+        Tokenize a batch of lines. Each distinct line is tokenized once and the segmentation of
+        every sentence is shared with other lines through the LRU cache.
+        """
+        uniq = {}
+        for line in lines:
+            if line not in uniq:
+                uniq[line] = self.tokenize(line)
+        return [uniq[line] for line in lines]
+
+    def fine_grained_tokenize_batch(self, tkss):
+        uniq = {}
+        for tks in tkss:
+            if tks not in uniq:
+                uniq[tks] = self.fine_grained_tokenize(tks)
+        return [uniq[tks] for tks in tkss]
+
+    def _cached_(self, cache, key, func):
+        with self.cache_lock_:
+            v = cache.get(key)
+            if v is not None:
+                self.cache_hits_ += 1
+                return v
+            self.cache_misses_ += 1
+        v = func()
+        with self.cache_lock_:
+            cache[key] = v
+        return v
+
+    def clear_cache(self):
+        with self.cache_lock_:
+            self.sentence_cache_.clear()
+            self.fine_grained_cache_.clear()
+            self.cache_hits_, self.cache_misses_ = 0, 0
+
+    def cache_info(self):
+        with self.cache_lock_:
+            total = self.cache_hits_ + self.cache_misses_
+            return {
+                "hits": self.cache_hits_,
+                "misses": self.cache_misses_,
+                "hit_rate": self.cache_hits_ / total if total else 0.,
+                "sentences": len(self.sentence_cache_),
+                "tokens": len(self.fine_grained_cache_),
+                "maxsize": self.sentence_cache_.maxsize,
+            }
+
 
 def is_chinese(s):
     if s >= u'\u4e00' and s <= u'\u9fa5':
@@ -436,6 +524,9 @@ def naiveQie(txt):
 tokenizer = RagTokenizer()
 tokenize = tokenizer.tokenize
 fine_grained_tokenize = tokenizer.fine_grained_tokenize
+tokenize_batch = tokenizer.tokenize_batch
+fine_grained_tokenize_batch = tokenizer.fine_grained_tokenize_batch
+cache_info = tokenizer.cache_info
 tag = tokenizer.tag
 freq = tokenizer.freq
 loadUserDict = tokenizer.loadUserDict
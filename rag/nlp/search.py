@@ -15,9 +15,12 @@
 #
 import logging
 import re
+import threading
 from collections import OrderedDict
 from dataclasses import dataclass
 
+from cachetools import LRUCache
+
 from rag.settings import TAG_FLD, PAGERANK_FLD
 from rag.utils import rmSpace, get_float
 from rag.nlp import rag_tokenizer, query
@@ -32,6 +35,9 @@ class Dealer:
     def __init__(self, dataStore: DocStoreConnection):
         self.qryr = query.FulltextQueryer()
         self.dataStore = dataStore
+        # embeddings of answer pieces for insert_citations, keyed on (model, piece)
+        self.citation_vec_cache = LRUCache(maxsize=4096)
+        self.citation_vec_cache_lock = threading.Lock()
 
     @dataclass
     class SearchResult:
@@ -202,7 +208,7 @@ class Dealer:
         if not pieces_:
             return answer, set([])
 
-        ans_v, _ = embd_mdl.encode(pieces_)
+        ans_v = self.encode_pieces(embd_mdl, pieces_)
         for i in range(len(chunk_v)):
             if len(ans_v[0]) != len(chunk_v[i]):
                 chunk_v[i] = [0.0]*len(ans_v[0])
@@ -211,24 +217,20 @@ class Dealer:
         assert len(ans_v[0]) == len(chunk_v[0]), "The dimension of query and chunk do not match: {} vs. {}".format(
             len(ans_v[0]), len(chunk_v[0]))
 
-        chunks_tks = [rag_tokenizer.tokenize(self.qryr.rmWWW(ck)).split()
-                      for ck in chunks]
+        chunks_tks = [tks.split() for tks in rag_tokenizer.tokenize_batch([self.qryr.rmWWW(ck) for ck in chunks])]
+        pieces_tks = [tks.split() for tks in rag_tokenizer.tokenize_batch([self.qryr.rmWWW(p) for p in pieces_])]
+        # pieces x chunks, computed once for all the thresholds
+        sim, _, _ = self.qryr.hybrid_similarity_matrix(ans_v, chunk_v, pieces_tks, chunks_tks, tkweight, vtweight)
+        mxs = np.max(sim, axis=1) * 0.99
         cites = {}
         thr = 0.63
         while thr > 0.3 and len(cites.keys()) == 0 and pieces_ and chunks_tks:
             for i, a in enumerate(pieces_):
-                sim, tksim, vtsim = self.qryr.hybrid_similarity(ans_v[i],
-                                                                chunk_v,
-                                                                rag_tokenizer.tokenize(
-                                                                    self.qryr.rmWWW(pieces_[i])).split(),
-                                                                chunks_tks,
-                                                                tkweight, vtweight)
-                mx = np.max(sim) * 0.99
+                mx = mxs[i]
                 logging.debug("{} SIM: {}".format(pieces_[i], mx))
                 if mx < thr:
                     continue
-                cites[idx[i]] = list(
-                    set([str(ii) for ii in range(len(chunk_v)) if sim[ii] > mx]))[:4]
+                cites[idx[i]] = [str(ii) for ii in np.flatnonzero(sim[i] > mx)][:4]
             thr *= 0.8
 
         res = ""
@@ -249,6 +251,21 @@ class Dealer:
 
         return res, seted
 
+    def encode_pieces(self, embd_mdl, pieces):
+        """Embed answer pieces in one batch, reusing the vectors of pieces seen before with the same model."""
+        mdl = (getattr(embd_mdl, "tenant_id", None), getattr(embd_mdl, "llm_name", None))
+        with self.citation_vec_cache_lock:
+            vecs = [self.citation_vec_cache.get((mdl, p)) for p in pieces]
+        missing = list(OrderedDict.fromkeys(p for p, v in zip(pieces, vecs) if v is None))
+        if missing:
+            encoded, _ = embd_mdl.encode(missing)
+            encoded = dict(zip(missing, encoded))
+            with self.citation_vec_cache_lock:
+                for p, v in encoded.items():
+                    self.citation_vec_cache[(mdl, p)] = v
+            vecs = [encoded[p] if v is None else v for p, v in zip(pieces, vecs)]
+        return vecs
+
     def _rank_feature_scores(self, query_rfea, search_res):
         ## For rank feature(tag_fea) scores.
         rank_fea = []
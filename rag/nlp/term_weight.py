@@ -19,7 +19,9 @@ import math
 import json
 import re
 import os
+import threading
 import numpy as np
+from cachetools import LRUCache
 from rag.nlp import rag_tokenizer
 from api.utils.file_utils import get_project_base_directory
 
@@ -89,6 +91,9 @@ class Dealer:
         except Exception:
             logging.warning("Load term.freq FAIL!")
 
+        self.token_weight_cache = LRUCache(maxsize=int(os.environ.get("TOKEN_WEIGHT_CACHE_SIZE", "262144")))
+        self.token_weight_cache_lock = threading.Lock()
+
     def pretoken(self, txt, num=False, stpwd=True):
         patt = [
             r"[~—\t @#%!<>,\.\?\":;'\{\}\[\]_=\(\)\|，。？》•●○↓《；‘’：“”【¥ 】…￥！、·（）×`&\\/「」\\]"
@@ -159,7 +164,7 @@ class Dealer:
                 tks.append(t)
         return tks
 
-    def weights(self, tks, preprocess=True):
+    def raw_weights_(self, tt):
         def skill(t):
             if t not in self.sk:
                 return 1
@@ -222,23 +227,38 @@ class Dealer:
 
         def idf(s, N): return math.log10(10 + ((N - s + 0.5) / (s + 0.5)))
 
+        idf1 = np.array([idf(freq(t), 10000000) for t in tt])
+        idf2 = np.array([idf(df(t), 1000000000) for t in tt])
+        return (0.3 * idf1 + 0.7 * idf2) * \
+            np.array([ner(t) * postag(t) for t in tt])
+
+    def weights(self, tks, preprocess=True):
         tw = []
         if not preprocess:
-            idf1 = np.array([idf(freq(t), 10000000) for t in tks])
-            idf2 = np.array([idf(df(t), 1000000000) for t in tks])
-            wts = (0.3 * idf1 + 0.7 * idf2) * \
-                np.array([ner(t) * postag(t) for t in tks])
+            wts = self.raw_weights_(tks)
             wts = [s for s in wts]
             tw = list(zip(tks, wts))
         else:
             for tk in tks:
                 tt = self.tokenMerge(self.pretoken(tk, True))
-                idf1 = np.array([idf(freq(t), 10000000) for t in tt])
-                idf2 = np.array([idf(df(t), 1000000000) for t in tt])
-                wts = (0.3 * idf1 + 0.7 * idf2) * \
-                    np.array([ner(t) * postag(t) for t in tt])
+                wts = self.raw_weights_(tt)
                 wts = [s for s in wts]
                 tw.extend(zip(tt, wts))
 
         S = np.sum([s for _, s in tw])
         return [(t, s / S) for t, s in tw]
+
+    def token_weights(self, tks):
+        """
+        Unnormalized weights of tokens, memoized per token.
+        `weights(tks, preprocess=False)` equals these divided by their sum.
+        """
+        with self.token_weight_cache_lock:
+            res = {t: self.token_weight_cache.get(t) for t in tks}
+        missing = [t for t, w in res.items() if w is None]
+        if missing:
+            wts = self.raw_weights_(missing)
+            with self.token_weight_cache_lock:
+                for t, w in zip(missing, wts):
+                    self.token_weight_cache[t] = res[t] = float(w)
+        return res
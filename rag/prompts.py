@@ -24,7 +24,7 @@ import json_repair
 from api import settings
 from api.db import LLMType
 from rag.settings import TAG_FLD
-from rag.utils import encoder, num_tokens_from_string
+from rag.utils import encoder, num_tokens_from_string_cached
 
 
 def chunks_format(reference):
@@ -61,7 +61,7 @@ def message_fit_in(msg, max_length=4000):
         tks_cnts = []
         for m in msg:
             tks_cnts.append(
-                {"role": m["role"], "count": num_tokens_from_string(m["content"])})
+                {"role": m["role"], "count": num_tokens_from_string_cached(m["content"])})
         total = 0
         for m in tks_cnts:
             total += m["count"]
@@ -79,8 +79,8 @@ def message_fit_in(msg, max_length=4000):
     if c < max_length:
         return c, msg
 
-    ll = num_tokens_from_string(msg_[0]["content"])
-    ll2 = num_tokens_from_string(msg_[-1]["content"])
+    ll = num_tokens_from_string_cached(msg_[0]["content"])
+    ll2 = num_tokens_from_string_cached(msg_[-1]["content"])
     if ll / (ll + ll2) > 0.8:
         m = msg_[0]["content"]
         m = encoder.decode(encoder.encode(m)[:max_length - ll2])
@@ -100,7 +100,7 @@ def kb_prompt(kbinfos, max_tokens):
     used_token_count = 0
     chunks_num = 0
     for i, c in enumerate(knowledges):
-        used_token_count += num_tokens_from_string(c)
+        used_token_count += num_tokens_from_string_cached(c)
         chunks_num += 1
         if max_tokens * 0.97 < used_token_count:
             knowledges = knowledges[:i]
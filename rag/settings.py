@@ -27,6 +27,7 @@ DOC_ENGINE = os.getenv('DOC_ENGINE', 'elasticsearch')
 
 ES = {}
 INFINITY = {}
+EMBEDDED = {}
 AZURE = {}
 S3 = {}
 MINIO = {}
@@ -37,6 +38,8 @@ if DOC_ENGINE == 'elasticsearch':
     ES = get_base_config("es", {})
 elif DOC_ENGINE == 'infinity':
     INFINITY = get_base_config("infinity", {"uri": "infinity:23817"})
+elif DOC_ENGINE == 'embedded':
+    EMBEDDED = get_base_config("embedded", {"path": os.path.join(get_project_base_directory(), "data", "doc_store")})
 
 if STORAGE_IMPL_TYPE in ['AZURE_SPN', 'AZURE_SAS']:
     AZURE = get_base_config("azure", {})
@@ -53,9 +56,19 @@ except Exception:
     REDIS = {}
     pass
 DOC_MAXIMUM_SIZE = int(os.environ.get("MAX_CONTENT_LENGTH", 128 * 1024 * 1024))
+# chunks handed to docStoreConn.insert at a time, the connection splits them into requests by itself
+DOC_BULK_SIZE = int(os.environ.get("DOC_BULK_SIZE", 256))
 
 SVR_QUEUE_NAME = "rag_flow_svr_queue"
 SVR_CONSUMER_GROUP_NAME = "rag_flow_svr_task_broker"
+# highest first
+SVR_QUEUE_PRIORITIES = [1, 0]
+# task progress events, folded into the documents by the server holding the update_progress lock
+DOC_PROGRESS_QUEUE_NAME = "rag_flow_doc_progress"
+# older events are trimmed when no server consumes them, the periodic sweep catches up on those
+DOC_PROGRESS_QUEUE_MAXLEN = 100000
+# ids of the documents whose parsing was canceled, published for the executors running their tasks
+TASK_CANCEL_CHANNEL = "rag_flow_task_cancel"
 PAGERANK_FLD = "pagerank_fea"
 TAG_FLD = "tag_feas"
 
@@ -78,4 +91,4 @@ def get_svr_queue_name(priority: int) -> str:
     return f"{SVR_QUEUE_NAME}_{priority}"
 
 def get_svr_queue_names():
-    return [get_svr_queue_name(priority) for priority in [1, 0]]
+    return [get_svr_queue_name(priority) for priority in SVR_QUEUE_PRIORITIES]
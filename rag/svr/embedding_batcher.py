@@ -0,0 +1,190 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import logging
+import os
+from collections import OrderedDict
+from timeit import default_timer as timer
+
+import numpy as np
+import trio
+
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", "16"))
+EMBEDDING_MAX_BATCH_SIZE = int(os.environ.get("EMBEDDING_MAX_BATCH_SIZE", "128"))
+# seconds a partial batch waits for texts of other tasks
+EMBEDDING_BATCH_WAIT = float(os.environ.get("EMBEDDING_BATCH_WAIT", "0.05"))
+# batches slower than this shrink, batches faster than half of it grow
+EMBEDDING_BATCH_LATENCY = float(os.environ.get("EMBEDDING_BATCH_LATENCY", "10"))
+EMBEDDING_MAX_PENDING = int(os.environ.get("EMBEDDING_MAX_PENDING", "1024"))
+EMBEDDING_MAX_INFLIGHT_BATCHES = int(os.environ.get("EMBEDDING_MAX_INFLIGHT_BATCHES", "2"))
+# batchers of models nobody embeds with at the moment are dropped beyond this
+EMBEDDING_MAX_BATCHERS = int(os.environ.get("EMBEDDING_MAX_BATCHERS", "64"))
+
+
+class EmbeddingRequest:
+    def __init__(self, text, mdl, caller):
+        self.text = text
+        # the model of the caller, whose key, base url and trace are used for its batches
+        self.mdl = mdl
+        self.caller = caller
+        self.vector = None
+        self.token_count = 0
+        self.error = None
+        self.done = trio.Event()
+
+
+class EmbeddingBatcher:
+    """
+    Coalesces the texts the tasks of this executor embed with the same model into full batches.
+
+    There's no background task: a caller whose texts are still queued after `EMBEDDING_BATCH_WAIT`,
+    or who finds a full batch in the queue, sends the head of the queue to the model for everyone.
+    A batch the model fails is retried caller by caller, so that only the callers whose texts fail get the error.
+    At most `EMBEDDING_MAX_PENDING` texts wait at a time, further callers block until batches finish.
+    The batch size moves between `EMBEDDING_BATCH_SIZE` and `EMBEDDING_MAX_BATCH_SIZE` in steps of the
+    former, following the latency of full batches.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.batch_size = EMBEDDING_BATCH_SIZE
+        self.queue: list[EmbeddingRequest] = []
+        self.slots = trio.Semaphore(EMBEDDING_MAX_PENDING)
+        self.limiter = trio.CapacityLimiter(EMBEDDING_MAX_INFLIGHT_BATCHES)
+        self.callers = 0
+        self.batches, self.texts = 0, 0
+
+    async def encode(self, mdl, texts: list[str]) -> tuple[np.ndarray, int]:
+        """Same as mdl.encode, the token count of a shared batch is split by text length."""
+        caller = object()
+        reqs = [EmbeddingRequest(t, mdl, caller) for t in texts]
+        self.callers += 1
+        try:
+            for r in reqs:
+                while True:
+                    if self.slots.value == 0 and len(self.queue) >= self.batch_size:
+                        await self._flush(caller)
+                        continue
+                    with trio.move_on_after(EMBEDDING_BATCH_WAIT):
+                        await self.slots.acquire()
+                        break
+                    # the queue may hold only texts of this caller, nobody else would flush them
+                    if self.queue:
+                        await self._flush(caller)
+                self.queue.append(r)
+
+            for r in reqs:
+                while not r.done.is_set():
+                    if len(self.queue) >= self.batch_size:
+                        await self._flush(caller)
+                        continue
+                    with trio.move_on_after(EMBEDDING_BATCH_WAIT):
+                        await r.done.wait()
+                    if not r.done.is_set() and r in self.queue:
+                        await self._flush(caller)
+                if r.error:
+                    raise r.error
+        finally:
+            self.callers -= 1
+            # the texts of a caller who failed or was canceled aren't worth embedding anymore
+            queued = [r for r in self.queue if r.caller is caller]
+            if queued:
+                self.queue = [r for r in self.queue if r.caller is not caller]
+                for _ in queued:
+                    self.slots.release()
+
+        return np.array([r.vector for r in reqs]), int(round(sum(r.token_count for r in reqs)))
+
+    async def _flush(self, caller):
+        batch = self.queue[:self.batch_size]
+        del self.queue[:len(batch)]
+        if not batch:
+            return
+        try:
+            async with self.limiter:
+                st = timer()
+                try:
+                    await trio.to_thread.run_sync(lambda: self._encode(batch))
+                    self._adapt(len(batch), timer() - st)
+                    self.batches += 1
+                    self.texts += len(batch)
+                except Exception as e:
+                    callers = list(dict.fromkeys(r.caller for r in batch))
+                    if len(callers) == 1:
+                        for r in batch:
+                            r.error = e
+                        return
+                    logging.warning(f"Embedding batch of {self.name} failed, retrying it caller by caller: {e}")
+                    for c in callers:
+                        reqs = [r for r in batch if r.caller is c]
+                        try:
+                            await trio.to_thread.run_sync(lambda: self._encode(reqs))
+                        except Exception as e:
+                            for r in reqs:
+                                r.error = e
+        finally:
+            # texts of other callers go back to the queue if this one was canceled before they were embedded
+            interrupted = [r for r in batch if r.vector is None and r.error is None and r.caller is not caller]
+            self.queue[:0] = interrupted
+            for r in batch:
+                if r in interrupted:
+                    continue
+                if r.vector is None and r.error is None:
+                    r.error = RuntimeError("Embedding batch was interrupted.")
+                r.done.set()
+                self.slots.release()
+
+    @staticmethod
+    def _encode(batch: list[EmbeddingRequest]):
+        vts, c = batch[0].mdl.encode([r.text for r in batch])
+        if len(vts) != len(batch):
+            raise ValueError(f"Embedding model returned {len(vts)} vectors for {len(batch)} texts.")
+        total = sum(len(r.text) for r in batch) or 1
+        for r, v in zip(batch, vts):
+            r.vector = v
+            r.token_count = c * len(r.text) / total
+
+    def _adapt(self, n, elapsed):
+        # a partial batch says nothing about what the model can take
+        if n < self.batch_size:
+            return
+        if elapsed > EMBEDDING_BATCH_LATENCY:
+            self.batch_size = max(EMBEDDING_BATCH_SIZE, self.batch_size // 2 // EMBEDDING_BATCH_SIZE * EMBEDDING_BATCH_SIZE)
+        elif elapsed < EMBEDDING_BATCH_LATENCY / 2:
+            self.batch_size = min(EMBEDDING_MAX_BATCH_SIZE, self.batch_size + EMBEDDING_BATCH_SIZE)
+        else:
+            return
+        logging.debug(f"Embedding batch size of {self.name} -> {self.batch_size}, last batch took {elapsed:.2f}s")
+
+    def idle(self):
+        return not self.callers and not self.queue
+
+    def stats(self):
+        return {"batch_size": self.batch_size, "batches": self.batches, "average_batch": self.texts / self.batches if self.batches else 0, "queued": len(self.queue)}
+
+
+BATCHERS: OrderedDict[tuple, EmbeddingBatcher] = OrderedDict()
+
+
+def get_embedding_batcher(mdl) -> EmbeddingBatcher:
+    """The batcher shared by the tasks embedding with the same tenant's model, which they pass to encode()."""
+    key = (mdl.tenant_id, mdl.embedding_cache_key())
+    if key in BATCHERS:
+        BATCHERS.move_to_end(key)
+        return BATCHERS[key]
+    for k in [k for k, b in BATCHERS.items() if b.idle()][:max(0, len(BATCHERS) + 1 - EMBEDDING_MAX_BATCHERS)]:
+        del BATCHERS[k]
+    BATCHERS[key] = EmbeddingBatcher(f"{mdl.tenant_id}/{mdl.llm_name}")
+    return BATCHERS[key]
@@ -31,6 +31,7 @@ import json
 import xxhash
 import copy
 import re
+from collections import defaultdict, deque
 from functools import partial
 from io import BytesIO
 from multiprocessing.context import TimeoutError
@@ -55,10 +56,15 @@ from api.db.db_models import close_connection
 from rag.app import laws, paper, presentation, manual, qa, table, book, resume, picture, naive, one, audio, \
     email, tag
 from rag.nlp import search, rag_tokenizer
+from deepdoc.vision.ocr import model_stats
 from rag.raptor import RecursiveAbstractiveProcessing4TreeOrganizedRetrieval as Raptor
-from rag.settings import DOC_MAXIMUM_SIZE, SVR_CONSUMER_GROUP_NAME, get_svr_queue_name, get_svr_queue_names, print_rag_settings, TAG_FLD, PAGERANK_FLD
+from rag.svr.embedding_batcher import get_embedding_batcher
+from rag.svr.task_progress import CANCEL_FLAGS, PROGRESS_FLUSH_INTERVAL, PROGRESS_SINK
+from rag.settings import DOC_MAXIMUM_SIZE, DOC_BULK_SIZE, SVR_CONSUMER_GROUP_NAME, get_svr_queue_name, get_svr_queue_names, print_rag_settings, TAG_FLD, PAGERANK_FLD
 from rag.utils import num_tokens_from_string, truncate
-from rag.utils.redis_conn import REDIS_CONN
+from rag.utils.page_cache import PAGE_ANALYSIS_CACHE
+from rag.utils.redis_conn import REDIS_CONN, RedisDistributedLock
+from rag.utils.task_scheduler import TASK_SCHEDULER
 from rag.utils.storage_factory import STORAGE_IMPL
 from graphrag.utils import chat_limiter
 
@@ -84,6 +90,10 @@ FACTORY = {
 }
 
 UNACKED_ITERATOR = None
+# messages of the tasks this executor holds, by id
+LEASED_MSGS = {}
+# messages taken over from other executors, waiting for a free slot
+PREFETCHED_MSGS = deque()
 
 CONSUMER_NO = "0" if len(sys.argv) < 2 else sys.argv[1]
 CONSUMER_NAME = "task_executor_" + CONSUMER_NO
@@ -98,6 +108,9 @@ CURRENT_TASKS = {}
 MAX_CONCURRENT_TASKS = int(os.environ.get('MAX_CONCURRENT_TASKS', "5"))
 MAX_CONCURRENT_CHUNK_BUILDERS = int(os.environ.get('MAX_CONCURRENT_CHUNK_BUILDERS', "1"))
 task_limiter = trio.CapacityLimiter(MAX_CONCURRENT_TASKS)
+# seconds the message of a task stays with this executor unless renewed, other executors take it over afterwards
+TASK_LEASE = int(os.environ.get('TASK_LEASE', "600"))
+TASK_QUEUE_BLOCK_MS = 1000
 chunk_limiter = trio.CapacityLimiter(MAX_CONCURRENT_CHUNK_BUILDERS)
 
 
@@ -142,7 +155,8 @@ def set_progress(task_id, from_page=0, to_page=-1, prog=None, msg="Processing...
     try:
         if prog is not None and prog < 0:
             msg = "[ERROR]" + msg
-        cancel = TaskService.do_cancel(task_id)
+        task = CURRENT_TASKS.get(task_id)
+        cancel = CANCEL_FLAGS.is_canceled(task_id, task["doc_id"] if task else None)
 
         if cancel:
             msg += " [Canceled]"
@@ -154,11 +168,7 @@ def set_progress(task_id, from_page=0, to_page=-1, prog=None, msg="Processing...
                     msg = f"Page({from_page + 1}~{to_page + 1}): " + msg
         if msg:
             msg = datetime.now().strftime("%H:%M:%S") + " " + msg
-        d = {"progress_msg": msg}
-        if prog is not None:
-            d["progress"] = prog
-
-        TaskService.update_progress(task_id, d)
+        PROGRESS_SINK.put(task_id, prog, msg, force=cancel)
 
         close_connection()
         if cancel:
@@ -169,45 +179,108 @@ def set_progress(task_id, from_page=0, to_page=-1, prog=None, msg="Processing...
     except Exception:
         logging.exception(f"set_progress({task_id}), progress: {prog}, progress_msg: {msg}, got exception")
 
-async def collect():
+async def collect(count):
+    """
+    Up to `count` tasks with their messages: those taken over from other executors first, then those
+    this executor left unacked, then new ones in the order of priority, `count` at a time.
+    """
     global CONSUMER_NAME, DONE_TASKS, FAILED_TASKS
     global UNACKED_ITERATOR
     svr_queue_names = get_svr_queue_names()
+    redis_msgs = []
+    while PREFETCHED_MSGS and len(redis_msgs) < count:
+        redis_msgs.append(PREFETCHED_MSGS.popleft())
     try:
         if not UNACKED_ITERATOR:
             UNACKED_ITERATOR = REDIS_CONN.get_unacked_iterator(svr_queue_names, SVR_CONSUMER_GROUP_NAME, CONSUMER_NAME)
-        try:
-            redis_msg = next(UNACKED_ITERATOR)
-        except StopIteration:
-            for svr_queue_name in svr_queue_names:
-                redis_msg = REDIS_CONN.queue_consumer(svr_queue_name, SVR_CONSUMER_GROUP_NAME, CONSUMER_NAME)
-                if redis_msg:
-                    break
+        while len(redis_msgs) < count:
+            redis_msg = next(UNACKED_ITERATOR, None)
+            if not redis_msg:
+                break
+            if redis_msg.get_msg_id() not in LEASED_MSGS:
+                redis_msgs.append(redis_msg)
+        for i, svr_queue_name in enumerate(svr_queue_names):
+            if len(redis_msgs) >= count:
+                break
+            # only wait on the last queue, and only if there's nothing to do
+            block = TASK_QUEUE_BLOCK_MS if i == len(svr_queue_names) - 1 and not redis_msgs else None
+            fetched = await trio.to_thread.run_sync(REDIS_CONN.queue_consumer_batch, svr_queue_name, SVR_CONSUMER_GROUP_NAME,
+                                                    CONSUMER_NAME, count - len(redis_msgs), block)
+            if fetched is None and not redis_msgs:
+                await trio.sleep(5)
+            redis_msgs.extend(fetched or [])
     except Exception:
         logging.exception("collect got exception")
-        return None, None
-
-    if not redis_msg:
-        return None, None
-    msg = redis_msg.get_message()
-    if not msg:
-        logging.error(f"collect got empty message of {redis_msg.get_msg_id()}")
-        redis_msg.ack()
-        return None, None
-
-    canceled = False
-    task = TaskService.get_task(msg["id"])
-    if task:
-        _, doc = DocumentService.get_by_id(task["doc_id"])
-        canceled = doc.run == TaskStatus.CANCEL.value or doc.progress < 0
-    if not task or canceled:
-        state = "is unknown" if not task else "has been cancelled"
-        FAILED_TASKS += 1
-        logging.warning(f"collect task {msg['id']} {state}")
-        redis_msg.ack()
-        return None, None
-    task["task_type"] = msg.get("task_type", "")
-    return redis_msg, task
+
+    tasks = []
+    unwanted = defaultdict(list)
+    for redis_msg in redis_msgs:
+        LEASED_MSGS[redis_msg.get_msg_id()] = redis_msg
+        msg = redis_msg.get_message()
+        if not msg:
+            logging.error(f"collect got empty message of {redis_msg.get_msg_id()}")
+            unwanted[redis_msg.get_queue_name()].append(redis_msg.get_msg_id())
+            continue
+
+        canceled = False
+        task = TaskService.get_task(msg["id"])
+        if task:
+            _, doc = DocumentService.get_by_id(task["doc_id"])
+            canceled = doc.run == TaskStatus.CANCEL.value or doc.progress < 0
+        if not task or canceled:
+            state = "is unknown" if not task else "has been cancelled"
+            FAILED_TASKS += 1
+            logging.warning(f"collect task {msg['id']} {state}")
+            unwanted[redis_msg.get_queue_name()].append(redis_msg.get_msg_id())
+            continue
+        task["task_type"] = msg.get("task_type", "")
+        tasks.append((redis_msg, task))
+    for queue_name, msg_ids in unwanted.items():
+        REDIS_CONN.queue_ack(queue_name, SVR_CONSUMER_GROUP_NAME, msg_ids)
+        for msg_id in msg_ids:
+            TASK_SCHEDULER.finished(LEASED_MSGS.pop(msg_id).get_message())
+    return tasks
+
+
+async def renew_leases():
+    """
+    Keep the messages of the tasks this executor holds from being taken over by other executors, and take over,
+    as far as there are free slots, those which other executors haven't renewed for TASK_LEASE seconds.
+    """
+    while True:
+        await trio.sleep(TASK_LEASE / 3)
+        try:
+            leased = defaultdict(list)
+            for redis_msg in list(LEASED_MSGS.values()):
+                leased[redis_msg.get_queue_name()].append(redis_msg.get_msg_id())
+            for queue_name, msg_ids in leased.items():
+                owned = await trio.to_thread.run_sync(REDIS_CONN.queue_renew, queue_name, SVR_CONSUMER_GROUP_NAME,
+                                                      CONSUMER_NAME, msg_ids)
+                if owned is None:
+                    continue
+                for msg_id in set(msg_ids) - owned:
+                    # Another executor has taken the message over: stop renewing it and don't start it here.
+                    logging.warning(f"renew_leases lost message {msg_id} of {queue_name} to another executor")
+                    redis_msg = LEASED_MSGS.pop(msg_id, None)
+                    if redis_msg in PREFETCHED_MSGS:
+                        PREFETCHED_MSGS.remove(redis_msg)
+            await trio.to_thread.run_sync(TASK_SCHEDULER.renew, [redis_msg.get_message() for redis_msg in LEASED_MSGS.values()])
+
+            free = MAX_CONCURRENT_TASKS - len(CURRENT_TASKS) - len(PREFETCHED_MSGS)
+            for queue_name in get_svr_queue_names():
+                if free <= 0:
+                    break
+                claimed = await trio.to_thread.run_sync(REDIS_CONN.queue_autoclaim, queue_name, SVR_CONSUMER_GROUP_NAME,
+                                                        CONSUMER_NAME, TASK_LEASE * 1000, free)
+                for redis_msg in claimed:
+                    if redis_msg.get_msg_id() in LEASED_MSGS:
+                        continue
+                    logging.warning(f"renew_leases took over message {redis_msg.get_msg_id()} of {queue_name}")
+                    LEASED_MSGS[redis_msg.get_msg_id()] = redis_msg
+                    PREFETCHED_MSGS.append(redis_msg)
+                    free -= 1
+        except Exception:
+            logging.exception("renew_leases got exception")
 
 
 async def get_storage_binary(bucket, name):
@@ -240,11 +313,13 @@ async def build_chunks(task, progress_callback):
         raise
 
     try:
+        # the page analysis cache entries of the document go when it is deleted
         async with chunk_limiter:
-            cks = await trio.to_thread.run_sync(lambda: chunker.chunk(task["name"], binary=binary, from_page=task["from_page"],
-                                to_page=task["to_page"], lang=task["language"], callback=progress_callback,
-                                kb_id=task["kb_id"], parser_config=task["parser_config"], tenant_id=task["tenant_id"]))
-        logging.info("Chunking({}) {}/{} done".format(timer() - st, task["location"], task["name"]))
+            with PAGE_ANALYSIS_CACHE.for_doc(task["doc_id"]):
+                cks = await trio.to_thread.run_sync(lambda: chunker.chunk(task["name"], binary=binary, from_page=task["from_page"],
+                                    to_page=task["to_page"], lang=task["language"], callback=progress_callback,
+                                    kb_id=task["kb_id"], parser_config=task["parser_config"], tenant_id=task["tenant_id"]))
+        logging.info("Chunking({}) {}/{} done, tokenizer cache: {}".format(timer() - st, task["location"], task["name"], rag_tokenizer.cache_info()))
     except TaskCanceledException:
         raise
     except Exception as e:
@@ -396,22 +471,30 @@ async def embedding(docs, mdl, parser_config=None, callback=None):
             c = "None"
         cnts.append(c)
 
+    # texts of concurrent tasks embedding with the same model share batches
+    batcher = get_embedding_batcher(mdl)
     tk_count = 0
     if len(tts) == len(cnts):
-        vts, c = await trio.to_thread.run_sync(lambda: mdl.encode(tts[0: 1]))
+        vts, c = await batcher.encode(mdl, tts[0: 1])
         tts = np.concatenate([vts for _ in range(len(tts))], axis=0)
         tk_count += c
 
-    cnts_ = np.array([])
-    for i in range(0, len(cnts), batch_size):
-        vts, c = await trio.to_thread.run_sync(lambda: mdl.encode([truncate(c, mdl.max_length-10) for c in cnts[i: i + batch_size]]))
-        if len(cnts_) == 0:
-            cnts_ = vts
-        else:
-            cnts_ = np.concatenate((cnts_, vts), axis=0)
+    cnts = [truncate(c, mdl.max_length-10) for c in cnts]
+    vects = [None] * len(cnts)
+    done = 0
+
+    async def encode_slice(i):
+        nonlocal tk_count, done
+        vts, c = await batcher.encode(mdl, cnts[i: i + batch_size])
+        vects[i: i + batch_size] = list(vts)
         tk_count += c
-        callback(prog=0.7 + 0.2 * (i + 1) / len(cnts), msg="")
-    cnts = cnts_
+        done += len(vts)
+        callback(prog=0.7 + 0.2 * done / len(cnts), msg="")
+
+    async with trio.open_nursery() as nursery:
+        for i in range(0, len(cnts), batch_size):
+            nursery.start_soon(encode_slice, i)
+    cnts = np.array(vects)
 
     title_w = float(parser_config.get("filename_embd_weight", 0.1))
     vects = (title_w * tts + (1 - title_w) *
@@ -552,27 +635,23 @@ async def do_handle_task(task):
             token_count = 0
             raise
         progress_message = "Embedding chunks ({:.2f}s)".format(timer() - start_ts)
-        logging.info(progress_message)
+        logging.info(f"{progress_message}, batcher: {get_embedding_batcher(embedding_model).stats()}")
         progress_callback(msg=progress_message)
 
     chunk_count = len(set([chunk["id"] for chunk in chunks]))
     start_ts = timer()
     doc_store_result = ""
-    es_bulk_size = 4
+    es_bulk_size = DOC_BULK_SIZE
     for b in range(0, len(chunks), es_bulk_size):
         doc_store_result = await trio.to_thread.run_sync(lambda: settings.docStoreConn.insert(chunks[b:b + es_bulk_size], search.index_name(task_tenant_id), task_dataset_id))
-        if b % 128 == 0:
-            progress_callback(prog=0.8 + 0.1 * (b + 1) / len(chunks), msg="")
+        progress_callback(prog=0.8 + 0.1 * (b + 1) / len(chunks), msg="")
         if doc_store_result:
             error_message = f"Insert chunk error: {doc_store_result}, please check log file and Elasticsearch/Infinity status!"
             progress_callback(-1, msg=error_message)
             raise Exception(error_message)
-        chunk_ids = [chunk["id"] for chunk in chunks[:b + es_bulk_size]]
-        chunk_ids_str = " ".join(chunk_ids)
-        try:
-            TaskService.update_chunk_ids(task["id"], chunk_ids_str)
-        except DoesNotExist:
-            logging.warning(f"do_handle_task update_chunk_ids failed since task {task['id']} is unknown.")
+        if not TaskService.add_chunk_ids(task["id"], [chunk["id"] for chunk in chunks[b:b + es_bulk_size]]):
+            logging.warning(f"do_handle_task add_chunk_ids failed since task {task['id']} is unknown.")
+            chunk_ids = [chunk["id"] for chunk in chunks[:b + es_bulk_size]]
             doc_store_result = await trio.to_thread.run_sync(lambda: settings.docStoreConn.delete({"id": chunk_ids}, search.index_name(task_tenant_id), task_dataset_id))
             return
     logging.info("Indexing doc({}), page({}-{}), chunks({}), elapsed: {:.2f}".format(task_document_name, task_from_page,
@@ -590,15 +669,12 @@ async def do_handle_task(task):
                                                                                    token_count, task_time_cost))
 
 
-async def handle_task():
+async def handle_task(redis_msg, task, limiter, token):
     global DONE_TASKS, FAILED_TASKS
-    redis_msg, task = await collect()
-    if not task:
-        await trio.sleep(5)
-        return
     try:
         logging.info(f"handle_task begin for task {json.dumps(task)}")
         CURRENT_TASKS[task["id"]] = copy.deepcopy(task)
+        PROGRESS_SINK.open(task["id"])
         await do_handle_task(task)
         DONE_TASKS += 1
         CURRENT_TASKS.pop(task["id"], None)
@@ -615,7 +691,15 @@ async def handle_task():
         except Exception:
             pass
         logging.exception(f"handle_task got exception for task {json.dumps(task)}")
+    try:
+        PROGRESS_SINK.close(task["id"])
+    except Exception:
+        logging.exception(f"handle_task failed to write the progress of task {task['id']}")
+    CANCEL_FLAGS.forget(task["id"])
     redis_msg.ack()
+    TASK_SCHEDULER.finished(redis_msg.get_message())
+    LEASED_MSGS.pop(redis_msg.get_msg_id(), None)
+    limiter.release_on_behalf_of(token)
 
 
 async def report_status():
@@ -627,7 +711,9 @@ async def report_status():
             group_info = REDIS_CONN.queue_info(get_svr_queue_name(0), SVR_CONSUMER_GROUP_NAME)
             if group_info is not None:
                 PENDING_TASKS = int(group_info.get("pending", 0))
-                LAG_TASKS = int(group_info.get("lag", 0))
+            # the executor queues hold no more than TASK_SCHEDULER_WINDOW, the rest waits in the tenant queues
+            lags = [(REDIS_CONN.queue_info(queue_name, SVR_CONSUMER_GROUP_NAME) or {}).get("lag") for queue_name in get_svr_queue_names()]
+            LAG_TASKS = sum(int(lag or 0) for lag in lags) + TASK_SCHEDULER.backlog()
 
             current = copy.deepcopy(CURRENT_TASKS)
             heartbeat = json.dumps({
@@ -639,6 +725,8 @@ async def report_status():
                 "done": DONE_TASKS,
                 "failed": FAILED_TASKS,
                 "current": current,
+                "models": model_stats(),
+                "progress": PROGRESS_SINK.stats(),
             })
             REDIS_CONN.zadd(CONSUMER_NAME, heartbeat, now.timestamp())
             logging.info(f"{CONSUMER_NAME} reported heartbeat: {heartbeat}")
@@ -651,6 +739,24 @@ async def report_status():
         await trio.sleep(30)
 
 
+async def schedule_tasks():
+    """The executor holding the lock moves the tasks of the tenant queues into the queues collect reads."""
+    lock = RedisDistributedLock("task_scheduler", timeout=10)
+    while True:
+        try:
+            if await trio.to_thread.run_sync(lock.acquire):
+                await trio.to_thread.run_sync(TASK_SCHEDULER.dispatch)
+        except Exception:
+            logging.exception("schedule_tasks got exception")
+        await trio.sleep(1)
+
+
+async def flush_progress():
+    while True:
+        await trio.sleep(PROGRESS_FLUSH_INTERVAL)
+        await trio.to_thread.run_sync(PROGRESS_SINK.flush_due)
+
+
 async def main():
     logging.info(r"""
   ______           __      ______                     __            
@@ -671,9 +777,21 @@ async def main():
 
     async with trio.open_nursery() as nursery:
         nursery.start_soon(report_status)
+        nursery.start_soon(flush_progress)
+        nursery.start_soon(renew_leases)
+        nursery.start_soon(schedule_tasks)
         while True:
-            async with task_limiter:
-                nursery.start_soon(handle_task)
+            # a slot for every task fetched at once, graphrag tasks swap the limiter meanwhile
+            limiter = task_limiter
+            tokens = [object()]
+            await limiter.acquire_on_behalf_of(tokens[0])
+            while limiter.available_tokens > 0:
+                tokens.append(object())
+                limiter.acquire_on_behalf_of_nowait(tokens[-1])
+            for redis_msg, task in await collect(len(tokens)):
+                nursery.start_soon(handle_task, redis_msg, task, limiter, tokens.pop())
+            for token in tokens:
+                limiter.release_on_behalf_of(token)
     logging.error("BUG!!! You should not reach here!!!")
 
 if __name__ == "__main__":
@@ -0,0 +1,180 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from api.db.services.task_service import TaskService
+from rag.settings import TASK_CANCEL_CHANNEL
+from rag.utils.redis_conn import REDIS_CONN
+
+# seconds between writes of the progress of a task, unless it moved by PROGRESS_FLUSH_DELTA
+PROGRESS_FLUSH_INTERVAL = float(os.environ.get("PROGRESS_FLUSH_INTERVAL", "2"))
+PROGRESS_FLUSH_DELTA = float(os.environ.get("PROGRESS_FLUSH_DELTA", "0.1"))
+# seconds a task is taken for not canceled before the database is asked again
+TASK_CANCEL_CACHE_TTL = float(os.environ.get("TASK_CANCEL_CACHE_TTL", "3"))
+# closed tasks remembered to drop the late updates of threads they left behind
+PROGRESS_CLOSED_TASKS = int(os.environ.get("PROGRESS_CLOSED_TASKS", "10000"))
+
+
+class TaskProgress:
+    def __init__(self):
+        self.prog = None
+        self.msgs = []
+        self.flushed_prog = 0
+        self.flushed_at = 0
+        # serializes the writes of the task, so that an older progress never overwrites a newer one
+        self.write_lock = threading.Lock()
+
+
+class ProgressSink:
+    """
+    Coalesces the progress parsers report, many times a page, into a write of the task every
+    PROGRESS_FLUSH_INTERVAL seconds, or as soon as the progress moved by PROGRESS_FLUSH_DELTA.
+    Failures and completion are written at once, and the messages in between all end up in the task.
+    Updates of a task after it was closed are dropped, until it's opened again.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tasks: dict[str, TaskProgress] = {}
+        self.closed: OrderedDict[str, None] = OrderedDict()
+        self.updates, self.writes = 0, 0
+
+    def open(self, task_id):
+        with self.lock:
+            self.closed.pop(task_id, None)
+
+    def put(self, task_id, prog=None, msg="", force=False):
+        """Record an update of the task, returns whether it was written."""
+        with self.lock:
+            if task_id in self.closed:
+                logging.debug(f"ProgressSink.put({task_id}) after the task was closed: {prog} {msg}")
+                return False
+            p = self.tasks.setdefault(task_id, TaskProgress())
+            if msg:
+                p.msgs.append(msg)
+            if prog is not None:
+                p.prog = prog
+            self.updates += 1
+            due = force or (prog is not None and (prog < 0 or prog >= 1)) or \
+                time.monotonic() - p.flushed_at >= PROGRESS_FLUSH_INTERVAL or \
+                (p.prog is not None and abs(p.prog - p.flushed_prog) >= PROGRESS_FLUSH_DELTA)
+        if due:
+            self._flush(task_id, p)
+        return due
+
+    def _flush(self, task_id, p: TaskProgress):
+        with p.write_lock:
+            with self.lock:
+                if not p.msgs and (p.prog is None or p.prog == p.flushed_prog):
+                    return
+                info = {"progress_msg": "\n".join(p.msgs)}
+                if p.prog is not None:
+                    info["progress"] = p.prog
+                    p.flushed_prog = p.prog
+                p.msgs = []
+                p.flushed_at = time.monotonic()
+                self.writes += 1
+            TaskService.update_progress(task_id, info)
+
+    def flush_due(self):
+        """Write the updates left behind by tasks which haven't reported for PROGRESS_FLUSH_INTERVAL."""
+        with self.lock:
+            due = [(task_id, p) for task_id, p in self.tasks.items()
+                   if time.monotonic() - p.flushed_at >= PROGRESS_FLUSH_INTERVAL]
+        for task_id, p in due:
+            try:
+                self._flush(task_id, p)
+            except Exception:
+                logging.exception(f"ProgressSink.flush_due({task_id}) got exception")
+
+    def close(self, task_id):
+        """Write what's left of the task and forget it."""
+        with self.lock:
+            p = self.tasks.pop(task_id, None)
+            self.closed[task_id] = None
+            self.closed.move_to_end(task_id)
+            while len(self.closed) > PROGRESS_CLOSED_TASKS:
+                self.closed.popitem(last=False)
+        if p:
+            self._flush(task_id, p)
+
+    def stats(self):
+        with self.lock:
+            return {"tasks": len(self.tasks), "updates": self.updates, "writes": self.writes}
+
+
+class CancelFlags:
+    """
+    Whether the tasks of this executor were canceled, from the database at most every TASK_CANCEL_CACHE_TTL
+    seconds a task, and right away for the tasks of the documents whose cancellation is published on TASK_CANCEL_CHANNEL.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checked: dict[str, tuple[bool, float]] = {}
+        self.doc_ids: dict[str, str] = {}
+        self.listener = None
+
+    def listen(self):
+        with self.lock:
+            if self.listener is not None:
+                return
+            self.listener = threading.Thread(target=self._listen, name="task_cancel_listener", daemon=True)
+        self.listener.start()
+
+    def _listen(self):
+        while (pubsub := REDIS_CONN.subscribe([TASK_CANCEL_CHANNEL])) is None:
+            time.sleep(5)
+        while True:
+            msg = REDIS_CONN.wait_message(pubsub, 60)
+            if msg:
+                self.cancel_doc(msg["data"])
+
+    def cancel_doc(self, doc_id):
+        now = time.monotonic()
+        with self.lock:
+            for task_id, d in self.doc_ids.items():
+                if d == doc_id:
+                    self.checked[task_id] = (True, now)
+
+    def is_canceled(self, task_id, doc_id=None) -> bool:
+        self.listen()
+        with self.lock:
+            if doc_id:
+                self.doc_ids[task_id] = doc_id
+            checked = self.checked.get(task_id)
+        # a canceled task stays canceled
+        if checked and (checked[0] or time.monotonic() - checked[1] < TASK_CANCEL_CACHE_TTL):
+            return checked[0]
+        canceled = TaskService.do_cancel(task_id)
+        with self.lock:
+            # unless the cancellation was published meanwhile
+            if not self.checked.get(task_id, (False, 0))[0]:
+                self.checked[task_id] = (canceled, time.monotonic())
+            return self.checked[task_id][0]
+
+    def forget(self, task_id):
+        with self.lock:
+            self.checked.pop(task_id, None)
+            self.doc_ids.pop(task_id, None)
+
+
+PROGRESS_SINK = ProgressSink()
+CANCEL_FLAGS = CancelFlags()
@@ -16,8 +16,11 @@
 
 import os
 import re
+import threading
 
 import tiktoken
+import xxhash
+from cachetools import LRUCache
 
 from api.utils.file_utils import get_project_base_directory
 
@@ -89,6 +92,87 @@ def num_tokens_from_string(string: str) -> int:
         return 0
 
 
+token_count_cache = LRUCache(maxsize=int(os.environ.get("TOKEN_COUNT_CACHE_SIZE", "8192")))
+token_count_cache_lock = threading.Lock()
+
+
+def num_tokens_from_string_cached(string: str) -> int:
+    """Same as num_tokens_from_string, memoized on the content hash for texts which are counted over and over,
+    like the chat history and the retrieved chunks."""
+    if not isinstance(string, str) or len(string) < 128:
+        return num_tokens_from_string(string)
+    key = xxhash.xxh3_64_intdigest(string.encode("utf-8"))
+    with token_count_cache_lock:
+        n = token_count_cache.get(key)
+    if n is None:
+        n = num_tokens_from_string(string)
+        with token_count_cache_lock:
+            token_count_cache[key] = n
+    return n
+
+
+class TokenCounter:
+    """
+    Counts the tokens of a growing text, e.g. a streamed answer, without encoding it again as a whole.
+    Only the text after the last committed token is encoded on each append. Tokens far enough from
+    the end won't merge with what comes next, so they are committed and never encoded again.
+    """
+
+    # tokens at the end which may still change when more text is appended
+    KEEP = 16
+
+    def __init__(self, text: str = ""):
+        self.text = ""
+        self.tail = ""
+        self.committed = 0
+        self.tail_count = 0
+        if text:
+            self.update(text)
+
+    @property
+    def count(self) -> int:
+        return self.committed + self.tail_count
+
+    def append(self, delta: str) -> int:
+        if not delta:
+            return self.count
+        self.text += delta
+        self._append(delta)
+        return self.count
+
+    def update(self, text: str) -> int:
+        """Feed the whole text so far, as streamed by chat_streamly. Starts over if it isn't an extension of the previous one."""
+        if not text.startswith(self.text):
+            self.text, self.tail, self.committed, self.tail_count = "", "", 0, 0
+        delta = text[len(self.text):]
+        self.text = text
+        self._append(delta)
+        return self.count
+
+    def _append(self, delta: str):
+        if not delta:
+            return
+        self.tail += delta
+        try:
+            tokens = encoder.encode(self.tail)
+        except Exception:
+            return
+        if len(tokens) > 2 * self.KEEP:
+            k = len(tokens) - self.KEEP
+            # don't commit in the middle of a multi-byte character
+            while k > 0:
+                try:
+                    prefix = encoder.decode_bytes(tokens[:k]).decode("utf-8")
+                    break
+                except UnicodeDecodeError:
+                    k -= 1
+            if k > 0 and self.tail.startswith(prefix):
+                self.committed += k
+                self.tail = self.tail[len(prefix):]
+                tokens = tokens[k:]
+        self.tail_count = len(tokens)
+
+
 def truncate(string: str, max_len: int) -> str:
     """Returns truncated text if the length of text exceed max_len."""
     return encoder.decode(encoder.encode(string)[:max_len])
@@ -0,0 +1,949 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import logging
+import os
+import re
+import json
+import math
+import copy
+import shutil
+import threading
+import uuid
+from collections import defaultdict
+
+import numpy as np
+from filelock import FileLock
+
+from rag import settings
+from rag.settings import TAG_FLD, PAGERANK_FLD
+from rag.utils import singleton, get_float
+from api.utils.file_utils import get_project_base_directory
+from rag.utils.doc_store_conn import DocStoreConnection, MatchExpr, OrderByExpr, MatchTextExpr, MatchDenseExpr, \
+    FusionExpr
+from rag.nlp import is_english
+
+logger = logging.getLogger('ragflow.embedded_conn')
+
+# Elasticsearch returns 10 hits when no size is given, keep the same contract.
+DEFAULT_PAGE_SIZE = 10
+# The write-ahead log is folded into a snapshot once it holds this many records.
+WAL_COMPACT_RECORDS = 4096
+VECTOR_FIELD_PATTERN = re.compile(r"^q_(\d+)_vec$")
+TEXT_FIELD_PATTERN = re.compile(r"(_tks|_ltks|_kwd)$")
+# fields filtered by value, looked up in postings of their exact values
+KEY_FIELDS = {"kb_id", "doc_id"}
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+def _is_text_field(field: str) -> bool:
+    return bool(TEXT_FIELD_PATTERN.search(field))
+
+
+def _is_key_field(field: str) -> bool:
+    return field in KEY_FIELDS or field.endswith("_kwd")
+
+
+def _fsync_dir(path: str):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class IndexGone(Exception):
+    """The directory of the index was deleted, or deleted and created anew, by some process."""
+
+
+def _field_terms(field: str, value) -> list[str]:
+    """
+    `*_tks`/`*_ltks` hold whitespace tokenized text, `*_kwd` hold whole-value keywords.
+    """
+    if value is None:
+        return []
+    if field.endswith("_kwd"):
+        values = value if isinstance(value, list) else [value]
+        return [str(v).lower() for v in values if str(v)]
+    if isinstance(value, list):
+        value = " ".join([str(v) for v in value])
+    return str(value).lower().split()
+
+
+def _parse_query_string(text: str) -> list[dict[str, float]]:
+    """
+    Parse the subset of the Lucene query string syntax generated by `FulltextQueryer` into
+    top-level clauses, each clause mapping its terms to the boost it carries.
+    Phrases and proximity searches are relaxed into their terms.
+    """
+    tokens = re.findall(r'"(?:\\.|[^"\\])*"|\\.|[()]|\^[0-9.]+|~[0-9]+|[^\s()"^~]+', text or "")
+    pos = 0
+
+    def unescape(s):
+        return re.sub(r"\\(.)", r"\1", s)
+
+    def boost():
+        nonlocal pos
+        w = 1.0
+        while pos < len(tokens) and tokens[pos][0] in "^~":
+            if tokens[pos][0] == "^":
+                w = get_float(tokens[pos][1:])
+                if w == float("-inf"):
+                    w = 1.0
+            pos += 1
+        return w
+
+    def parse_group() -> list[dict[str, float]]:
+        nonlocal pos
+        clauses = []
+        while pos < len(tokens):
+            tk = tokens[pos]
+            pos += 1
+            if tk == ")":
+                break
+            if tk in ["OR", "AND", "NOT"]:
+                continue
+            if tk == "(":
+                sub = parse_group()
+                w = boost()
+                merged = {}
+                for c in sub:
+                    for t, v in c.items():
+                        merged[t] = max(merged.get(t, 0.0), v * w)
+                if merged:
+                    clauses.append(merged)
+                continue
+            if tk[0] in "^~":
+                continue
+            if tk[0] == '"':
+                terms = unescape(tk[1:-1]).lower().split()
+            else:
+                terms = [unescape(tk).lower()]
+            w = boost()
+            terms = [t for t in terms if t]
+            if terms:
+                clauses.append({t: w for t in terms})
+        return clauses
+
+    clauses = []
+    while pos < len(tokens):
+        clauses.extend(parse_group())
+    return clauses
+
+
+def _minimum_should_match(msm, clause_num: int) -> int:
+    if not clause_num:
+        return 0
+    if isinstance(msm, str) and msm.endswith("%"):
+        msm = get_float(msm[:-1]) / 100.
+    elif isinstance(msm, str):
+        return min(clause_num, max(0, int(get_float(msm))))
+    if isinstance(msm, float):
+        return int(clause_num * max(0., min(msm, 1.)))
+    return min(clause_num, max(0, int(msm)))
+
+
+def _sort_value(v):
+    if isinstance(v, list):
+        nums = [get_float(i) for i in v]
+        return sum(nums) / len(nums) if nums else float("-inf")
+    if isinstance(v, (int, float)):
+        return float(v)
+    return get_float(v) if v is not None else float("-inf")
+
+
+class EmbeddedIndex:
+    """
+    One in-process index (the equivalent of an Elasticsearch index).
+
+    Rows are kept in slots. Row mutations are appended to a write-ahead log and periodically folded
+    into a snapshot, vectors live in one memory-mapped float32 matrix per `q_<dim>_vec` column.
+    All processes on the host share the files: writers hold a file lock and readers tail the log.
+    The lock file sits beside the directory, so that deleting the index is serialized with the writes,
+    and the INSTANCE file tells an index from one created after it was deleted.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.RLock()
+        self.file_lock = FileLock(path + ".lock")
+        with self.file_lock:
+            os.makedirs(path, exist_ok=True)
+            instance = os.path.join(path, "INSTANCE")
+            if not os.path.exists(instance):
+                with open(instance + ".tmp", "w") as f:
+                    f.write(uuid.uuid4().hex)
+                os.replace(instance + ".tmp", instance)
+            self.instance = self._read_instance()
+        self._reset()
+
+    def _read_instance(self) -> str | None:
+        try:
+            with open(os.path.join(self.path, "INSTANCE"), "r") as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def _reset(self):
+        self.generation = -1
+        self.wal_offset = 0
+        self.wal_records = 0
+        self.rows: list[dict | None] = []
+        self.id2slot: dict[str, int] = {}
+        self.free_slots: set[int] = set()
+        # field -> term -> {slot: term frequency}
+        self.postings: dict[str, dict[str, dict[int, int]]] = defaultdict(lambda: defaultdict(dict))
+        # field -> {slot: field length}
+        self.field_len: dict[str, dict[int, int]] = defaultdict(dict)
+        self.field_total_len: dict[str, int] = defaultdict(int)
+        # key field -> str(value) -> slots, for filters
+        self.keys: dict[str, dict[str, set[int]]] = defaultdict(lambda: defaultdict(set))
+        self.unavailable: set[int] = set()
+        self.vectors: dict[str, np.memmap] = {}
+        self.vector_slots: dict[str, set[int]] = defaultdict(set)
+
+    """
+    Persistence
+    """
+
+    def _current_generation(self) -> int:
+        try:
+            with open(os.path.join(self.path, "CURRENT"), "r") as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def _wal_path(self, generation: int) -> str:
+        return os.path.join(self.path, f"wal.{generation}.jsonl")
+
+    def _snapshot_path(self, generation: int) -> str:
+        return os.path.join(self.path, f"snapshot.{generation}.jsonl")
+
+    def _vector_path(self, column: str) -> str:
+        return os.path.join(self.path, f"{column}.f32")
+
+    def _map_vectors(self, column: str, min_slots: int = 0) -> np.memmap:
+        dim = int(VECTOR_FIELD_PATTERN.match(column).group(1))
+        fnm = self._vector_path(column)
+        size = os.path.getsize(fnm) if os.path.exists(fnm) else 0
+        capacity = size // (4 * dim)
+        mm = self.vectors.get(column)
+        if mm is not None and mm.shape[0] == capacity and capacity >= min_slots:
+            return mm
+        if capacity < min_slots:
+            capacity = max(min_slots, capacity * 2, 1024)
+            with open(fnm, "ab") as f:
+                f.truncate(capacity * dim * 4)
+        if mm is not None:
+            mm.flush()
+        self.vectors[column] = np.memmap(fnm, dtype=np.float32, mode="r+", shape=(capacity, dim))
+        return self.vectors[column]
+
+    def sync(self):
+        """
+        Catch up with the changes made by other processes, raises IndexGone if the index was deleted.
+        """
+        if self._read_instance() != self.instance:
+            raise IndexGone(self.path)
+        generation = self._current_generation()
+        if generation != self.generation:
+            self._reset()
+            self.generation = generation
+            snapshot = self._snapshot_path(generation)
+            if os.path.exists(snapshot):
+                with open(snapshot, "r", encoding="utf-8") as f:
+                    for line in f:
+                        if line.strip():
+                            self._apply(json.loads(line))
+            self.free_slots = set([slot for slot, row in enumerate(self.rows) if row is None])
+        wal = self._wal_path(self.generation)
+        if not os.path.exists(wal) or os.path.getsize(wal) <= self.wal_offset:
+            return
+        with open(wal, "rb") as f:
+            f.seek(self.wal_offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # A record being written by another process, pick it up next time.
+                    break
+                self.wal_offset += len(line)
+                self.wal_records += 1
+                self._apply(json.loads(line))
+
+    def _append(self, records: list[dict]):
+        if not records:
+            return
+        for column in self.vectors:
+            self.vectors[column].flush()
+        data = "".join([json.dumps(r, ensure_ascii=False) + "\n" for r in records]).encode("utf-8")
+        with open(self._wal_path(self.generation), "ab") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        self.wal_offset += len(data)
+        self.wal_records += len(records)
+        if self.wal_records >= max(WAL_COMPACT_RECORDS, len(self.id2slot)):
+            self._compact()
+
+    def _compact(self):
+        generation = self.generation + 1
+        with open(self._snapshot_path(generation), "w", encoding="utf-8") as f:
+            for slot, row in enumerate(self.rows):
+                if row is None:
+                    continue
+                vecs = [c for c in self.vector_slots if slot in self.vector_slots[c]]
+                f.write(json.dumps({"op": "put", "slot": slot, "row": row, "vecs": vecs}, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        with open(self._wal_path(generation), "w") as f:
+            os.fsync(f.fileno())
+        with open(os.path.join(self.path, "CURRENT.tmp"), "w") as f:
+            f.write(str(generation))
+            f.flush()
+            os.fsync(f.fileno())
+        # the new files are durable before CURRENT points to them, and CURRENT is before the old ones go
+        _fsync_dir(self.path)
+        os.replace(os.path.join(self.path, "CURRENT.tmp"), os.path.join(self.path, "CURRENT"))
+        _fsync_dir(self.path)
+        for g in [self.generation]:
+            for fnm in [self._snapshot_path(g), self._wal_path(g)]:
+                if os.path.exists(fnm):
+                    os.remove(fnm)
+        self.generation = generation
+        self.wal_offset = 0
+        self.wal_records = 0
+
+    """
+    In-memory structures
+    """
+
+    def _apply(self, record: dict):
+        slot = record["slot"]
+        while len(self.rows) <= slot:
+            self.rows.append(None)
+        self._unindex(slot)
+        if record["op"] == "del":
+            self.free_slots.add(slot)
+            return
+        row = record["row"]
+        self.free_slots.discard(slot)
+        self.rows[slot] = row
+        self.id2slot[row["id"]] = slot
+        if get_float(row.get("available_int", 1)) < 1:
+            self.unavailable.add(slot)
+        for field, value in row.items():
+            if _is_key_field(field) and value is not None:
+                for v in (value if isinstance(value, list) else [value]):
+                    self.keys[field][str(v)].add(slot)
+            if not _is_text_field(field):
+                continue
+            terms = _field_terms(field, value)
+            if not terms:
+                continue
+            self.field_len[field][slot] = len(terms)
+            self.field_total_len[field] += len(terms)
+            tf = defaultdict(int)
+            for t in terms:
+                tf[t] += 1
+            for t, c in tf.items():
+                self.postings[field][t][slot] = c
+        for column in record.get("vecs", []):
+            if column not in self.vectors or self.vectors[column].shape[0] <= slot:
+                self._map_vectors(column, slot + 1)
+            self.vector_slots[column].add(slot)
+
+    def _unindex(self, slot: int):
+        row = self.rows[slot]
+        if row is None:
+            return
+        self.unavailable.discard(slot)
+        for field, value in row.items():
+            if _is_key_field(field) and value is not None:
+                for v in (value if isinstance(value, list) else [value]):
+                    posting = self.keys[field].get(str(v))
+                    if posting is None:
+                        continue
+                    posting.discard(slot)
+                    if not posting:
+                        del self.keys[field][str(v)]
+            if not _is_text_field(field):
+                continue
+            self.field_total_len[field] -= self.field_len[field].pop(slot, 0)
+            for t in set(_field_terms(field, value)):
+                posting = self.postings[field].get(t)
+                if posting is None:
+                    continue
+                posting.pop(slot, None)
+                if not posting:
+                    del self.postings[field][t]
+        for column in self.vector_slots:
+            self.vector_slots[column].discard(slot)
+        if self.id2slot.get(row["id"]) == slot:
+            del self.id2slot[row["id"]]
+        self.rows[slot] = None
+
+    def _put(self, row: dict) -> dict:
+        """
+        Store vectors into the memory-mapped matrices and return the log record of the row.
+        """
+        row = dict(row)
+        vecs = []
+        for field in list(row.keys()):
+            if not VECTOR_FIELD_PATTERN.match(field):
+                continue
+            vecs.append((field, row.pop(field)))
+        slot = self.id2slot.get(row["id"])
+        if slot is None:
+            slot = self.free_slots.pop() if self.free_slots else len(self.rows)
+        for column, v in vecs:
+            mm = self._map_vectors(column, slot + 1)
+            mm[slot] = np.asarray(v, dtype=np.float32)
+        return {"op": "put", "slot": slot, "row": row, "vecs": [c for c, _ in vecs]}
+
+    def full_row(self, slot: int, vector_columns: set[str] | None = None) -> dict:
+        row = copy.deepcopy(self.rows[slot])
+        for column, slots in self.vector_slots.items():
+            if vector_columns is not None and column not in vector_columns:
+                continue
+            if slot in slots:
+                row[column] = self.vectors[column][slot].tolist()
+        return row
+
+    def live_slots(self) -> list[int]:
+        return [slot for slot, row in enumerate(self.rows) if row is not None]
+
+    """
+    Write operations, caller holds the locks and has synced.
+    """
+
+    def upsert(self, rows: list[dict]):
+        records = []
+        for row in rows:
+            r = self._put(row)
+            self._apply(r)
+            records.append(r)
+        self._append(records)
+
+    def remove(self, slots: list[int]):
+        records = []
+        for slot in slots:
+            r = {"op": "del", "slot": slot}
+            self._apply(r)
+            records.append(r)
+        self._append(records)
+
+    """
+    Filtering and scoring
+    """
+
+    @staticmethod
+    def _match_value(row_value, v) -> bool:
+        targets = v if isinstance(v, list) else [v]
+        values = row_value if isinstance(row_value, list) else [row_value]
+        targets = set([str(t) for t in targets])
+        return any([str(rv) in targets for rv in values])
+
+    def _lookup(self, field: str, v) -> set[int]:
+        targets = v if isinstance(v, list) else [v]
+        postings = self.keys.get(field, {})
+        res = set()
+        for t in targets:
+            res |= postings.get(str(t), set())
+        return res
+
+    def filter(self, condition: dict, slots: list[int] | None = None, skip_empty: bool = True) -> list[int]:
+        """
+        Slots of the rows matching `condition`. The key fields and `available_int` are looked up in postings
+        and intersected, only the rest of the condition is checked row by row.
+        """
+        checks = []
+        keyed = []
+        for k, v in condition.items():
+            if k == "id":
+                continue
+            if k in ["available_int", "exists", "must_not"]:
+                checks.append((k, v))
+                continue
+            if not v and skip_empty:
+                continue
+            if not isinstance(v, (list, str, int)):
+                raise Exception(
+                    f"Condition `{str(k)}={str(v)}` value type is {str(type(v))}, expected to be int, str or list.")
+            if _is_key_field(k) and not (isinstance(v, list) and not v):
+                keyed.append((k, v))
+            else:
+                checks.append((k, v))
+
+        if slots is None and "id" in condition and condition["id"]:
+            ids = condition["id"] if isinstance(condition["id"], list) else [condition["id"]]
+            slots = [self.id2slot[i] for i in ids if i in self.id2slot]
+        if slots is None and keyed:
+            # the smallest posting first, the intersection never grows
+            postings = sorted([self._lookup(k, v) for k, v in keyed], key=len)
+            found = set(postings[0])
+            for p in postings[1:]:
+                found &= p
+            if ("available_int", 0) in checks:
+                found &= self.unavailable
+            elif any(k == "available_int" for k, _ in checks):
+                found -= self.unavailable
+            checks = [(k, v) for k, v in checks if k != "available_int"]
+            slots = sorted(found)
+        else:
+            checks = keyed + checks
+            if slots is None:
+                slots = self.live_slots()
+        if not checks:
+            return [slot for slot in slots if self.rows[slot] is not None]
+
+        res = []
+        for slot in slots:
+            row = self.rows[slot]
+            if row is None:
+                continue
+            ok = True
+            for k, v in checks:
+                if k == "available_int":
+                    avail = get_float(row.get(k, 1))
+                    if (v == 0 and avail >= 1) or (v != 0 and avail < 1):
+                        ok = False
+                        break
+                    continue
+                if k == "exists":
+                    if row.get(v) is None:
+                        ok = False
+                        break
+                    continue
+                if k == "must_not":
+                    if isinstance(v, dict) and "exists" in v and row.get(v["exists"]) is not None:
+                        ok = False
+                        break
+                    continue
+                if row.get(k) is None or not self._match_value(row[k], v):
+                    ok = False
+                    break
+            if ok:
+                res.append(slot)
+        return res
+
+    def text_scores(self, expr: MatchTextExpr, slots: list[int]) -> dict[int, float]:
+        candidates = set(slots)
+        clauses = _parse_query_string(expr.matching_text)
+        if not clauses or not candidates:
+            return {}
+        fields = []
+        for f in expr.fields:
+            nm, _, w = f.partition("^")
+            fields.append((nm, get_float(w) if w else 1.0))
+        doc_num = max(1, len(self.id2slot))
+        scores = defaultdict(float)
+        matched_clauses = defaultdict(int)
+        for clause in clauses:
+            hit = set()
+            for term, qw in clause.items():
+                for field, fw in fields:
+                    posting = self.postings.get(field, {}).get(term)
+                    if not posting:
+                        continue
+                    lens = self.field_len[field]
+                    avgdl = self.field_total_len[field] / max(1, len(lens))
+                    idf = math.log(1 + (doc_num - len(posting) + 0.5) / (len(posting) + 0.5))
+                    for slot, tf in posting.items():
+                        if slot not in candidates:
+                            continue
+                        norm = tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * lens.get(slot, 0) / max(avgdl, 1e-6)))
+                        scores[slot] += qw * fw * idf * norm
+                        hit.add(slot)
+            for slot in hit:
+                matched_clauses[slot] += 1
+        required = _minimum_should_match(expr.extra_options.get("minimum_should_match", 0.0), len(clauses))
+        return {slot: sc for slot, sc in scores.items() if matched_clauses[slot] >= max(1, required)}
+
+    def dense_scores(self, expr: MatchDenseExpr, slots: list[int]) -> dict[int, float]:
+        column = expr.vector_column_name
+        if column not in self.vectors:
+            return {}
+        slots = [s for s in slots if s in self.vector_slots[column]]
+        if not slots:
+            return {}
+        q = np.asarray(expr.embedding_data, dtype=np.float32)
+        mat = np.asarray(self.vectors[column][slots])
+        norms = np.linalg.norm(mat, axis=1) * max(float(np.linalg.norm(q)), 1e-9)
+        sims = mat @ q / np.maximum(norms, 1e-9)
+        threshold = get_float(expr.extra_options.get("similarity", 0.0))
+        idx = np.argsort(-sims)[:expr.topn]
+        return {slots[i]: float(sims[i]) for i in idx if sims[i] >= threshold}
+
+
+@singleton
+class EmbeddedConnection(DocStoreConnection):
+    def __init__(self):
+        self.path = settings.EMBEDDED.get("path")
+        if not self.path:
+            msg = "Embedded doc store path is not configured."
+            logger.error(msg)
+            raise Exception(msg)
+        if not os.path.isabs(self.path):
+            self.path = os.path.join(get_project_base_directory(), self.path)
+        os.makedirs(self.path, exist_ok=True)
+        self.indices: dict[str, EmbeddedIndex] = {}
+        self.lock = threading.Lock()
+        logger.info(f"Use embedded doc store at {self.path} as the doc engine.")
+
+    def _index(self, indexName: str, create: bool = False) -> EmbeddedIndex | None:
+        with self.lock:
+            if indexName in self.indices:
+                return self.indices[indexName]
+            path = os.path.join(self.path, indexName)
+            if not create and not os.path.isdir(path):
+                return None
+            self.indices[indexName] = EmbeddedIndex(path)
+            return self.indices[indexName]
+
+    def _forget(self, indexName: str, idx: EmbeddedIndex):
+        """Drop the cached index once it was found deleted by another process."""
+        logger.info(f"Index {indexName} was deleted, forget it")
+        with self.lock:
+            if self.indices.get(indexName) is idx:
+                del self.indices[indexName]
+
+    """
+    Database operations
+    """
+
+    def dbType(self) -> str:
+        return "embedded"
+
+    def health(self) -> dict:
+        return {
+            "type": "embedded",
+            "status": "green" if os.access(self.path, os.W_OK) else "red",
+            "path": self.path,
+        }
+
+    """
+    Table operations
+    """
+
+    def createIdx(self, indexName: str, knowledgebaseId: str, vectorSize: int):
+        self._index(indexName, create=True)
+        return True
+
+    def deleteIdx(self, indexName: str, knowledgebaseId: str):
+        if len(knowledgebaseId) > 0:
+            # The index need to be alive after any kb deletion since all kb under this tenant are in one index.
+            return
+        with self.lock:
+            self.indices.pop(indexName, None)
+        # the other processes holding the index find it gone when they next take the lock
+        path = os.path.join(self.path, indexName)
+        with FileLock(path + ".lock"):
+            shutil.rmtree(path, ignore_errors=True)
+
+    def indexExist(self, indexName: str, knowledgebaseId: str = None) -> bool:
+        return os.path.isdir(os.path.join(self.path, indexName))
+
+    """
+    CRUD operations
+    """
+
+    def search(
+            self, selectFields: list[str],
+            highlightFields: list[str],
+            condition: dict,
+            matchExprs: list[MatchExpr],
+            orderBy: OrderByExpr,
+            offset: int,
+            limit: int,
+            indexNames: str | list[str],
+            knowledgebaseIds: list[str],
+            aggFields: list[str] = [],
+            rank_feature: dict | None = None
+    ):
+        if isinstance(indexNames, str):
+            indexNames = indexNames.split(",")
+        assert isinstance(indexNames, list) and len(indexNames) > 0
+        assert "_id" not in condition
+        condition = dict(condition)
+        condition["kb_id"] = knowledgebaseIds
+
+        text_expr, dense_expr = None, None
+        vector_similarity_weight = 0.5
+        for m in matchExprs:
+            if isinstance(m, MatchTextExpr):
+                text_expr = m
+            elif isinstance(m, MatchDenseExpr):
+                dense_expr = m
+            elif isinstance(m, FusionExpr) and m.method == "weighted_sum" and "weights" in (m.fusion_params or {}):
+                vector_similarity_weight = get_float(m.fusion_params["weights"].split(",")[1])
+
+        # Like `_source=True` of Elasticsearch every stored field is returned, vectors only on demand.
+        vector_columns = set([f for f in selectFields if VECTOR_FIELD_PATTERN.match(f)]) if selectFields else None
+        hits = []
+        for indexName in indexNames:
+            idx = self._index(indexName)
+            if idx is None:
+                continue
+            with idx.lock:
+                try:
+                    idx.sync()
+                except IndexGone:
+                    self._forget(indexName, idx)
+                    continue
+                slots = idx.filter(condition)
+                if text_expr or dense_expr:
+                    tscores = idx.text_scores(text_expr, slots) if text_expr else {}
+                    if tscores:
+                        # Fulltext is the scoring anchor, normalize it to be comparable with cosine similarity.
+                        mx = max(tscores.values())
+                        tscores = {s: v / mx for s, v in tscores.items()}
+                    vscores = idx.dense_scores(dense_expr, slots) if dense_expr else {}
+                    tw = 1.0 - vector_similarity_weight if dense_expr else 1.0
+                    vw = vector_similarity_weight if text_expr else 1.0
+                    scored = {}
+                    for s in set(tscores.keys()) | set(vscores.keys()):
+                        scored[s] = tw * tscores.get(s, 0.0) + vw * vscores.get(s, 0.0)
+                else:
+                    scored = {s: 1.0 for s in slots}
+
+                for slot, score in scored.items():
+                    row = idx.rows[slot]
+                    if rank_feature:
+                        for fld, sc in rank_feature.items():
+                            if fld == PAGERANK_FLD:
+                                if row.get(PAGERANK_FLD):
+                                    score += get_float(row[PAGERANK_FLD]) * sc
+                                continue
+                            tags = row.get(TAG_FLD) or {}
+                            if isinstance(tags, str):
+                                tags = json.loads(tags)
+                            if fld in tags:
+                                score += get_float(tags[fld]) * sc
+                    hits.append((idx, slot, row, score))
+
+        if orderBy and orderBy.fields:
+            for field, order in reversed(orderBy.fields):
+                hits.sort(key=lambda h: _sort_value(h[2].get(field)), reverse=order == 1)
+        else:
+            hits.sort(key=lambda h: h[3], reverse=True)
+
+        aggregations = {}
+        for fld in aggFields:
+            counts = defaultdict(int)
+            for _, _, row, _ in hits:
+                v = row.get(fld)
+                if v is None:
+                    continue
+                for vv in (v if isinstance(v, list) else [v]):
+                    counts[vv] += 1
+            aggregations[fld] = sorted(counts.items(), key=lambda x: x[1] * -1)
+
+        total = len(hits)
+        if limit <= 0:
+            limit = DEFAULT_PAGE_SIZE
+        # Only the requested page is copied out of the index.
+        page = []
+        for idx, slot, row, score in hits[offset:offset + limit]:
+            with idx.lock:
+                src = idx.full_row(slot, vector_columns) if idx.rows[slot] is row else copy.deepcopy(row)
+            page.append({"_id": src.pop("id"), "_score": score, "_source": src})
+        return {
+            "total": total,
+            "hits": page,
+            "aggregations": aggregations,
+            "highlight": bool(highlightFields) and text_expr is not None,
+        }
+
+    def get(self, chunkId: str, indexName: str, knowledgebaseIds: list[str]) -> dict | None:
+        idx = self._index(indexName)
+        if idx is None:
+            return None
+        with idx.lock:
+            try:
+                idx.sync()
+            except IndexGone:
+                self._forget(indexName, idx)
+                return None
+            slot = idx.id2slot.get(chunkId)
+            if slot is None:
+                return None
+            return idx.full_row(slot)
+
+    def insert(self, documents: list[dict], indexName: str, knowledgebaseId: str = None) -> list[str]:
+        rows = []
+        for d in documents:
+            assert "_id" not in d
+            assert "id" in d
+            d_copy = copy.deepcopy(d)
+            d_copy["kb_id"] = knowledgebaseId
+            rows.append(d_copy)
+        try:
+            # an index deleted meanwhile is created anew, like Elasticsearch does on insert
+            for _ in range(2):
+                idx = self._index(indexName, create=True)
+                with idx.lock, idx.file_lock:
+                    try:
+                        idx.sync()
+                    except IndexGone:
+                        self._forget(indexName, idx)
+                        continue
+                    idx.upsert(rows)
+                    break
+            else:
+                raise IndexGone(indexName)
+        except Exception as e:
+            logger.exception("EmbeddedConnection.insert got exception")
+            return [str(e)]
+        return []
+
+    def update(self, condition: dict, newValue: dict, indexName: str, knowledgebaseId: str) -> bool:
+        idx = self._index(indexName)
+        if idx is None:
+            return False
+        condition = dict(condition)
+        condition["kb_id"] = knowledgebaseId
+        single = "id" in condition and isinstance(condition["id"], str)
+        try:
+            with idx.lock, idx.file_lock:
+                try:
+                    idx.sync()
+                except IndexGone:
+                    self._forget(indexName, idx)
+                    return False
+                slots = idx.filter(condition)
+                if single and not slots:
+                    return False
+                rows = []
+                for slot in slots:
+                    row = idx.full_row(slot)
+                    for k, v in newValue.items():
+                        if k == "id":
+                            continue
+                        if k == "remove":
+                            if isinstance(v, str):
+                                row.pop(v, None)
+                            elif isinstance(v, dict):
+                                for kk, vv in v.items():
+                                    if isinstance(row.get(kk), list) and vv in row[kk]:
+                                        row[kk].remove(vv)
+                            continue
+                        if k == "add":
+                            if isinstance(v, dict):
+                                for kk, vv in v.items():
+                                    row.setdefault(kk, [])
+                                    if not isinstance(row[kk], list):
+                                        row[kk] = [row[kk]]
+                                    row[kk].append(vv.strip())
+                            continue
+                        if not single and not v and k != "available_int":
+                            continue
+                        if not isinstance(v, (str, int, float, list, dict)) and v is not None:
+                            raise Exception(
+                                f"newValue `{str(k)}={str(v)}` value type is {str(type(v))}, expected to be int, str.")
+                        row[k] = copy.deepcopy(v)
+                    rows.append(row)
+                idx.upsert(rows)
+            return True
+        except Exception:
+            logger.exception(f"EmbeddedConnection.update(index={indexName}, condition={str(condition)}) got exception")
+            return False
+
+    def delete(self, condition: dict, indexName: str, knowledgebaseId: str) -> int:
+        assert "_id" not in condition
+        idx = self._index(indexName)
+        if idx is None:
+            return 0
+        condition = dict(condition)
+        condition["kb_id"] = knowledgebaseId
+        if "id" in condition:
+            chunk_ids = condition["id"]
+            condition = {"id": chunk_ids if isinstance(chunk_ids, list) else [chunk_ids]}
+            if not condition["id"]:
+                return 0
+        with idx.lock, idx.file_lock:
+            try:
+                idx.sync()
+            except IndexGone:
+                self._forget(indexName, idx)
+                return 0
+            slots = idx.filter(condition)
+            idx.remove(slots)
+        return len(slots)
+
+    """
+    Helper functions for search result
+    """
+
+    def getTotal(self, res):
+        return res["total"]
+
+    def getChunkIds(self, res):
+        return [d["_id"] for d in res["hits"]]
+
+    def getFields(self, res, fields: list[str]) -> dict[str, dict]:
+        res_fields = {}
+        if not fields:
+            return {}
+        for d in res["hits"]:
+            # like the sources of Elasticsearch, with the id and score of the hit
+            src = {**d["_source"], "id": d["_id"], "_score": d["_score"]}
+            m = {n: src.get(n) for n in fields if src.get(n) is not None}
+            for n, v in m.items():
+                if isinstance(v, list):
+                    continue
+                if not isinstance(v, str):
+                    m[n] = str(v)
+            if m:
+                res_fields[d["_id"]] = m
+        return res_fields
+
+    def getHighlight(self, res, keywords: list[str], fieldnm: str):
+        ans = {}
+        if not res.get("highlight"):
+            return ans
+        for d in res["hits"]:
+            txt = d["_source"].get(fieldnm)
+            if not txt:
+                continue
+            txt = re.sub(r"[\r\n]", " ", txt, flags=re.IGNORECASE | re.MULTILINE)
+            txts = []
+            if not is_english(txt.split()):
+                for w in sorted(keywords, key=len, reverse=True):
+                    txt = re.sub(r"(?<!<em>)(%s)(?!</em>)" % re.escape(w), r"<em>\1</em>", txt, flags=re.IGNORECASE)
+                if re.search(r"<em>[^<>]+</em>", txt):
+                    ans[d["_id"]] = txt
+                continue
+            for t in re.split(r"[.?!;\n]", txt):
+                for w in keywords:
+                    t = re.sub(r"(^|[ .?/'\"\(\)!,:;-])(%s)([ .?/'\"\(\)!,:;-])" % re.escape(w), r"\1<em>\2</em>\3", t,
+                               flags=re.IGNORECASE | re.MULTILINE)
+                if not re.search(r"<em>[^<>]+</em>", t, flags=re.IGNORECASE | re.MULTILINE):
+                    continue
+                txts.append(t)
+            if txts:
+                ans[d["_id"]] = "...".join(txts)
+        return ans
+
+    def getAggregation(self, res, fieldnm: str):
+        return list(res.get("aggregations", {}).get(fieldnm, []))
+
+    """
+    SQL
+    """
+
+    def sql(self, sql: str, fetch_size: int, format: str):
+        logger.warning("EmbeddedConnection.sql is not supported.")
+        return None
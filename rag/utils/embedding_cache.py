@@ -0,0 +1,112 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import logging
+import os
+import threading
+
+import numpy as np
+import xxhash
+from cachetools import LRUCache
+
+from rag.utils.redis_conn import REDIS_CONN
+
+# entries of the in-process tier, 0 disables it
+EMBEDDING_CACHE_LOCAL_SIZE = int(os.environ.get("EMBEDDING_CACHE_LOCAL_SIZE", "16384"))
+# seconds vectors live in Redis, 0 disables the Redis tier
+EMBEDDING_CACHE_TTL = int(os.environ.get("EMBEDDING_CACHE_TTL", str(7 * 24 * 3600)))
+# float32 keeps vectors exact, float16 halves the memory
+EMBEDDING_CACHE_DTYPE = os.environ.get("EMBEDDING_CACHE_DTYPE", "float32")
+
+DTYPES = {b"4": np.float32, b"2": np.float16}
+
+
+class EmbeddingCache:
+    """
+    Vectors keyed by the hash of (model, kind, text), `kind` tells documents from queries apart since
+    some models embed them differently. Redis holds them as a one-byte dtype tag and the raw array;
+    an LRU in front of it serves the texts this process has seen lately.
+    """
+
+    def __init__(self):
+        self.local = LRUCache(maxsize=EMBEDDING_CACHE_LOCAL_SIZE) if EMBEDDING_CACHE_LOCAL_SIZE > 0 else None
+        self.lock = threading.Lock()
+        self.dtype = np.float16 if EMBEDDING_CACHE_DTYPE == "float16" else np.float32
+        self.hits, self.misses = 0, 0
+
+    @staticmethod
+    def key(model: str, kind: str, text: str) -> str:
+        hasher = xxhash.xxh3_128()
+        hasher.update(f"{model}\0{kind}\0".encode("utf-8"))
+        hasher.update(str(text).encode("utf-8"))
+        return "embd:" + hasher.hexdigest()
+
+    def pack(self, vec) -> bytes:
+        tag = b"2" if self.dtype == np.float16 else b"4"
+        return tag + np.asarray(vec, dtype=self.dtype).tobytes()
+
+    @staticmethod
+    def unpack(bin: bytes):
+        dtype = DTYPES.get(bin[:1])
+        if dtype is None:
+            return None
+        return np.frombuffer(bin[1:], dtype=dtype).astype(np.float32)
+
+    def get(self, model: str, texts: list[str], kind: str = "doc") -> list:
+        """Cached vectors of `texts`, None for the missing ones."""
+        keys = [self.key(model, kind, t) for t in texts]
+        res = [None] * len(keys)
+        if self.local is not None:
+            with self.lock:
+                for i, k in enumerate(keys):
+                    res[i] = self.local.get(k)
+        missing = [i for i, v in enumerate(res) if v is None]
+        if missing and EMBEDDING_CACHE_TTL > 0:
+            try:
+                bins = REDIS_CONN.mget_bytes([keys[i] for i in missing])
+            except Exception:
+                logging.exception("EmbeddingCache.get got exception")
+                bins = [None] * len(missing)
+            for i, bin in zip(missing, bins):
+                if bin:
+                    res[i] = self.unpack(bin)
+            if self.local is not None:
+                with self.lock:
+                    for i in missing:
+                        if res[i] is not None:
+                            self.local[keys[i]] = res[i]
+        with self.lock:
+            n = sum(1 for v in res if v is not None)
+            self.hits += n
+            self.misses += len(res) - n
+        return res
+
+    def set(self, model: str, texts: list[str], vecs, kind: str = "doc"):
+        keys = [self.key(model, kind, t) for t in texts]
+        vecs = [np.asarray(v, dtype=self.dtype).astype(np.float32) for v in vecs]
+        if self.local is not None:
+            with self.lock:
+                for k, v in zip(keys, vecs):
+                    self.local[k] = v
+        if EMBEDDING_CACHE_TTL > 0:
+            REDIS_CONN.mset_bytes({k: self.pack(v) for k, v in zip(keys, vecs)}, EMBEDDING_CACHE_TTL)
+
+    def info(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0, "local": len(self.local) if self.local is not None else 0}
+
+
+EMBEDDING_CACHE = EmbeddingCache()
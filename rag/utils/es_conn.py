@@ -19,11 +19,14 @@ import re
 import json
 import time
 import os
+import threading
 
 import copy
+from concurrent.futures import ThreadPoolExecutor
+from timeit import default_timer as timer
 from elasticsearch import Elasticsearch, NotFoundError
 from elasticsearch_dsl import UpdateByQuery, Q, Search, Index
-from elastic_transport import ConnectionTimeout
+from elastic_transport import ConnectionTimeout, ConnectionError as TransportConnectionError
 from rag import settings
 from rag.settings import TAG_FLD, PAGERANK_FLD
 from rag.utils import singleton, get_float
@@ -34,6 +37,13 @@ from rag.nlp import is_english, rag_tokenizer
 
 ATTEMPT_TIME = 2
 
+# bulk requests are cut by serialized size, which moves between the bounds following 429s and latency
+ES_BULK_MIN_BYTES = int(os.environ.get("ES_BULK_MIN_BYTES", 256 * 1024))
+ES_BULK_MAX_BYTES = int(os.environ.get("ES_BULK_MAX_BYTES", 16 * 1024 * 1024))
+ES_BULK_LATENCY = float(os.environ.get("ES_BULK_LATENCY", "5"))
+ES_BULK_INFLIGHT = int(os.environ.get("ES_BULK_INFLIGHT", "4"))
+ES_BULK_RETRY = int(os.environ.get("ES_BULK_RETRY", "5"))
+
 logger = logging.getLogger('ragflow.es_conn')
 
 
@@ -41,6 +51,9 @@ logger = logging.getLogger('ragflow.es_conn')
 class ESConnection(DocStoreConnection):
     def __init__(self):
         self.info = {}
+        self.bulk_bytes = min(ES_BULK_MAX_BYTES, max(ES_BULK_MIN_BYTES, 4 * 1024 * 1024))
+        self.bulk_lock = threading.Lock()
+        self.bulk_executor = ThreadPoolExecutor(max_workers=ES_BULK_INFLIGHT, thread_name_prefix="es_bulk")
         logger.info(f"Use Elasticsearch {settings.ES['hosts']} as the doc engine.")
         for _ in range(ATTEMPT_TIME):
             try:
@@ -160,6 +173,9 @@ class ESConnection(DocStoreConnection):
                     bqry.filter.append(
                         Q("bool", must_not=Q("range", available_int={"lt": 1})))
                 continue
+            if k == "id":
+                bqry.filter.append(Q("ids", values=v if isinstance(v, list) else [v]))
+                continue
             if not v:
                 continue
             if isinstance(v, list):
@@ -279,41 +295,78 @@ class ESConnection(DocStoreConnection):
 
     def insert(self, documents: list[dict], indexName: str, knowledgebaseId: str = None) -> list[str]:
         # Refers to https://www.elastic.co/guide/en/elasticsearch/reference/current/docs-bulk.html
-        operations = []
+        # Documents are serialized once, sent in parallel bulk requests cut by size,
+        # and only the items rejected for load are sent again.
+        serializer = self.es.transport.serializers.get_serializer("application/json")
+        items = []
         for d in documents:
             assert "_id" not in d
             assert "id" in d
             d_copy = copy.deepcopy(d)
             d_copy["kb_id"] = knowledgebaseId
             meta_id = d_copy.pop("id", "")
-            operations.append(
-                {"index": {"_index": indexName, "_id": meta_id}})
-            operations.append(d_copy)
+            items.append((meta_id, serializer.dumps({"index": {"_index": indexName, "_id": meta_id}}) + b"\n" + serializer.dumps(d_copy) + b"\n"))
 
         res = []
-        for _ in range(ATTEMPT_TIME):
-            try:
-                res = []
-                r = self.es.bulk(index=(indexName), operations=operations,
-                                 refresh=False, timeout="60s")
-                if re.search(r"False", str(r["errors"]), re.IGNORECASE):
-                    return res
-
-                for item in r["items"]:
-                    for action in ["create", "delete", "index", "update"]:
-                        if action in item and "error" in item[action]:
-                            res.append(str(item[action]["_id"]) + ":" + str(item[action]["error"]))
+        pending = list(range(len(items)))
+        for attempt in range(ES_BULK_RETRY):
+            batches, batch, size = [], [], 0
+            bulk_bytes = self.bulk_bytes
+            for i in pending:
+                if batch and size + len(items[i][1]) > bulk_bytes:
+                    batches.append(batch)
+                    batch, size = [], 0
+                batch.append(i)
+                size += len(items[i][1])
+            if batch:
+                batches.append(batch)
+
+            pending = []
+            for retry, errors in self.bulk_executor.map(lambda b: self._bulk(indexName, items, b), batches):
+                pending.extend(retry)
+                res.extend(errors)
+            if not pending:
                 return res
-            except Exception as e:
-                res.append(str(e))
-                logger.warning("ESConnection.insert got exception: " + str(e))
-                res = []
-                if re.search(r"(Timeout|time out)", str(e), re.IGNORECASE):
-                    res.append(str(e))
-                    time.sleep(3)
-                    continue
+            logger.warning(f"ESConnection.insert {len(pending)} documents rejected, retry {attempt + 1}/{ES_BULK_RETRY}")
+            time.sleep(min(0.5 * 2 ** attempt, 10))
+
+        res.extend(f"{items[i][0]}:retried {ES_BULK_RETRY} times without success" for i in pending)
         return res
 
+    def _bulk(self, indexName: str, items: list[tuple[str, bytes]], batch: list[int]) -> tuple[list[int], list[str]]:
+        """Send one bulk request, return the items to retry and the errors of the others."""
+        size = sum(len(items[i][1]) for i in batch)
+        st = timer()
+        try:
+            r = self.es.bulk(index=indexName, operations=b"".join(items[i][1] for i in batch), refresh=False, timeout="60s")
+        except Exception as e:
+            overloaded = getattr(e, "status_code", None) == 429
+            if overloaded or isinstance(e, (ConnectionTimeout, TransportConnectionError)) or re.search(r"(Timeout|time out)", str(e), re.IGNORECASE):
+                logger.warning("ESConnection.insert got exception: " + str(e))
+                self._adapt_bulk_bytes(size, timer() - st, True)
+                return batch, []
+            logger.exception("ESConnection.insert got exception")
+            return [], [str(e)]
+
+        retry, errors = [], []
+        if re.search(r"True", str(r["errors"]), re.IGNORECASE):
+            for i, item in zip(batch, r["items"]):
+                for action in ["create", "delete", "index", "update"]:
+                    if action in item and "error" in item[action]:
+                        if item[action].get("status") in (429, 502, 503, 504):
+                            retry.append(i)
+                        else:
+                            errors.append(str(item[action]["_id"]) + ":" + str(item[action]["error"]))
+        self._adapt_bulk_bytes(size, timer() - st, bool(retry))
+        return retry, errors
+
+    def _adapt_bulk_bytes(self, size, elapsed, overloaded):
+        with self.bulk_lock:
+            if overloaded or elapsed > ES_BULK_LATENCY:
+                self.bulk_bytes = max(ES_BULK_MIN_BYTES, self.bulk_bytes // 2)
+            elif elapsed < ES_BULK_LATENCY / 2 and size >= self.bulk_bytes / 2:
+                self.bulk_bytes = min(ES_BULK_MAX_BYTES, int(self.bulk_bytes * 1.5))
+
     def update(self, condition: dict, newValue: dict, indexName: str, knowledgebaseId: str) -> bool:
         doc = copy.deepcopy(newValue)
         doc.pop("id", None)
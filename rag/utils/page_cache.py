@@ -0,0 +1,206 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+import numpy as np
+import xxhash
+
+from api.utils.file_utils import get_project_base_directory
+
+# where page analysis results are kept: storage (STORAGE_IMPL), local (PAGE_ANALYSIS_CACHE_DIR) or off
+PAGE_ANALYSIS_CACHE_BACKEND = os.environ.get("PAGE_ANALYSIS_CACHE_BACKEND", "off")
+PAGE_ANALYSIS_CACHE_DIR = os.environ.get("PAGE_ANALYSIS_CACHE_DIR", os.path.join(get_project_base_directory(), "rag/res/page_cache"))
+PAGE_ANALYSIS_CACHE_BUCKET = "page-analysis-cache"
+# seconds an entry nobody used is kept, and entries kept at most, the least recently used are evicted first
+PAGE_ANALYSIS_CACHE_TTL = int(os.environ.get("PAGE_ANALYSIS_CACHE_TTL", str(7 * 24 * 3600)))
+PAGE_ANALYSIS_CACHE_MAX_ENTRIES = int(os.environ.get("PAGE_ANALYSIS_CACHE_MAX_ENTRIES", "100000"))
+# entries written by a process between evictions
+PAGE_ANALYSIS_CACHE_EVICT_EVERY = int(os.environ.get("PAGE_ANALYSIS_CACHE_EVICT_EVERY", "100"))
+# sorted set of the entries by last use
+PAGE_ANALYSIS_CACHE_INDEX = "page_analysis_cache"
+
+# the document whose pages are analyzed, its entries are dropped along with it
+PAGE_ANALYSIS_CACHE_DOC = contextvars.ContextVar("page_analysis_cache_doc", default=None)
+
+
+def doc_entries_key(doc_id: str) -> str:
+    return f"page_analysis_cache_doc_{doc_id}"
+
+
+def to_json(o):
+    # numpy scalars and arrays in the results
+    return o.tolist() if hasattr(o, "tolist") else str(o)
+
+
+class PageAnalysisCache:
+    """
+    OCR, layout and table structure results keyed by the hash of the image they were computed from,
+    the model version and whatever else they depend on. Re-parsing a document renders the same
+    pages, so only the pages whose content or models changed are analyzed again.
+
+    The use of entries is tracked in Redis: those unused for PAGE_ANALYSIS_CACHE_TTL seconds or
+    beyond PAGE_ANALYSIS_CACHE_MAX_ENTRIES are evicted, and those of a document are removed with it.
+    """
+
+    def __init__(self, backend=PAGE_ANALYSIS_CACHE_BACKEND):
+        self.backend = backend if backend in ("storage", "local") else None
+        self.lock = threading.Lock()
+        self.hits, self.misses, self.writes = 0, 0, 0
+
+    @property
+    def enabled(self):
+        return self.backend is not None
+
+    @staticmethod
+    def key(kind: str, version: str, image, *parts) -> str:
+        hasher = xxhash.xxh3_128()
+        hasher.update(f"{kind}\0{version}\0".encode("utf-8"))
+        arr = np.ascontiguousarray(np.asarray(image))
+        hasher.update(str(arr.shape).encode("utf-8"))
+        hasher.update(arr)
+        for p in parts:
+            hasher.update(b"\0" + json.dumps(p, ensure_ascii=False, default=to_json).encode("utf-8"))
+        return f"{kind}/{hasher.hexdigest()}"
+
+    def _get(self, key):
+        if self.backend == "local":
+            path = os.path.join(PAGE_ANALYSIS_CACHE_DIR, key)
+            if not os.path.exists(path):
+                return None
+            with open(path, "rb") as f:
+                return f.read()
+        from rag.utils.storage_factory import STORAGE_IMPL
+        if not STORAGE_IMPL.obj_exist(PAGE_ANALYSIS_CACHE_BUCKET, key):
+            return None
+        return STORAGE_IMPL.get(PAGE_ANALYSIS_CACHE_BUCKET, key)
+
+    def _put(self, key, bin):
+        if self.backend == "local":
+            path = os.path.join(PAGE_ANALYSIS_CACHE_DIR, key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # written aside and renamed, so readers never see a partial entry
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}"
+            with open(tmp, "wb") as f:
+                f.write(bin)
+            os.replace(tmp, path)
+            return
+        from rag.utils.storage_factory import STORAGE_IMPL
+        STORAGE_IMPL.put(PAGE_ANALYSIS_CACHE_BUCKET, key, bin)
+
+    def _rm(self, key):
+        if self.backend == "local":
+            path = os.path.join(PAGE_ANALYSIS_CACHE_DIR, key)
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        from rag.utils.storage_factory import STORAGE_IMPL
+        STORAGE_IMPL.rm(PAGE_ANALYSIS_CACHE_BUCKET, key)
+
+    @staticmethod
+    def _used(key):
+        from rag.utils.redis_conn import REDIS_CONN
+        REDIS_CONN.zadd(PAGE_ANALYSIS_CACHE_INDEX, key, time.time())
+        doc_id = PAGE_ANALYSIS_CACHE_DOC.get()
+        if doc_id:
+            REDIS_CONN.sadd(doc_entries_key(doc_id), key)
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        res = None
+        try:
+            bin = self._get(key)
+            if bin:
+                res = json.loads(zlib.decompress(bin))
+                self._used(key)
+        except Exception:
+            logging.exception(f"PageAnalysisCache.get {key} got exception")
+        with self.lock:
+            if res is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return res
+
+    def set(self, key, value):
+        if not self.enabled:
+            return
+        try:
+            self._put(key, zlib.compress(json.dumps(value, ensure_ascii=False, default=to_json).encode("utf-8")))
+            self._used(key)
+        except Exception:
+            logging.exception(f"PageAnalysisCache.set {key} got exception")
+            return
+        with self.lock:
+            self.writes += 1
+            due = self.writes % PAGE_ANALYSIS_CACHE_EVICT_EVERY == 0
+        if due:
+            self.evict()
+
+    def evict(self):
+        """Remove the entries unused for PAGE_ANALYSIS_CACHE_TTL, then the least recently used beyond PAGE_ANALYSIS_CACHE_MAX_ENTRIES."""
+        from rag.utils.redis_conn import REDIS_CONN
+        try:
+            expire_before = time.time() - PAGE_ANALYSIS_CACHE_TTL
+            keys = REDIS_CONN.zrangebyscore(PAGE_ANALYSIS_CACHE_INDEX, 0, expire_before) or []
+            for key in keys:
+                self._rm(key)
+            REDIS_CONN.zremrangebyscore(PAGE_ANALYSIS_CACHE_INDEX, 0, expire_before)
+            excess = REDIS_CONN.zcount(PAGE_ANALYSIS_CACHE_INDEX, "-inf", "+inf") - PAGE_ANALYSIS_CACHE_MAX_ENTRIES
+            lru = [key for key, _ in REDIS_CONN.zpopmin(PAGE_ANALYSIS_CACHE_INDEX, excess) or []] if excess > 0 else []
+            for key in lru:
+                self._rm(key)
+            if keys or lru:
+                logging.info(f"PageAnalysisCache evicted {len(keys)} expired and {len(lru)} least recently used entries")
+        except Exception:
+            logging.exception("PageAnalysisCache.evict got exception")
+
+    @contextmanager
+    def for_doc(self, doc_id: str):
+        """The entries used meanwhile belong to the document as well, see drop_doc()."""
+        token = PAGE_ANALYSIS_CACHE_DOC.set(doc_id)
+        try:
+            yield
+        finally:
+            PAGE_ANALYSIS_CACHE_DOC.reset(token)
+
+    def drop_doc(self, doc_id: str):
+        """Remove the entries used by the pages of the document, called when it is deleted."""
+        if not self.enabled:
+            return
+        from rag.utils.redis_conn import REDIS_CONN
+        try:
+            for key in REDIS_CONN.smembers(doc_entries_key(doc_id)) or []:
+                self._rm(key)
+                REDIS_CONN.zrem(PAGE_ANALYSIS_CACHE_INDEX, key)
+            REDIS_CONN.delete(doc_entries_key(doc_id))
+        except Exception:
+            logging.exception(f"PageAnalysisCache.drop_doc {doc_id} got exception")
+
+    def info(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0}
+
+
+PAGE_ANALYSIS_CACHE = PageAnalysisCache()
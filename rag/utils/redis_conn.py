@@ -16,11 +16,13 @@
 
 import logging
 import json
+import time
 import uuid
 
 import valkey as redis
 from rag import settings
 from rag.utils import singleton
+from valkey.exceptions import LockError
 from valkey.lock import Lock
 
 class RedisMsg:
@@ -45,6 +47,9 @@ class RedisMsg:
     def get_msg_id(self):
         return self.__msg_id
 
+    def get_queue_name(self):
+        return self.__queue_name
+
 
 @singleton
 class RedisDB:
@@ -57,16 +62,33 @@ class RedisDB:
         end
         return 0
     """
+    lua_queue_renew = None
+    # ARGV: group, consumer, msg ids; XCLAIM only the ids still pending on this consumer and return those
+    LUA_QUEUE_RENEW_SCRIPT = """
+        local owned = {}
+        for i = 3, #ARGV do
+            local pending = redis.call('XPENDING', KEYS[1], ARGV[1], ARGV[i], ARGV[i], 1)
+            if pending[1] and pending[1][2] == ARGV[2] then
+                redis.call('XCLAIM', KEYS[1], ARGV[1], ARGV[2], 0, ARGV[i], 'JUSTID')
+                table.insert(owned, ARGV[i])
+            end
+        end
+        return owned
+    """
 
     def __init__(self):
         self.REDIS = None
+        self.REDIS_BIN = None
         self.config = settings.REDIS
+        # (queue, group) known to exist, so that batch reads don't ask every time
+        self.queue_groups = set()
         self.__open__()
 
     def register_scripts(self) -> None:
         cls = self.__class__
         client = self.REDIS
         cls.lua_delete_if_equal = client.register_script(cls.LUA_DELETE_IF_EQUAL_SCRIPT)
+        cls.lua_queue_renew = client.register_script(cls.LUA_QUEUE_RENEW_SCRIPT)
 
     def __open__(self):
         try:
@@ -77,6 +99,14 @@ class RedisDB:
                 password=self.config.get("password"),
                 decode_responses=True,
             )
+            # for values which aren't text, like packed vectors
+            self.REDIS_BIN = redis.StrictRedis(
+                host=self.config["host"].split(":")[0],
+                port=int(self.config.get("host", ":6379").split(":")[1]),
+                db=int(self.config.get("db", 1)),
+                password=self.config.get("password"),
+                decode_responses=False,
+            )
             self.register_scripts()
         except Exception:
             logging.warning("Redis can't be connected.")
@@ -129,6 +159,39 @@ class RedisDB:
             self.__open__()
         return False
 
+    def mget_bytes(self, keys: list[str]) -> list[bytes | None]:
+        if not self.REDIS_BIN or not keys:
+            return [None] * len(keys)
+        try:
+            return self.REDIS_BIN.mget(keys)
+        except Exception as e:
+            logging.warning("RedisDB.mget_bytes got exception: " + str(e))
+            self.__open__()
+        return [None] * len(keys)
+
+    def mset_bytes(self, mapping: dict[str, bytes], exp=3600):
+        if not self.REDIS_BIN or not mapping:
+            return False
+        try:
+            pipeline = self.REDIS_BIN.pipeline(transaction=False)
+            for k, v in mapping.items():
+                pipeline.set(k, v, exp)
+            pipeline.execute()
+            return True
+        except Exception as e:
+            logging.warning("RedisDB.mset_bytes got exception: " + str(e))
+            self.__open__()
+        return False
+
+    def delete(self, key) -> bool:
+        try:
+            self.REDIS.delete(key)
+            return True
+        except Exception as e:
+            logging.warning("RedisDB.delete " + str(key) + " got exception: " + str(e))
+            self.__open__()
+        return False
+
     def sadd(self, key: str, member: str):
         try:
             self.REDIS.sadd(key, member)
@@ -158,9 +221,9 @@ class RedisDB:
             self.__open__()
         return None
 
-    def zadd(self, key: str, member: str, score: float):
+    def zadd(self, key: str, member: str, score: float, xx=False):
         try:
-            self.REDIS.zadd(key, {member: score})
+            self.REDIS.zadd(key, {member: score}, xx=xx)
             return True
         except Exception as e:
             logging.warning("RedisDB.zadd " + str(key) + " got exception: " + str(e))
@@ -196,6 +259,73 @@ class RedisDB:
             self.__open__()
         return None
 
+    def zrem(self, key: str, member: str):
+        try:
+            self.REDIS.zrem(key, member)
+            return True
+        except Exception as e:
+            logging.warning("RedisDB.zrem " + str(key) + " got exception: " + str(e))
+            self.__open__()
+        return False
+
+    def zremrangebyscore(self, key: str, min: float, max: float):
+        try:
+            return self.REDIS.zremrangebyscore(key, min, max)
+        except Exception as e:
+            logging.warning("RedisDB.zremrangebyscore " + str(key) + " got exception: " + str(e))
+            self.__open__()
+        return 0
+
+    def hgetall(self, key: str):
+        try:
+            return self.REDIS.hgetall(key)
+        except Exception as e:
+            logging.warning("RedisDB.hgetall " + str(key) + " got exception: " + str(e))
+            self.__open__()
+        return None
+
+    def rpush(self, key: str, value: str):
+        try:
+            self.REDIS.rpush(key, value)
+            return True
+        except Exception as e:
+            logging.warning("RedisDB.rpush " + str(key) + " got exception: " + str(e))
+            self.__open__()
+        return False
+
+    def lpush(self, key: str, value: str):
+        try:
+            self.REDIS.lpush(key, value)
+            return True
+        except Exception as e:
+            logging.warning("RedisDB.lpush " + str(key) + " got exception: " + str(e))
+            self.__open__()
+        return False
+
+    def lpop(self, key: str):
+        try:
+            return self.REDIS.lpop(key)
+        except Exception as e:
+            logging.warning("RedisDB.lpop " + str(key) + " got exception: " + str(e))
+            self.__open__()
+        return None
+
+    def llen(self, key: str) -> int:
+        try:
+            return self.REDIS.llen(key)
+        except Exception as e:
+            logging.warning("RedisDB.llen " + str(key) + " got exception: " + str(e))
+            self.__open__()
+        return 0
+
+    def lindex(self, key: str, index: int):
+        try:
+            return self.REDIS.lindex(key, index)
+        except Exception as e:
+            logging.warning("RedisDB.lindex " + str(key) + " got exception: " + str(e))
+            self.__open__()
+        return None
+
     def transaction(self, key, value, exp=3600):
         try:
             pipeline = self.REDIS.pipeline(transaction=True)
@@ -209,11 +339,11 @@ class RedisDB:
             self.__open__()
         return False
 
-    def queue_product(self, queue, message) -> bool:
+    def queue_product(self, queue, message, maxlen=None) -> bool:
         for _ in range(3):
             try:
                 payload = {"message": json.dumps(message)}
-                self.REDIS.xadd(queue, payload)
+                self.REDIS.xadd(queue, payload, maxlen=maxlen, approximate=True)
                 return True
             except Exception as e:
                 logging.exception(
@@ -221,6 +351,37 @@ class RedisDB:
                 )
         return False
 
+    def queue_range(self, queue, count) -> list[tuple[str, dict]]:
+        """The first `count` messages of the stream, without consuming them."""
+        try:
+            return [(msg_id, json.loads(payload["message"])) for msg_id, payload in self.REDIS.xrange(queue, count=count)]
+        except Exception as e:
+            logging.warning("RedisDB.queue_range " + str(queue) + " got exception: " + str(e))
+            self.__open__()
+        return []
+
+    def queue_wait(self, queue, count, timeout: float) -> list[tuple[str, dict]]:
+        """Like queue_range, but waits up to `timeout` seconds for a message if the stream is empty."""
+        try:
+            messages = self.REDIS.xread({queue: "0"}, count=count, block=max(1, int(timeout * 1000)))
+            if not messages:
+                return []
+            return [(msg_id, json.loads(payload["message"])) for msg_id, payload in messages[0][1]]
+        except Exception as e:
+            logging.warning("RedisDB.queue_wait " + str(queue) + " got exception: " + str(e))
+            self.__open__()
+        return []
+
+    def queue_delete(self, queue, msg_ids: list[str]):
+        try:
+            if msg_ids:
+                self.REDIS.xdel(queue, *msg_ids)
+            return True
+        except Exception as e:
+            logging.warning("RedisDB.queue_delete " + str(queue) + " got exception: " + str(e))
+            self.__open__()
+        return False
+
     def queue_consumer(self, queue_name, group_name, consumer_name, msg_id=b">") -> RedisMsg:
         """https://redis.io/docs/latest/commands/xreadgroup/"""
         try:
@@ -255,6 +416,70 @@ class RedisDB:
                 )
         return None
 
+    def queue_group(self, queue_name, group_name):
+        if (queue_name, group_name) in self.queue_groups:
+            return
+        try:
+            self.REDIS.xgroup_create(queue_name, group_name, id="0", mkstream=True)
+        except redis.exceptions.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+        self.queue_groups.add((queue_name, group_name))
+
+    def queue_consumer_batch(self, queue_name, group_name, consumer_name, count, block=None) -> list[RedisMsg] | None:
+        """
+        Up to `count` new messages in one XREADGROUP, waiting up to `block` milliseconds for one if there's none.
+        None if Redis failed.
+        """
+        try:
+            self.queue_group(queue_name, group_name)
+            messages = self.REDIS.xreadgroup(group_name, consumer_name, {queue_name: ">"}, count=count, block=block)
+            if not messages:
+                return []
+            stream, element_list = messages[0]
+            return [RedisMsg(self.REDIS, queue_name, group_name, msg_id, payload) for msg_id, payload in element_list]
+        except Exception as e:
+            # the group is gone if Redis lost its data
+            self.queue_groups.discard((queue_name, group_name))
+            logging.warning("RedisDB.queue_consumer_batch " + str(queue_name) + " got exception: " + str(e))
+        return None
+
+    def queue_ack(self, queue_name, group_name, msg_ids: list[str]):
+        try:
+            if msg_ids:
+                self.REDIS.xack(queue_name, group_name, *msg_ids)
+            return True
+        except Exception as e:
+            logging.warning("RedisDB.queue_ack " + str(queue_name) + " got exception: " + str(e))
+            self.__open__()
+        return False
+
+    def queue_renew(self, queue_name, group_name, consumer_name, msg_ids: list[str]):
+        """
+        Reset the idle time of messages the consumer is working on, so that queue_autoclaim leaves them alone.
+        Messages another consumer has meanwhile claimed are left to it. Returns the ids still owned, None on failure.
+        """
+        try:
+            if not msg_ids:
+                return set()
+            owned = self.lua_queue_renew(keys=[queue_name], args=[group_name, consumer_name] + list(msg_ids))
+            return set(owned)
+        except Exception as e:
+            logging.warning("RedisDB.queue_renew " + str(queue_name) + " got exception: " + str(e))
+            self.__open__()
+        return None
+
+    def queue_autoclaim(self, queue_name, group_name, consumer_name, min_idle_ms, count) -> list[RedisMsg]:
+        """Take over up to `count` messages delivered to other consumers which haven't been acked or renewed for `min_idle_ms`."""
+        try:
+            res = self.REDIS.xautoclaim(queue_name, group_name, consumer_name, min_idle_ms, count=count)
+            # messages deleted from the stream meanwhile come back without payload
+            return [RedisMsg(self.REDIS, queue_name, group_name, msg_id, payload) for msg_id, payload in res[1] if payload]
+        except Exception as e:
+            if "NOGROUP" not in str(e):
+                logging.warning("RedisDB.queue_autoclaim " + str(queue_name) + " got exception: " + str(e))
+        return []
+
     def get_unacked_iterator(self, queue_names: list[str], group_name, consumer_name):
         try:
             for queue_name in queue_names:
@@ -293,6 +518,44 @@ class RedisDB:
             )
         return None
 
+    def publish(self, channel: str, message: str):
+        try:
+            self.REDIS.publish(channel, message)
+            return True
+        except Exception as e:
+            logging.warning("RedisDB.publish " + str(channel) + " got exception: " + str(e))
+            self.__open__()
+        return False
+
+    def subscribe(self, channels: list[str]):
+        """A PubSub on `channels` for wait_message, close it when done."""
+        try:
+            pubsub = self.REDIS.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(*channels)
+            return pubsub
+        except Exception as e:
+            logging.warning("RedisDB.subscribe " + str(channels) + " got exception: " + str(e))
+            self.__open__()
+        return None
+
+    @staticmethod
+    def wait_message(pubsub, timeout: float) -> dict | None:
+        """The next message published to the channels of `pubsub`, None after `timeout` seconds."""
+        deadline = time.monotonic() + timeout
+        while (left := deadline - time.monotonic()) > 0:
+            if pubsub is None:
+                time.sleep(left)
+                break
+            try:
+                msg = pubsub.get_message(timeout=left)
+            except Exception as e:
+                logging.warning("RedisDB.wait_message got exception: " + str(e))
+                time.sleep(min(left, 1))
+                continue
+            if msg:
+                return msg
+        return None
+
     def delete_if_equal(self, key: str, expected_value: str) -> bool:
         """
         Do follwing atomically:
@@ -311,11 +574,43 @@ class RedisDistributedLock:
         else:
             self.lock_value = str(uuid.uuid4())
         self.timeout = timeout
-        self.lock = Lock(REDIS_CONN.REDIS, lock_key, timeout=timeout, blocking_timeout=blocking_timeout)
+        # not thread local, as it may be acquired in a worker thread and released elsewhere
+        self.lock = Lock(REDIS_CONN.REDIS, lock_key, timeout=timeout, blocking_timeout=blocking_timeout, thread_local=False)
+
+    @property
+    def released_channel(self):
+        return f"{self.lock_key}_released"
 
     def acquire(self):
         REDIS_CONN.delete_if_equal(self.lock_key, self.lock_value)
         return self.lock.acquire(token=self.lock_value)
 
+    def wait_acquire(self, timeout) -> bool:
+        """acquire(), or wait up to `timeout` seconds for the lock to be released and return False."""
+        pubsub = REDIS_CONN.subscribe([self.released_channel])
+        try:
+            if self.acquire():
+                return True
+            REDIS_CONN.wait_message(pubsub, timeout)
+            return False
+        finally:
+            if pubsub is not None:
+                pubsub.close()
+
+    def extend(self) -> bool:
+        """Restart the timeout of the lock, False if it isn't held anymore."""
+        try:
+            return self.lock.extend(self.timeout, replace_ttl=True)
+        except LockError as e:
+            logging.warning(f"RedisDistributedLock.extend {self.lock_key} got exception: {e}")
+        return False
+
     def release(self):
-        return self.lock.release()
+        try:
+            self.lock.release()
+        except LockError as e:
+            # it expired, and may be somebody else's by now
+            logging.warning(f"RedisDistributedLock.release {self.lock_key} got exception: {e}")
+            return False
+        REDIS_CONN.publish(self.released_channel, self.lock_value)
+        return True
@@ -0,0 +1,193 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+Fair share of the task executors between tenants.
+
+Tasks are queued per tenant and priority. One task executor at a time moves them into the queues
+the executors read, keeping no more than TASK_SCHEDULER_WINDOW undelivered in each, so whatever
+was queued later by another tenant is never stuck behind a large backlog. Tenants are served by
+deficit round robin: each turn a tenant earns TASK_SCHEDULER_QUANTUM pages times its weight
+(the hash rag_flow_svr_tenant_weights, 1 by default) and spends them on its tasks, a task costing
+its number of pages. Tenants with TASK_TENANT_MAX_RUNNING tasks running, or whose next task's chunk
+method has its TASK_METHOD_MAX_RUNNING running, are skipped. The deficits and the tenant served last
+are kept in Redis, so that the round robin carries on where it was when another executor takes the lock.
+"""
+import json
+import logging
+import math
+import os
+import time
+from collections import Counter, defaultdict
+
+from rag.settings import SVR_CONSUMER_GROUP_NAME, SVR_QUEUE_PRIORITIES, get_svr_queue_name
+from rag.utils.redis_conn import REDIS_CONN
+
+# 0 queues tasks straight into the queues the executors read
+TASK_FAIR_SCHEDULING = int(os.environ.get("TASK_FAIR_SCHEDULING", "1"))
+TASK_SCHEDULER_WINDOW = int(os.environ.get("TASK_SCHEDULER_WINDOW", "8"))
+TASK_SCHEDULER_QUANTUM = float(os.environ.get("TASK_SCHEDULER_QUANTUM", "12"))
+# 0 for no limit
+TASK_TENANT_MAX_RUNNING = int(os.environ.get("TASK_TENANT_MAX_RUNNING", "0"))
+# running tasks allowed per chunk method, or task type for raptor and graphrag, like {"knowledge_graph": 4}
+TASK_METHOD_MAX_RUNNING = json.loads(os.environ.get("TASK_METHOD_MAX_RUNNING", "{}"))
+# seconds a dispatched task counts as running without being renewed by its executor
+TASK_SCHEDULER_RUNNING_TTL = int(os.environ.get("TASK_SCHEDULER_RUNNING_TTL", "1800"))
+
+TASK_SCHEDULER_RUNNING = "rag_flow_svr_running"
+TASK_SCHEDULER_WEIGHTS = "rag_flow_svr_tenant_weights"
+# seconds the round robin state of a priority outlives its last dispatch
+TASK_SCHEDULER_STATE_TTL = 24 * 3600
+
+
+def tenants_key(priority: int) -> str:
+    return f"rag_flow_svr_tenants_{priority}"
+
+
+def tenant_queue_name(priority: int, tenant_id: str) -> str:
+    return f"rag_flow_svr_tenant_queue_{priority}_{tenant_id}"
+
+
+def state_key(priority: int) -> str:
+    return f"rag_flow_svr_scheduler_state_{priority}"
+
+
+class TaskScheduler:
+    @staticmethod
+    def enqueue(priority: int, tenant_id: str, method: str, message: dict, cost=1) -> bool:
+        if not TASK_FAIR_SCHEDULING:
+            return REDIS_CONN.queue_product(get_svr_queue_name(priority), message=message)
+        entry = {"method": method, "cost": max(1, cost), "message": message}
+        return REDIS_CONN.rpush(tenant_queue_name(priority, tenant_id), json.dumps(entry)) and \
+            REDIS_CONN.sadd(tenants_key(priority), tenant_id)
+
+    @staticmethod
+    def finished(message: dict):
+        if message and message.get("scheduled"):
+            REDIS_CONN.zrem(TASK_SCHEDULER_RUNNING, message["scheduled"])
+
+    @staticmethod
+    def renew(messages: list[dict]):
+        now = time.time()
+        for message in messages:
+            if message and message.get("scheduled"):
+                REDIS_CONN.zadd(TASK_SCHEDULER_RUNNING, message["scheduled"], now, xx=True)
+
+    @staticmethod
+    def backlog() -> int:
+        """Number of tasks in the tenant queues, not dispatched yet."""
+        return sum(REDIS_CONN.llen(tenant_queue_name(p, t)) for p in SVR_QUEUE_PRIORITIES
+                   for t in REDIS_CONN.smembers(tenants_key(p)) or [])
+
+    def dispatch(self) -> int:
+        """Move tasks of the tenant queues into the executor queues, the caller holds the scheduler lock."""
+        now = time.time()
+        REDIS_CONN.zremrangebyscore(TASK_SCHEDULER_RUNNING, 0, now - TASK_SCHEDULER_RUNNING_TTL)
+        running = REDIS_CONN.zrangebyscore(TASK_SCHEDULER_RUNNING, now - TASK_SCHEDULER_RUNNING_TTL, "+inf") or []
+        running = [m.split("\t") for m in running]
+        tenant_running = Counter(tenant_id for tenant_id, _, _ in running)
+        method_running = Counter(method for _, method, _ in running)
+        weights = REDIS_CONN.hgetall(TASK_SCHEDULER_WEIGHTS) or {}
+        return sum(self.dispatch_priority(p, tenant_running, method_running, weights) for p in SVR_QUEUE_PRIORITIES)
+
+    def dispatch_priority(self, priority, tenant_running: Counter, method_running: Counter, weights: dict) -> int:
+        svr_queue_name = get_svr_queue_name(priority)
+        group = REDIS_CONN.queue_info(svr_queue_name, SVR_CONSUMER_GROUP_NAME) or {}
+        room = TASK_SCHEDULER_WINDOW - int(group.get("lag") or 0)
+        tenants = sorted(REDIS_CONN.smembers(tenants_key(priority)) or [])
+        if room <= 0 or not tenants:
+            return 0
+        state = json.loads(REDIS_CONN.get(state_key(priority)) or "{}")
+        deficits = defaultdict(float, state.get("deficits", {}))
+        # the round robin resumes after the tenant served last
+        last = state.get("last_tenant")
+        i = next((i for i, t in enumerate(tenants) if last is not None and t > last), 0)
+        tenants = tenants[i:] + tenants[:i]
+
+        heads = {}
+
+        def head(tenant_id):
+            if tenant_id not in heads:
+                entry = REDIS_CONN.lindex(tenant_queue_name(priority, tenant_id), 0)
+                heads[tenant_id] = json.loads(entry) if entry else None
+            return heads[tenant_id]
+
+        def blocked(tenant_id):
+            entry = head(tenant_id)
+            if entry is None:
+                return True
+            if TASK_TENANT_MAX_RUNNING and tenant_running[tenant_id] >= TASK_TENANT_MAX_RUNNING:
+                return True
+            cap = TASK_METHOD_MAX_RUNNING.get(entry["method"])
+            return cap is not None and method_running[entry["method"]] >= cap
+
+        def quantum(tenant_id):
+            return TASK_SCHEDULER_QUANTUM * max(0.01, float(weights.get(tenant_id, 1)))
+
+        dispatched = 0
+        try:
+            while room > 0:
+                eligible = [t for t in tenants if not blocked(t)]
+                if not eligible:
+                    break
+                # turns every tenant takes before the first of them can afford its next task
+                turns = max(1, min(math.ceil((head(t)["cost"] - deficits[t]) / quantum(t)) for t in eligible))
+                for tenant_id in eligible:
+                    if room <= 0:
+                        break
+                    deficits[tenant_id] += turns * quantum(tenant_id)
+                    while room > 0 and not blocked(tenant_id) and head(tenant_id)["cost"] <= deficits[tenant_id]:
+                        entry = heads.pop(tenant_id)
+                        if not self.forward(priority, tenant_id, entry):
+                            return dispatched
+                        tenant_running[tenant_id] += 1
+                        method_running[entry["method"]] += 1
+                        deficits[tenant_id] -= entry["cost"]
+                        room -= 1
+                        dispatched += 1
+                    last = tenant_id
+                    if head(tenant_id) is None:
+                        deficits.pop(tenant_id, None)
+                        self.retire(priority, tenant_id)
+        finally:
+            deficits = {t: d for t, d in deficits.items() if t in tenants}
+            REDIS_CONN.set_obj(state_key(priority), {"last_tenant": last, "deficits": deficits}, TASK_SCHEDULER_STATE_TTL)
+        if dispatched:
+            logging.info(f"TaskScheduler dispatched {dispatched} tasks into {svr_queue_name}")
+        return dispatched
+
+    @staticmethod
+    def forward(priority, tenant_id, entry) -> bool:
+        queue_name = tenant_queue_name(priority, tenant_id)
+        raw = REDIS_CONN.lpop(queue_name)
+        if not raw:
+            return False
+        message = entry["message"]
+        message["scheduled"] = f"{tenant_id}\t{entry['method']}\t{message['id']}"
+        if not REDIS_CONN.queue_product(get_svr_queue_name(priority), message=message):
+            REDIS_CONN.lpush(queue_name, raw)
+            return False
+        REDIS_CONN.zadd(TASK_SCHEDULER_RUNNING, message["scheduled"], time.time())
+        return True
+
+    @staticmethod
+    def retire(priority, tenant_id):
+        REDIS_CONN.srem(tenants_key(priority), tenant_id)
+        # unless a task was queued meanwhile
+        if REDIS_CONN.lindex(tenant_queue_name(priority, tenant_id), 0) is not None:
+            REDIS_CONN.sadd(tenants_key(priority), tenant_id)
+
+
+TASK_SCHEDULER = TaskScheduler()
@@ -23,12 +23,13 @@ class Tavily:
     def __init__(self, api_key: str):
         self.tavily_client = TavilyClient(api_key=api_key)
 
-    def search(self, query):
+    def search(self, query, timeout=60):
         try:
             response = self.tavily_client.search(
                 query=query,
                 search_depth="advanced",
-                max_results=6
+                max_results=6,
+                timeout=max(1, int(timeout))
             )
             return [{"url": res["url"], "title": res["title"], "content": res["content"], "score": res["score"]} for res in response["results"]]
         except Exception as e:
@@ -36,11 +37,11 @@ class Tavily:
 
         return []
 
-    def retrieve_chunks(self, question):
+    def retrieve_chunks(self, question, timeout=60):
         chunks = []
         aggs = []
         logging.info("[Tavily]Q: " + question)
-        for r in self.search(question):
+        for r in self.search(question, timeout):
             id = get_uuid()
             chunks.append({
                 "chunk_id": id,
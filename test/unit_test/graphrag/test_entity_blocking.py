@@ -0,0 +1,94 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import itertools
+import random
+
+import editdistance
+import pytest
+
+from api import settings  # noqa: F401, imported first like the servers do, graphrag.utils and it import each other
+from graphrag.entity_blocking import blocking_candidates
+from graphrag.entity_resolution import EntityResolution
+from rag.nlp import is_english
+
+CJK_NAMES = ["北京大学", "北京理工大学", "上海交通大学", "上海交大", "马云", "马云先生", "阿里巴巴集团", "阿里巴巴",
+             "清华大学", "浙江大学", "中国科学院", "中科院", "腾讯控股", "腾讯公司", "华为技术有限公司", "华为"]
+CJK_CHARS = "的一是在不了有人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动同工也能下过子说产种面而方后多定行学法所民得经"
+ENGLISH_NAMES = ["Microsoft", "Microsoft Corp", "Microsoft Corporation", "Alibaba Group", "Alibaba", "Tencent Holdings",
+                 "Tencent", "Peking University", "Beijing University", "Tsinghua University", "Huawei Technologies", "Huawei"]
+
+
+def is_similarity(a, b):
+    return EntityResolution.is_similarity(None, a, b)
+
+
+def baseline_pairs(names, queries):
+    """What entity resolution compared before blocking: every combination is_similarity takes."""
+    return {(min(a, b), max(a, b)) for a, b in itertools.combinations(names, 2)
+            if (a in queries or b in queries) and is_similarity(a, b)}
+
+
+def cjk_variants(n, seed=0):
+    rng = random.Random(seed)
+    names = set(CJK_NAMES)
+    while len(names) < n:
+        base = rng.choice(CJK_NAMES)
+        extra = "".join(rng.choice(CJK_CHARS) for _ in range(rng.randint(1, 3)))
+        names.add(rng.choice([base + extra, extra + base, base[:2] + extra, extra]))
+    return sorted(names)
+
+
+@pytest.mark.parametrize("pair", [("北京大学", "北京理工大学"), ("上海交通大学", "上海交大"), ("马云", "马云先生")])
+def test_cjk_pairs_are_candidates(pair):
+    names = cjk_variants(200)
+    assert is_similarity(*pair)
+    assert (min(pair), max(pair)) in blocking_candidates(names, set(pair))
+
+
+@pytest.mark.parametrize("seed", [0, 1])
+def test_cjk_recall_against_all_combinations(seed):
+    names = cjk_variants(2000, seed)
+    queries = set(random.Random(seed).sample(names, 200))
+    expected = baseline_pairs(names, queries)
+    got = blocking_candidates(names, queries)
+    assert expected, "the names should have similar pairs"
+    assert expected <= got
+
+
+def test_mixed_pairs_are_candidates():
+    names = ["iPhone", "iPhone手机", "苹果手机", "Apple"]
+    queries = set(names)
+    expected = {p for p in baseline_pairs(names, queries) if not (is_english(p[0]) and is_english(p[1]))}
+    assert expected <= blocking_candidates(names, queries)
+
+
+def test_english_near_duplicates_are_candidates():
+    names = ENGLISH_NAMES
+    queries = set(names)
+    # the pairs is_similarity takes by edit distance, those sharing two letters are nearly all pairs
+    expected = {(min(a, b), max(a, b)) for a, b in itertools.combinations(names, 2)
+                if editdistance.eval(a, b) <= min(len(a), len(b)) // 2}
+    got = blocking_candidates(names, queries)
+    assert expected
+    assert len(expected & got) / len(expected) >= 0.9
+    # and far from all of them
+    assert len(got) < len(list(itertools.combinations(names, 2))) / 2
+
+
+def test_only_pairs_with_a_query():
+    names = cjk_variants(300)
+    queries = {"北京大学"}
+    assert all("北京大学" in pair for pair in blocking_candidates(names, queries))
@@ -0,0 +1,114 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import pytest
+
+from rag.utils import embedded_conn
+from rag.utils.doc_store_conn import MatchDenseExpr, MatchTextExpr, OrderByExpr
+from rag.utils.embedded_conn import EmbeddedConnection, EmbeddedIndex
+
+INDEX = "ragflow_tenant"
+FIELDS = ["docnm_kwd", "content_ltks", "doc_id", "available_int"]
+
+
+def chunk(i, doc_id="d1", text="", **kwargs):
+    return {"id": f"c{i}", "doc_id": doc_id, "docnm_kwd": f"{doc_id}.txt", "content_ltks": text,
+            "content_with_weight": text, "q_4_vec": [1.0, float(i), 0.0, 0.0], **kwargs}
+
+
+@pytest.fixture
+def conn(tmp_path, monkeypatch):
+    monkeypatch.setattr(embedded_conn.settings, "EMBEDDED", {"path": str(tmp_path)})
+    # the connection is a singleton, point it at the directory of the test
+    c = EmbeddedConnection()
+    c.path, c.indices = str(tmp_path), {}
+    return c
+
+
+def reopen(conn):
+    """Forget the indices kept in memory, as a process starting anew."""
+    conn.indices = {}
+    return conn
+
+
+def search(conn, condition, match=None, kb_ids=("kb1",), limit=100):
+    return conn.search(FIELDS, [], condition, match or [], OrderByExpr(), 0, limit, INDEX, list(kb_ids))
+
+
+def test_insert_and_get(conn):
+    assert conn.insert([chunk(1, text="hello world")], INDEX, "kb1") == []
+    row = conn.get("c1", INDEX, ["kb1"])
+    assert row["content_ltks"] == "hello world"
+    assert row["kb_id"] == "kb1"
+    assert row["q_4_vec"] == [1.0, 1.0, 0.0, 0.0]
+
+
+def test_filter_by_keys(conn):
+    conn.insert([chunk(1, "d1"), chunk(2, "d1"), chunk(3, "d2", available_int=0)], INDEX, "kb1")
+    conn.insert([chunk(4, "d1")], INDEX, "kb2")
+    assert set(conn.getChunkIds(search(conn, {}))) == {"c1", "c2", "c3"}
+    assert set(conn.getChunkIds(search(conn, {"doc_id": "d1"}))) == {"c1", "c2"}
+    assert set(conn.getChunkIds(search(conn, {"doc_id": ["d1", "d2"]}, kb_ids=["kb1", "kb2"]))) == {"c1", "c2", "c3", "c4"}
+    assert set(conn.getChunkIds(search(conn, {"docnm_kwd": "d2.txt"}))) == {"c3"}
+    assert set(conn.getChunkIds(search(conn, {"available_int": 1}))) == {"c1", "c2"}
+    assert set(conn.getChunkIds(search(conn, {"available_int": 0}))) == {"c3"}
+    assert search(conn, {"doc_id": "d3"})["total"] == 0
+
+
+def test_fulltext_and_dense_search(conn):
+    conn.insert([chunk(1, text="apple banana"), chunk(2, text="banana cherry"), chunk(3, text="durian")], INDEX, "kb1")
+    res = search(conn, {}, [MatchTextExpr(["content_ltks"], "apple", 10, {"minimum_should_match": 0.0})])
+    assert conn.getChunkIds(res) == ["c1"]
+    res = search(conn, {}, [MatchDenseExpr("q_4_vec", [1.0, 3.0, 0.0, 0.0], "float", "cosine", 2, {"similarity": 0.0})])
+    assert conn.getChunkIds(res)[0] == "c3"
+    assert set(conn.getFields(res, ["_score", "id"])["c3"]) == {"_score", "id"}
+
+
+def test_update_and_delete(conn):
+    conn.insert([chunk(1, "d1"), chunk(2, "d1"), chunk(3, "d2")], INDEX, "kb1")
+    assert conn.update({"id": "c1"}, {"available_int": 0}, INDEX, "kb1")
+    assert set(conn.getChunkIds(search(conn, {"available_int": 1}))) == {"c2", "c3"}
+    assert conn.delete({"doc_id": "d1"}, INDEX, "kb1") == 2
+    assert conn.getChunkIds(search(conn, {})) == ["c3"]
+    assert conn.delete({"id": ["c3"]}, INDEX, "kb1") == 1
+    assert search(conn, {})["total"] == 0
+
+
+def test_reopen_after_compaction(conn, monkeypatch):
+    monkeypatch.setattr(embedded_conn, "WAL_COMPACT_RECORDS", 4)
+    conn.insert([chunk(i, f"d{i % 3}", text=f"term{i}") for i in range(10)], INDEX, "kb1")
+    conn.delete({"doc_id": "d0"}, INDEX, "kb1")
+    conn.update({"doc_id": "d1"}, {"important_kwd": ["k"]}, INDEX, "kb1")
+    before = sorted(conn.getChunkIds(search(conn, {})))
+    assert conn.indices[INDEX].generation > 0
+
+    reopen(conn)
+    assert sorted(conn.getChunkIds(search(conn, {}))) == before
+    assert set(conn.getChunkIds(search(conn, {"important_kwd": "k"}))) == {"c1", "c4", "c7"}
+    assert conn.get("c5", INDEX, ["kb1"])["q_4_vec"] == [1.0, 5.0, 0.0, 0.0]
+
+
+def test_deleted_index_is_not_written_by_stale_handles(conn, tmp_path):
+    conn.insert([chunk(1)], INDEX, "kb1")
+    stale = conn.indices[INDEX]
+    # another process deletes the index
+    conn.indices = {}
+    conn.deleteIdx(INDEX, "")
+    conn.indices = {INDEX: stale}
+
+    assert search(conn, {})["total"] == 0
+    assert conn.insert([chunk(2)], INDEX, "kb1") == []
+    assert conn.getChunkIds(search(conn, {})) == ["c2"]
+    assert EmbeddedIndex(str(tmp_path / INDEX)).instance != stale.instance